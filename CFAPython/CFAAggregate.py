@@ -0,0 +1,296 @@
+"""Automatic creation of a CFA-netCDF file from a collection of netCDF files.
+The metadata of each file is read in parallel, the dimensions that the files
+are concatenated along are inferred from their coordinate values, and each
+file becomes a fragment of every variable that spans those dimensions.  The
+fragment tables are written in bulk (see CFAVariable.setFragments).
+
+Usage: python -m CFAPython.CFAAggregate [--workers N] [--concat-dim D] out files
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+import argparse
+import glob
+import os
+import os.path
+import sys
+
+import numpy
+from netCDF4 import Dataset
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+
+def _expand_paths(paths: Iterable[str]) -> list[str]:
+    """Expand glob patterns in paths to a sorted list of absolute paths"""
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = set()
+    for p in paths:
+        matches = glob.glob(p, recursive=True)
+        if len(matches) == 0 and os.path.exists(p):
+            matches = [p]
+        expanded.update(os.path.abspath(m) for m in matches)
+    return sorted(expanded)
+
+def _scan_file(path: str) -> dict:
+    """Read the metadata of the netCDF file at path: the size of each
+    dimension, the values of the 1-D coordinate variables, and the
+    dimensions, dtype and attributes of the other variables.  This is run in a
+    worker process, so only returns plain (picklable) data."""
+    with Dataset(path, mode='r') as nc:
+        dims = {name: len(d) for name, d in nc.dimensions.items()}
+        coords = {}
+        variables = {}
+        for name, v in nc.variables.items():
+            attrs = {a: v.getncattr(a) for a in v.ncattrs()}
+            if v.dimensions == (name,):
+                coords[name] = (v[:], v.dtype, attrs)
+            else:
+                variables[name] = (v.dimensions, v.dtype, attrs)
+    return {"path": path, "dims": dims, "coords": coords,
+            "variables": variables}
+
+def _block_key(values: numpy.ndarray) -> bytes:
+    """Get a hashable key for the coordinate values of a file"""
+    return numpy.ma.getdata(values).tobytes()
+
+def _infer_concat_dims(files: list[dict]) -> list[str]:
+    """Infer the dimensions that the files are concatenated along: those whose
+    coordinate values (or sizes, if there is no coordinate variable) differ
+    between files"""
+    first = files[0]
+    concat_dims = []
+    for dim, size in first["dims"].items():
+        for f in files[1:]:
+            if dim not in f["dims"]:
+                raise CFAException(f"Dimension {dim} not in {f['path']}")
+            if dim in first["coords"] and dim in f["coords"]:
+                differ = (_block_key(f["coords"][dim][0]) !=
+                          _block_key(first["coords"][dim][0]))
+            else:
+                differ = f["dims"][dim] != size
+            if differ:
+                concat_dims.append(dim)
+                break
+    if len(concat_dims) == 0 and len(files) > 1:
+        raise CFAException("Cannot infer the dimension to concatenate along: "
+                           "the files have the same coordinates")
+    return concat_dims
+
+def _direction(values: numpy.ndarray, dim: str) -> int:
+    """Get the direction of the coordinate values of a file along dim: 1 if
+    they increase, -1 if they decrease, or 0 for a single value"""
+    diff = numpy.diff(numpy.ma.getdata(values))
+    if len(diff) == 0:
+        return 0
+    if numpy.all(diff > 0):
+        return 1
+    if numpy.all(diff < 0):
+        return -1
+    raise CFAException(f"Coordinate values of {dim} are not monotonic")
+
+def _blocks(files: list[dict], dim: str) -> tuple:
+    """Order the distinct coordinate blocks of the files along dim, which may
+    all increase or all decrease.  Returns the block index of each file, the
+    size of each block, and the concatenated coordinate values (or None, if
+    the files do not have a coordinate variable for dim)"""
+    if all(dim in f["coords"] for f in files):
+        blocks = {}
+        for f in files:
+            values = f["coords"][dim][0]
+            blocks.setdefault(_block_key(values), values)
+        directions = {_direction(v, dim) for v in blocks.values()} - {0}
+        if len(directions) > 1:
+            raise CFAException(f"Coordinate values of {dim} increase in some "
+                               "files and decrease in others")
+        sign = directions.pop() if directions else 1
+        ordered = sorted(blocks.items(), key=lambda kv: sign * kv[1][0])
+        # the blocks must not overlap, or the files cannot be concatenated
+        for (k0, v0), (k1, v1) in zip(ordered[:-1], ordered[1:]):
+            if sign * v0[-1] >= sign * v1[0]:
+                raise CFAException(
+                    f"Coordinate values of {dim} overlap between files"
+                )
+        position = {k: b for b, (k, v) in enumerate(ordered)}
+        file_block = [position[_block_key(f["coords"][dim][0])] for f in files]
+        sizes = [len(v) for k, v in ordered]
+        coords = numpy.ma.concatenate([v for k, v in ordered])
+        return file_block, sizes, coords
+    # without coordinates, the files are concatenated in the order of their
+    # paths
+    return (list(range(0, len(files))), [f["dims"][dim] for f in files],
+            None)
+
+def _check_files(files: list[dict], concat_dims: list[str]) -> None:
+    """Check that the files match the first file along the dimensions that
+    they are not concatenated along, in size and coordinate values, and that
+    their variables have the same dimensions"""
+    first = files[0]
+    for f in files[1:]:
+        for dim, size in first["dims"].items():
+            if dim in concat_dims:
+                continue
+            if f["dims"].get(dim, None) != size:
+                raise CFAException(
+                    f"Dimension {dim} of {f['path']} has size "
+                    f"{f['dims'].get(dim, None)}, not {size}"
+                )
+            if (dim in first["coords"] and dim in f["coords"] and
+                    _block_key(f["coords"][dim][0]) != 
+                    _block_key(first["coords"][dim][0])):
+                raise CFAException(
+                    f"Coordinate values of {dim} differ in {f['path']}"
+                )
+        for name, (dims, dtype, attrs) in f["variables"].items():
+            if (name in first["variables"] and 
+                    tuple(dims) != tuple(first["variables"][name][0])):
+                raise CFAException(
+                    f"Variable {name} of {f['path']} has dimensions "
+                    f"{tuple(dims)}, not {tuple(first['variables'][name][0])}"
+                )
+
+def aggregate(paths: Iterable[str], out_path: str,
+              concat_dims: list[str]=None, workers: int=None,
+              relative: bool=True, format: str="nc") -> dict:
+    """Create the CFA-netCDF file out_path from the netCDF files matching
+    paths (a glob pattern, or a list of paths or patterns).  The metadata of
+    the files are read in parallel by workers processes.
+    The files are concatenated along concat_dims, which are inferred from the
+    coordinate values if not given.  Every variable that spans all of the
+    concat_dims becomes an aggregation variable with one fragment per file;
+    the coordinate variables are written to the CFA-netCDF file.
+    Fragment files are referred to relative to the directory of out_path if
+    relative is True, otherwise by their absolute paths.  Fragments missing
+    from the grid of files are absent.  Returns a summary of the aggregation."""
+    from CFAPython.CFADataset import CFADataset
+    paths = _expand_paths(paths)
+    if len(paths) == 0:
+        raise CFAException("No files to aggregate")
+
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(paths) // (workers * 16))
+            files = list(pool.map(_scan_file, paths, chunksize=chunksize))
+    else:
+        files = [_scan_file(p) for p in paths]
+
+    if concat_dims is None:
+        concat_dims = _infer_concat_dims(files)
+    first = files[0]
+    _check_files(files, concat_dims)
+    blocks = {dim: _blocks(files, dim) for dim in concat_dims}
+
+    # the fragment location of each file along every concatenation dimension
+    frag_locs = [tuple(blocks[dim][0][i] for dim in concat_dims)
+                 for i in range(0, len(files))]
+    if len(set(frag_locs)) != len(frag_locs):
+        raise CFAException("More than one file has the same coordinates")
+
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    if relative:
+        frag_files = [os.path.relpath(f["path"], out_dir) for f in files]
+    else:
+        frag_files = [f["path"] for f in files]
+
+    ds = CFADataset(out_path, mode='w')
+    try:
+        # dimensions, and their coordinate variables
+        for dim, size in first["dims"].items():
+            coords = None
+            if dim in blocks:
+                size = sum(blocks[dim][1])
+                coords = blocks[dim][2]
+            if dim in first["coords"]:
+                values, dtype, attrs = first["coords"][dim]
+                if coords is None:
+                    coords = values
+                cfa_type = CFAPython.CFATypeFromNumpy(dtype)
+            else:
+                attrs = {}
+                cfa_type = CFAPython.CFAType.CFAInt
+            ds.CFA.createDimension(dim, cfa_type, size)
+            if dim in ds.variables:
+                nc_var = ds.variables[dim]
+                nc_var.setncatts({a: v for a, v in attrs.items()
+                                  if a != "_FillValue"})
+                if coords is not None:
+                    nc_var[:] = coords
+
+        # aggregation variables, with one fragment per file
+        n_vars = 0
+        for name, (dims, dtype, attrs) in first["variables"].items():
+            if not all(d in dims for d in concat_dims):
+                continue
+            var = ds.CFA.createVariable(name, CFAPython.CFATypeFromNumpy(dtype),
+                                        dims)
+            var.setAggregationInstruction({
+                "location": ("aggregation_location", False,
+                             CFAPython.CFAType.CFAInt),
+                "file"    : ("aggregation_file", False,
+                             CFAPython.CFAType.CFAString),
+                "format"  : ("aggregation_format", True,
+                             CFAPython.CFAType.CFAString),
+                "address" : ("aggregation_address", False,
+                             CFAPython.CFAType.CFAString),
+            })
+            frag_def = []
+            sizes = []
+            for d in dims:
+                if d in blocks:
+                    frag_def.append(len(blocks[d][1]))
+                    sizes.append(blocks[d][1])
+                else:
+                    frag_def.append(1)
+                    sizes.append([first["dims"][d]])
+            var.setFragmentDefinition(frag_def)
+            file_col = numpy.full(frag_def, None, dtype=object)
+            address_col = numpy.full(frag_def, None, dtype=object)
+            axes = [dims.index(d) for d in concat_dims]
+            for i, f in enumerate(files):
+                if name not in f["variables"]:
+                    continue
+                frag_loc = [0] * len(dims)
+                for axis, b in zip(axes, frag_locs[i]):
+                    frag_loc[axis] = b
+                file_col[tuple(frag_loc)] = frag_files[i]
+                address_col[tuple(frag_loc)] = name
+            var.setFragments({"file": file_col, "format": format,
+                              "address": address_col}, sizes=sizes)
+            var.nc.setncatts({a: v for a, v in attrs.items()
+                              if a != "_FillValue"})
+            n_vars += 1
+        ds.CFA.serialise()
+    finally:
+        ds.close()
+    return {"files": len(files), "variables": n_vars,
+            "concat_dims": concat_dims}
+
+def main(argv: list[str]=None) -> int:
+    """Command line interface to create a CFA-netCDF file from netCDF files"""
+    parser = argparse.ArgumentParser(
+        prog="cfa-aggregate",
+        description="Create a CFA-netCDF file from a collection of netCDF "
+                    "files"
+    )
+    parser.add_argument("out", help="the CFA-netCDF file to create")
+    parser.add_argument("files", nargs="+",
+                        help="the netCDF files, or glob patterns (quoted)")
+    parser.add_argument("--concat-dim", action="append", dest="concat_dims",
+                        help="a dimension to concatenate along (default: "
+                             "inferred), may be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--absolute", action="store_true",
+                        help="refer to fragment files by absolute path")
+    args = parser.parse_args(argv)
+
+    summary = aggregate(args.files, args.out, args.concat_dims, args.workers,
+                        relative=not args.absolute)
+    print(f"{summary['files']} files aggregated along "
+          f"{', '.join(summary['concat_dims'])} for {summary['variables']} "
+          "variables")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
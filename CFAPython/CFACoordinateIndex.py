@@ -0,0 +1,133 @@
+from __future__ import annotations
+import datetime
+import re
+
+import numpy
+
+from CFAPython.CFAExceptions import CFAException
+
+# a (partial) ISO 8601 date-time, e.g. "2001", "2001-03" or "2001-03-15T12"
+_DATETIME = re.compile(
+    r"^(\d{1,4})(?:-(\d{1,2})(?:-(\d{1,2})"
+    r"(?:[T ](\d{1,2})(?::(\d{1,2})(?::(\d{1,2}))?)?)?)?)?$"
+)
+
+class CFACoordinateIndex:
+    def __init__(self, values: object, units: str=None,
+                 calendar: str="standard"):
+        """Create an index of the (monotonic) values of a coordinate
+        variable, to find the index range of a coordinate range by binary
+        search.  If units are time units (e.g. "days since 2001-01-01") then
+        coordinate ranges can be given as (partial) ISO 8601 date-time
+        strings, e.g. "2001-03", or as datetime objects."""
+        values = numpy.ma.getdata(numpy.ma.asanyarray(values)).ravel()
+        self._size = len(values)
+        self._descending = False
+        if self._size > 1:
+            diff = numpy.diff(values)
+            if numpy.all(diff < 0):
+                self._descending = True
+            elif not numpy.all(diff > 0):
+                raise CFAException("Coordinate values are not monotonic")
+        # the values in ascending order, for searchsorted
+        self._values = values[::-1] if self._descending else values
+        self.units = units
+        self.calendar = calendar or "standard"
+
+    def __str__(self):
+        return (f"{self.__class__}: size={self._size}, units={self.units}, "
+                f"descending={self._descending}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def size(self) -> int:
+        """Return the number of coordinate values"""
+        return self._size
+
+    @property
+    def _isTime(self) -> bool:
+        """Whether the units are time units, i.e. "<units> since <date>" """
+        return self.units is not None and " since " in self.units
+
+    def _period(self, label: str) -> tuple[object, object]:
+        """Get the (start, end) date-times of the period given by a partial
+        ISO 8601 date-time string, e.g. the whole of March 2001 for
+        "2001-03"."""
+        import cftime
+        match = _DATETIME.match(label.strip())
+        if match is None:
+            raise CFAException(f"Cannot parse date-time {label}")
+        fields = [int(f) for f in match.groups() if f is not None]
+        full = fields + [1, 1, 0, 0, 0][len(fields)-1:]
+        start = cftime.datetime(*full, calendar=self.calendar)
+        if len(fields) == 1:
+            end = cftime.datetime(full[0] + 1, 1, 1, calendar=self.calendar)
+        elif len(fields) == 2:
+            year, month = divmod(full[1], 12)
+            end = cftime.datetime(full[0] + year, month + 1, 1,
+                                  calendar=self.calendar)
+        else:
+            end = start + [datetime.timedelta(days=1),
+                           datetime.timedelta(hours=1),
+                           datetime.timedelta(minutes=1),
+                           datetime.timedelta(seconds=1)][len(fields)-3]
+        return start, end
+
+    def _value(self, label: object) -> float:
+        """Convert a date-time object to a coordinate value"""
+        import cftime
+        return cftime.date2num(label, self.units, self.calendar)
+
+    def _bounds(self, label: object) -> tuple[float, float, bool]:
+        """Get the (lower, upper, upper_inclusive) coordinate bounds of a
+        label: a value, a date-time, or a period string"""
+        if isinstance(label, str) or hasattr(label, "timetuple"):
+            if not self._isTime:
+                raise CFAException(f"Cannot select {label} from coordinates "
+                                   f"in units {self.units}")
+            if isinstance(label, str):
+                start, end = self._period(label)
+                return self._value(start), self._value(end), False
+            value = self._value(label)
+            return value, value, True
+        return label, label, True
+
+    def getSlice(self, label: object) -> slice:
+        """Get the slice of the coordinate values within label: a slice of
+        coordinate values (inclusive at both ends, in either order, so that
+        slice(a, None) selects the values >= a), a single value (which must
+        exist), or a date-time string, which selects the whole period it 
+        gives, e.g. all the times in March 2001 for "2001-03".  The slice is
+        in the order the values are stored."""
+        if isinstance(label, slice):
+            lower = upper = None
+            if label.start is not None:
+                lower = self._bounds(label.start)
+            if label.stop is not None:
+                upper = self._bounds(label.stop)
+            if (lower is not None and upper is not None and
+                    upper[1] < lower[0]):
+                # the range is given in descending order
+                lower, upper = upper, lower
+            i0 = 0
+            i1 = self._size
+            if lower is not None:
+                i0 = numpy.searchsorted(self._values, lower[0], side="left")
+            if upper is not None:
+                i1 = numpy.searchsorted(self._values, upper[1],
+                                        side="right" if upper[2] else "left")
+            step = label.step
+        else:
+            lower, upper, inclusive = self._bounds(label)
+            i0 = numpy.searchsorted(self._values, lower, side="left")
+            i1 = numpy.searchsorted(self._values, upper,
+                                    side="right" if inclusive else "left")
+            if i1 <= i0:
+                raise CFAException(f"Coordinate value {label} not found")
+            step = None
+        i1 = max(int(i0), int(i1))
+        if self._descending:
+            i0, i1 = self._size - i1, self._size - int(i0)
+        return slice(int(i0), int(i1), step)
@@ -0,0 +1,130 @@
+"""Checking that the fragments of an aggregation variable tile its aggregated
+data exactly, with no holes and no overlaps.  The fragments form a grid, with
+the size of each fragment along each dimension given by the location table, so
+the check is made on whole arrays:
+
+    - along each dimension, the fragment sizes must be positive and sum to the
+      size of the dimension.  Fragments that extend past the end of the
+      dimension overlap, and a shortfall leaves a hole after the last
+      fragment.  This applies to location tables read from a file: at write
+      time, the sizes given to setFragments are checked when they are set,
+      and otherwise the fragmentation is regular
+    - every fragment of the grid must have been given a value (a hole), and
+      no fragment may have been set by setFragment from two different data
+      locations (an overlap, e.g. two fragment files that the writer meant to
+      put at different places).  Setting the terms of a fragment in several
+      calls, from the same location, is allowed
+
+Fragments set from more than one data location are found by sorting the
+(fragment, data location) pairs recorded by setFragment, so the check is
+O(n log n) in the number of fragments.
+"""
+from __future__ import annotations
+
+import numpy
+
+from CFAPython.CFAExceptions import CFAException
+
+class CFACoverageReport:
+    def __init__(self, variable: str, frag_def: list[int],
+                 holes: numpy.ndarray, overlaps: numpy.ndarray,
+                 messages: list[str]):
+        """The result of checking the coverage of the fragments of an
+        aggregation variable.  holes and overlaps are the (sorted) flat
+        indices of the offending fragments."""
+        self.variable = variable
+        self.frag_def = list(frag_def)
+        self.holes = holes
+        self.overlaps = overlaps
+        self.messages = messages
+
+    def __str__(self):
+        return (f"{self.__class__}: variable={self.variable}, "
+                f"holes={len(self.holes)}, overlaps={len(self.overlaps)}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def ok(self) -> bool:
+        """Return whether the fragments tile the aggregated data exactly"""
+        return (len(self.holes) == 0 and len(self.overlaps) == 0 and
+                len(self.messages) == 0)
+
+    def getLocations(self, fragments: numpy.ndarray) -> numpy.ndarray:
+        """Get the fragment locations of flat fragment indices (e.g. holes or
+        overlaps), as an array with a row per fragment"""
+        if len(self.frag_def) == 0:
+            return numpy.zeros((len(fragments), 0), dtype=numpy.int64)
+        return numpy.stack(numpy.unravel_index(fragments, self.frag_def),
+                           axis=-1)
+
+    def summary(self, max_fragments: int=10) -> str:
+        """Describe the problems found, listing at most max_fragments
+        offending fragment locations of each kind"""
+        lines = list(self.messages)
+        for kind, fragments in (("holes", self.holes),
+                                ("overlaps", self.overlaps)):
+            if len(fragments) == 0:
+                continue
+            locs = self.getLocations(fragments[0:max_fragments]).tolist()
+            more = ", ..." if len(fragments) > max_fragments else ""
+            lines.append(f"{len(fragments)} {kind} at fragment locations "
+                         f"{locs}{more}")
+        return f"{self.variable}: " + "; ".join(lines)
+
+def _check_sizes(shape: list[int], sizes: list[numpy.ndarray],
+                 frag_def: list[int]) -> tuple:
+    """Check the fragment sizes along each dimension.  Returns (holes,
+    overlaps, messages), with holes and overlaps as boolean arrays over the
+    fragment grid."""
+    holes = numpy.zeros(frag_def, dtype=bool)
+    overlaps = numpy.zeros(frag_def, dtype=bool)
+    messages = []
+    for d, (size, s) in enumerate(zip(shape, sizes)):
+        # select the fragments at positions p along dimension d
+        def along(p):
+            key = [slice(None)] * len(frag_def)
+            key[d] = p
+            return tuple(key)
+        missing = numpy.ma.getmaskarray(s)
+        s = numpy.ma.filled(s, 0).astype(numpy.int64)
+        bad = missing | (s <= 0)
+        if bad.any():
+            messages.append(f"Dimension {d} has fragments without a "
+                            "positive size")
+            holes[along(bad)] = True
+        ends = numpy.cumsum(s)
+        total = int(ends[-1]) if len(ends) > 0 else 0
+        if total > size:
+            messages.append(f"Fragment sizes along dimension {d} sum to "
+                            f"{total}, more than its size ({size})")
+            overlaps[along(ends > size)] = True
+        elif total < size:
+            messages.append(f"Fragment sizes along dimension {d} sum to "
+                            f"{total}, less than its size ({size})")
+            if len(s) > 0:
+                holes[along(len(s) - 1)] = True
+    return holes, overlaps, messages
+
+def check_coverage(var: object, allow_absent: bool=False) -> CFACoverageReport:
+    """Check that the fragments of the CFAVariable var tile its aggregated
+    data exactly.  Unless allow_absent is True, fragments without a value
+    (see CFAVariable.getPresentFragments) are holes."""
+    frag_def = var.getFragmentDefinition()
+    shape = var.shape
+    if len(frag_def) != len(shape):
+        raise CFAException(-502)
+    holes, overlaps, messages = _check_sizes(shape, var._fragmentSizes(),
+                                             frag_def)
+    if not allow_absent:
+        holes |= ~var.getPresentFragments()
+    writes = var._fragment_writes
+    if len(writes) > 0:
+        # the fragments set from more than one distinct data location
+        pairs = numpy.unique(numpy.asarray(writes, dtype=numpy.int64), axis=0)
+        flat, counts = numpy.unique(pairs[:, 0], return_counts=True)
+        overlaps.reshape(-1)[flat[counts > 1]] = True
+    return CFACoverageReport(var.name, frag_def,
+                             numpy.flatnonzero(holes),
+                             numpy.flatnonzero(overlaps), messages)
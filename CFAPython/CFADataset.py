@@ -1,14 +1,21 @@
+from __future__ import annotations
 
 import CFAPython
 from CFAPython.CFAGroup import CFAGroup
 from CFAPython.CFAVariable import CFAVariable
 from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFileResolver import CFAFileResolver
 from CFAPython import CFAFileFormat
 from CFAPython.version import MAJOR_VERSION, MINOR_VERSION, REVISION
 
 from netCDF4 import Dataset 
 
 from ctypes import *
+from typing import Callable
+import os
+import os.path
+import threading
+import warnings
 
 class _CFADataset(CFAGroup):
         
@@ -17,6 +24,8 @@ class _CFADataset(CFAGroup):
                  nc_object: object=None):
         
         super().__init__(0, nc_object)
+        # whether the fragment coverage is checked when serialising
+        self._check_coverage = False
         self.__mode = mode
         self.__format = format
         self.__filename = filename
@@ -51,7 +60,7 @@ class _CFADataset(CFAGroup):
         """Serialise if self.mode == "w" and then close the CFA-netCDF file"""
         if self.__mode == 'w':
             # serialise the root group (i.e. this group)
-            self.serialise()
+            self.serialise(check_coverage=self._check_coverage)
             # write the global metadata
             self._nc_object.Conventions = f"CFA-{MAJOR_VERSION}.{MINOR_VERSION}.{REVISION}"
         
@@ -67,7 +76,7 @@ class _CFADataset(CFAGroup):
     @property
     def path(self) -> str:
         """Return the path of the Dataset"""
-        return self._container.path.decode('utf-8')
+        return self._container.path
 
     @property
     def format(self) -> CFAPython.CFAFileFormat:
@@ -75,6 +84,58 @@ class _CFADataset(CFAGroup):
         return CFAPython.CFAFileFormat(self._container.format)
     
 
+def _check_parse(filename: str) -> None:
+    """Check that a CFA-netCDF file can be loaded and parsed, without changing
+    any open dataset"""
+    nc_object = Dataset(filename, mode='r')
+    cfa = None
+    try:
+        cfa = _CFADataset(filename=filename, mode='r', nc_object=nc_object)
+        cfa.parse()
+    finally:
+        if cfa is not None:
+            cfa.close()
+        nc_object.close()
+
+class _CFAPoller(threading.Thread):
+    def __init__(self, ds: object, interval: float, callback: Callable=None,
+                 error_callback: Callable=None):
+        """Refresh a CFADataset every interval seconds, in a daemon thread,
+        calling callback(ds) after each refresh that found a change, and
+        error_callback(ds, exception) if a refresh (or callback) fails"""
+        super().__init__(daemon=True, name="CFADataset.refresh")
+        self._ds = ds
+        self._interval = interval
+        self._callback = callback
+        self._error_callback = error_callback
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                # the file may be part way through being written, in which
+                # case the dataset is left as it was and the refresh is
+                # tried again at the next poll
+                if self._ds.refresh() and self._callback is not None:
+                    self._callback(self._ds)
+            except Exception as e:
+                # keep polling, whatever the error
+                try:
+                    if self._error_callback is not None:
+                        self._error_callback(self._ds, e)
+                    else:
+                        warnings.warn(f"Refreshing dataset failed: {e}")
+                except Exception:
+                    pass
+                if self._ds.closed:
+                    # a refresh that could not reopen the file closed it
+                    break
+
+    def stop(self):
+        self._stopped.set()
+        if self is not threading.current_thread():
+            self.join()
+
 class CFADataset(Dataset):
     """This is a wrapper class for the actual _CFADataset class.
     It inherits the netCDF4-python Dataset class and adds a .CFA member object which
@@ -82,13 +143,20 @@ class CFADataset(Dataset):
 
     # declare private atts, otherwise they will be written out into the netCDF file
     # as global variables
-    _private_atts = ["CFA", "closed"]
+    _private_atts = ["CFA", "closed", "_resolver", "_open_args", 
+                     "_file_state", "_poller", "_access"]
 
     def __init__(self, filename, mode='r', clobber=True, format='NETCDF4',
                  diskless=False, persist=False, keepweakref=False,
-                 memory=None, encoding=None, parallel=False, **kwargs):
+                 memory=None, encoding=None, parallel=False, 
+                 definition_options=None, check_coverage=False, **kwargs):
         """Create a CFA object within a netCDF4 Dataset and either read it in from
         a CFA-netCDF file, or create the file to write to.
+        definition_options is a dictionary of the write-time options for the
+        aggregation definition variables, see CFAGroup.setDefinitionOptions.
+        If check_coverage is True then, in write mode, the fragments of every
+        variable are checked to tile its aggregated data exactly when the 
+        dataset is serialised, see CFAVariable.checkCoverage.
         (Comm and Info from netCDF4-python not supported as arguments currently)
         """
         # CFANetCDF files must be created as NETCDF4 files
@@ -101,6 +169,23 @@ class CFADataset(Dataset):
                          format=in_format, diskless=diskless, persist=persist, 
                          keepweakref=keepweakref, memory=memory, encoding=encoding, 
                          parallel=parallel, kwargs=kwargs)
+        # how to reopen the file, and its state when it was opened, to
+        # refresh a dataset read from a file
+        self._poller = None
+        self._open_args = None
+        self._file_state = None
+        if (mode == 'r' and memory is None and not diskless and 
+                format == CFAFileFormat.CFANetCDF):
+            self._open_args = dict(filename=filename, mode='r', 
+                                   format=in_format, keepweakref=keepweakref,
+                                   encoding=encoding, parallel=parallel)
+            self._file_state = self._fileState()
+        # held by readers, and exclusively while refreshing
+        self._access = CFAPython.CFAAccessLock()
+        # resolves the file names of fragments, relative to this file
+        self._resolver = CFAFileResolver(
+            os.path.dirname(os.path.abspath(filename))
+        )
         # only parse or serialise if the file is a CFA file
         if format == CFAFileFormat.CFANetCDF:
             self.CFA = _CFADataset(
@@ -109,16 +194,167 @@ class CFADataset(Dataset):
         else:
             self.CFA = None
 
+        if self.CFA and mode == 'w' and definition_options is not None:
+            self.CFA.setDefinitionOptions(**definition_options)
+        if self.CFA and mode == 'w':
+            self.CFA._check_coverage = check_coverage
+
         # parse - this will assign the netCDF variables and dimensions
         # to the CFA instances 
         if self.CFA and mode == 'r':
             self.CFA.parse()
         self.closed = False
 
-    def close(self):
+    @classmethod
+    def fromBuffer(cls, buffer: object, filename: str="memory.nc", 
+                   **kwargs) -> CFADataset:
+        """Parse a CFA-netCDF file from a memory buffer (bytes, bytearray or 
+        memoryview) without touching the disk.  filename is only used to 
+        label the dataset."""
+        return cls(filename, mode='r', memory=buffer, **kwargs)
+
+    @classmethod
+    def inMemory(cls, filename: str="memory.nc", size: int=1024,
+                 **kwargs) -> CFADataset:
+        """Create a CFA-netCDF file in memory, without touching the disk.  size
+        is the initial size (in bytes) of the memory buffer, which grows as 
+        required.  close() serialises the dataset and returns the file as a
+        memoryview."""
+        return cls(filename, mode='w', memory=size, **kwargs)
+
+    def close(self) -> memoryview:
+        """Serialise (in write mode) and close the dataset.  For datasets 
+        created in memory (see inMemory) the file is returned as a memoryview,
+        otherwise None is returned.
+        Any buffered assignments to aggregated data are written first."""
+        self.setAutoRefresh(None)
+        if self.closed:
+            # closed by a refresh that could not reopen the file
+            return None
+        for grp, var in self.CFA.walkVariables():
+            var.flush()
         self.CFA.close()
-        super().close()
+        memory = super().close()
         self.closed = True
+        return memory
+
+    @property
+    def file_resolver(self) -> CFAFileResolver:
+        """Return the CFAFileResolver that resolves the file names of the
+        fragments of every variable in this dataset"""
+        return self._resolver
+
+    def setFileSubstitutions(self, substitutions: dict, 
+                             replace: bool=False) -> None:
+        """Set the value of ${name} substitutions in fragment file names, 
+        keyed by name, e.g. {"BASE": "/data/archive"}.  This is a metadata 
+        only operation: resolved file names are recomputed on the next read."""
+        self._resolver.setSubstitutions(substitutions, replace)
+
+    def setFileBaseDirectory(self, base_dir: str) -> None:
+        """Set the directory that relative fragment file names are resolved
+        against (by default, the directory of this file)"""
+        self._resolver.base_dir = base_dir
+
+    def _fileState(self) -> tuple[int, int]:
+        """Get the modification time and size of the file"""
+        st = os.stat(self._open_args["filename"])
+        return st.st_mtime_ns, st.st_size
+
+    def refresh(self) -> bool:
+        """Reload the dataset if the CFA-netCDF file has changed since it was
+        opened (or last refreshed), e.g. because another process has appended
+        fragments.  This is equivalent to reopening the file, and costs about
+        as much: an open netCDF-4 file does not see changes made by another
+        process, and the CFA-C library parses the whole definition.
+        The file is first parsed with a separate handle and, if that fails
+        (e.g. the file is part way through being written), a CFAException is
+        raised and the dataset is left as it was.  Otherwise the dataset is
+        reopened from the file, once no other thread is reading it.  If the
+        file changes again, so that the reopen fails, then the dataset is
+        closed and a CFAException is raised.
+        The existing CFAGroup and CFAVariable objects are kept, with the
+        caches that do not depend on the fragment table: the unit conversions
+        and axes of fragment variables, and the coordinate indexes of 
+        dimensions whose size has not changed.  The fragment table and index
+        are read again when next used.
+        Returns whether the file had changed.  Only datasets read from a file
+        can be refreshed."""
+        if self._open_args is None:
+            raise CFAException("Only datasets read from a file can be "
+                               "refreshed")
+        if self.closed:
+            raise CFAException("A closed dataset cannot be refreshed")
+        state = self._fileState()
+        if state == self._file_state:
+            return False
+        filename = self._open_args["filename"]
+        _check_parse(filename)
+        if self._fileState() != state:
+            raise CFAException(f"{filename} changed while it was checked")
+
+        # the file can be parsed, so reopen this dataset, once no other
+        # thread is reading it
+        with self._access.exclusive(), CFAPython.cfa_lock, CFAPython.nc_lock:
+            self.CFA.close()
+            Dataset.close(self)
+            try:
+                Dataset.__init__(self, **self._open_args)
+            except Exception as e:
+                self.closed = True
+                raise CFAException(f"{filename} could not be reopened, and "
+                                   f"the dataset has been closed: {e}")
+            cfa = None
+            try:
+                cfa = _CFADataset(filename=filename, mode='r', nc_object=self)
+                cfa.parse()
+            except Exception as e:
+                if cfa is not None:
+                    cfa.close()
+                Dataset.close(self)
+                self.closed = True
+                raise CFAException(f"{filename} could not be parsed, and the "
+                                   f"dataset has been closed: {e}")
+            self.CFA._refreshFrom(cfa)
+        self._file_state = state
+        return True
+
+    def setAutoRefresh(self, interval: float=None, callback: Callable=None,
+                       error_callback: Callable=None) -> None:
+        """Refresh the dataset (see refresh) every interval seconds, in a 
+        background thread, calling callback(dataset) whenever it has changed.
+        If a refresh, or the callback, raises an exception then 
+        error_callback(dataset, exception) is called (by default, a warning
+        is issued) and polling continues.
+        If interval is None then automatic refreshing is stopped."""
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+        if interval is not None:
+            if self._open_args is None:
+                raise CFAException("Only datasets read from a file can be "
+                                   "refreshed")
+            self._poller = _CFAPoller(self, interval, callback, 
+                                      error_callback)
+            self._poller.start()
+
+    def validate(self, workers: int=None, threads: bool=False) -> object:
+        """Check every fragment of every aggregation variable: that the 
+        fragment file exists, the variable exists at the address, its shape
+        matches the location and its dtype and units are compatible.  The
+        fragment files are checked in parallel by workers processes (or 
+        threads, if threads is True).  Returns a CFAValidationReport."""
+        from CFAPython.CFAValidate import validate
+        return validate(self, workers, threads)
+
+    def exportReferences(self, path: str, format: str=None,
+                         workers: int=None) -> dict:
+        """Export the aggregation variables as a kerchunk reference set (JSON,
+        or a Parquet directory), so the aggregated data can be read as a Zarr
+        store.  The fragment files are scanned in parallel by workers 
+        processes.  See CFAPython.CFAReferences."""
+        from CFAPython.CFAReferences import export_references
+        return export_references(self, path, format, workers)
 
     def __del__(self):
         if not self.closed:
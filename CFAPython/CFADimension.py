@@ -2,10 +2,11 @@
 from __future__ import annotations
 
 import CFAPython
-from CFAPython._CFADatatypes import C_AggregatedDimension
+from CFAPython._CFADatatypes import (C_AggregatedDimension,
+                                     AggregatedDimensionInfo)
 from CFAPython.CFAExceptions import CFAException
 
-from ctypes import c_int, pointer
+from ctypes import c_int, byref, POINTER
 
 class CFADimension:
     def __init__(self, parent_id: int = -1, id: int = -1, nc_object: object=None):
@@ -13,6 +14,8 @@ class CFADimension:
         self.__parent_id = parent_id
         self.__cfa_id = id
         self._nc_object = nc_object
+        self.__name = None
+        self.__info = None
 
     def __str__(self):
         return (f"{self.name}: {self.__class__}: name={self.name}, size={self.size}, "
@@ -22,33 +25,55 @@ class CFADimension:
         return self.__str__()
 
     @property
-    def _dimension(self) -> object:
+    def _c_dimension(self) -> object:
         """Get the underlying CFA-C AggregatedDimension for this CFADimension.
+        This is a view onto the structure owned by the CFA-C library.
         Hidden (private) as we want users to access the property functions
         instead of querying the C_AggregatedDimension structure directly."""
-        cfa_dim = C_AggregatedDimension()
-        cfa_dim_p = pointer(cfa_dim)
+        cfa_dim_p = POINTER(C_AggregatedDimension)()
         cfa_err = CFAPython.lib().cfa_get_dim(
-            self.__parent_id, self.__cfa_id, pointer(cfa_dim_p)
+            self.__parent_id, self.__cfa_id, byref(cfa_dim_p)
         )
         if (cfa_err != 0):
             raise CFAException(cfa_err)
         return cfa_dim_p.contents
 
+    @property
+    def _dimension(self) -> object:
+        """Get a snapshot of the CFA-C AggregatedDimension for this 
+        CFADimension, as an AggregatedDimensionInfo."""
+        if self.__info is not None:
+            return self.__info
+        return AggregatedDimensionInfo(self._c_dimension)
+
+    def _freeze(self) -> None:
+        """Cache the metadata of the dimension.  This is only called in read
+        mode, where the metadata cannot change, so that reading the metadata
+        does not have to call (and lock) the CFA-C library."""
+        self.__info = AggregatedDimensionInfo(self._c_dimension)
+        self.__name = self.__info.name
+
     @property
     def name(self) -> str:
         """Return the name of the dimension"""
-        return self._dimension.name.decode('utf-8')
+        # the name cannot change once the dimension is defined, so cache it
+        if self.__name is None:
+            self.__name = self._c_dimension.name.decode('utf-8')
+        return self.__name
 
     @property
     def size(self) -> int:
         """Return the length of the dimension"""
-        return self._dimension.length
+        if self.__info is not None:
+            return self.__info.length
+        return self._c_dimension.length
 
     @property
     def type(self) -> int:
         """Return the datatype of the dimension"""
-        return CFAPython.CFAType(self._dimension.cfa_dtype.type)
+        if self.__info is not None:
+            return CFAPython.CFAType(self.__info.type)
+        return CFAPython.CFAType(self._c_dimension.cfa_dtype.type)
     
     @property
     def nc(self) -> object:
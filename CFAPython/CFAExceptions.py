@@ -1,3 +1,7 @@
+# the error code returned by the CFA-C library when a fragment has no value for
+# a term
+FRAGMENT_DATUM_NOT_FOUND = -537
+
 class CFAException(Exception):
     """Generic CFA Exception.  Outputs sensible error message."""
     def __init__(self, code: int, *args):
@@ -5,6 +9,10 @@ class CFAException(Exception):
         self.code = code
 
     def __str__(self):
+        # some errors are raised with a message rather than a code
+        if isinstance(self.code, str):
+            return f"CFA error : {self.code}"
+
         # trap any netCDF error first
         if self.code > -500:
             return f"NetCDF error : ({self.code})"
@@ -0,0 +1,119 @@
+from __future__ import annotations
+import os.path
+import re
+import sys
+import threading
+
+import numpy
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAStorage import uri_scheme
+
+# a ${name} substitution in a fragment file name
+_SUBSTITUTION = re.compile(r"\$\{(\w+)\}")
+# the substitutions attribute of a file variable: "${name}: value ..."
+_SUBSTITUTIONS_ATTRIBUTE = re.compile(r"\$\{(\w+)\}:\s*(\S+)")
+
+def parse_substitutions(attribute: str) -> tuple[tuple[str, str]]:
+    """Parse the substitutions attribute of a file definition variable, e.g.
+    "${base}: /data/archive/ ${site}: https://host/", into a tuple of
+    (name, value) pairs"""
+    if attribute is None:
+        return ()
+    return tuple(_SUBSTITUTIONS_ATTRIBUTE.findall(attribute))
+
+class CFAFileResolver:
+    def __init__(self, base_dir: str=None, substitutions: dict=None):
+        """Resolve the file term of fragments to absolute paths (or URIs).
+        ${name} substitutions in the file names are replaced, then relative
+        paths are resolved against base_dir (by default, the current
+        directory).  Each distinct file name is resolved once, and the result
+        is interned and cached, so that resolving the file of every fragment
+        does not repeat any string operations.  Changing the substitutions or
+        base directory only clears the cache."""
+        self._base_dir = base_dir or os.getcwd()
+        self._substitutions = dict(substitutions or {})
+        self._cache = {}
+        self._lock = threading.Lock()
+        # incremented whenever the resolution changes, so that resolved
+        # columns cached elsewhere can be invalidated
+        self.generation = 0
+
+    def __str__(self):
+        return (f"{self.__class__}: base_dir={self._base_dir}, "
+                f"substitutions={self._substitutions}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def base_dir(self) -> str:
+        """Return the directory that relative file names are resolved
+        against"""
+        return self._base_dir
+
+    @base_dir.setter
+    def base_dir(self, base_dir: str) -> None:
+        with self._lock:
+            self._base_dir = base_dir
+            self._cache = {}
+            self.generation += 1
+
+    @property
+    def substitutions(self) -> dict:
+        """Return the substitutions, keyed by name"""
+        return dict(self._substitutions)
+
+    def setSubstitutions(self, substitutions: dict,
+                         replace: bool=False) -> None:
+        """Set the value of ${name} substitutions, keyed by name, in addition
+        to (or, if replace is True, instead of) the existing substitutions.
+        These take precedence over the substitutions attribute of the file
+        definition variable."""
+        with self._lock:
+            if replace:
+                self._substitutions = {}
+            self._substitutions.update(substitutions)
+            self._cache = {}
+            self.generation += 1
+
+    def resolve(self, file: str, defaults: tuple=()) -> str:
+        """Resolve a fragment file name, with the default substitutions as
+        (name, value) pairs, e.g. from the file variable's substitutions
+        attribute"""
+        key = (file, defaults)
+        path = self._cache.get(key, None)
+        if path is not None:
+            return path
+        path = file
+        if "${" in path:
+            subs = dict(defaults)
+            subs.update(self._substitutions)
+            def substitute(match):
+                if match.group(1) not in subs:
+                    raise CFAException(
+                        f"No substitution for ${{{match.group(1)}}} in {file}"
+                    )
+                return subs[match.group(1)]
+            path = _SUBSTITUTION.sub(substitute, path)
+        if uri_scheme(path) == "" and not os.path.isabs(path):
+            path = os.path.normpath(os.path.join(self._base_dir, path))
+        path = sys.intern(path)
+        with self._lock:
+            self._cache[key] = path
+        return path
+
+    def resolveColumn(self, files: numpy.ndarray,
+                      defaults: tuple=()) -> numpy.ndarray:
+        """Resolve the file of every fragment, resolving each distinct name
+        once.  Fragments without a file (None) are left as None."""
+        if numpy.ma.isMaskedArray(files):
+            mask = numpy.ma.getmaskarray(files)
+            files = numpy.array(files.data, dtype=object)
+            files[mask] = None
+        resolved = {f: self.resolve(f, defaults)
+                    for f in set(files.flat) if f is not None}
+        resolved[None] = None
+        column = numpy.empty(files.shape, dtype=object)
+        column.flat[:] = [resolved[f] for f in files.flat]
+        return column
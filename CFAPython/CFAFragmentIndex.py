@@ -0,0 +1,247 @@
+from __future__ import annotations
+from typing import Iterator
+import itertools
+
+import numpy
+
+from CFAPython.CFAExceptions import CFAException
+
+def normalise_key(key: object, shape: list[int]) -> tuple[list[slice], list[int]]:
+    """Convert an index into an array of shape (integers, slices and an
+    Ellipsis, as used with __getitem__) into a list of slices, one per 
+    dimension, with non-negative start and stop and a positive step.
+    Also returns the list of the axes indexed by integers, which are to be
+    removed from the result."""
+    if not isinstance(key, tuple):
+        key = (key,)
+    # expand any Ellipsis
+    n_ellipsis = sum(1 for k in key if k is Ellipsis)
+    if n_ellipsis > 1:
+        raise IndexError("an index can only have a single ellipsis ('...')")
+    if n_ellipsis == 1:
+        e = key.index(Ellipsis)
+        fill = (slice(None),) * (len(shape) - len(key) + 1)
+        key = key[:e] + fill + key[e+1:]
+    if len(key) > len(shape):
+        raise IndexError("too many indices for aggregated data")
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    slices = []
+    squeeze = []
+    for d, k in enumerate(key):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(shape[d])
+            if step < 0:
+                raise IndexError("negative steps are not supported")
+            stop = max(start, stop)
+            slices.append(slice(start, stop, step))
+        elif isinstance(k, (int, numpy.integer)):
+            i = int(k)
+            if i < 0:
+                i += shape[d]
+            if i < 0 or i >= shape[d]:
+                raise IndexError(
+                    f"index {k} is out of bounds for axis {d} with size "
+                    f"{shape[d]}"
+                )
+            slices.append(slice(i, i+1, 1))
+            squeeze.append(d)
+        else:
+            raise IndexError(f"unsupported index: {k}")
+    return slices, squeeze
+
+def fragment_axes(span: list[int], frag_shape: list[int]) -> list[int]:
+    """Map the axes of a fragment variable onto the dimensions of the
+    aggregated data, given the span of the fragment along each dimension.
+    Fragment variables may omit dimensions of size 1.  Returns the dimension
+    of the aggregated data for each axis of the fragment variable."""
+    if len(frag_shape) == len(span):
+        return list(range(0, len(span)))
+    axes = []
+    d = 0
+    for n in frag_shape:
+        # skip the omitted, size 1, dimensions
+        while d < len(span) and span[d] != n and span[d] == 1:
+            d += 1
+        if d == len(span) or span[d] != n:
+            raise CFAException(f"Fragment shape {tuple(frag_shape)} does not "
+                               f"match location span {tuple(span)}")
+        axes.append(d)
+        d += 1
+    if any(s != 1 for s in span[d:]):
+        raise CFAException(f"Fragment shape {tuple(frag_shape)} does not "
+                           f"match location span {tuple(span)}")
+    return axes
+
+class CFAFragmentIndex:
+    def __init__(self, shape: list[int], sizes: list[object]):
+        """Create the index of the fragments of an AggregationVariable, from
+        the shape of the aggregated data and the size of each fragment along
+        each of the aggregated dimensions (i.e. the contents of the location
+        aggregation definition variable)."""
+        if len(shape) != len(sizes):
+            raise CFAException(
+                "Fragment sizes do not match the aggregated dimensions"
+            )
+        self._shape = [int(s) for s in shape]
+        self._sizes = [numpy.asarray(s, dtype=numpy.int64) for s in sizes]
+        # the boundaries of the fragments along each dimension
+        self._bounds = [numpy.concatenate(([0], numpy.cumsum(s)))
+                        for s in self._sizes]
+        for d in range(0, len(self._shape)):
+            if self._bounds[d][-1] != self._shape[d]:
+                raise CFAException(
+                    f"Fragment sizes along dimension {d} do not sum to the "
+                    f"size of the dimension ({self._shape[d]})"
+                )
+        # the fragments along each dimension are regular if the first k are
+        # all of size a and the rest are all of size b, stored as (a, k, b),
+        # so that their boundaries can be computed arithmetically.  This
+        # covers equal fragments with a smaller last fragment, and dimensions
+        # divided as evenly as possible (see regular)
+        self._span = [self._regularSpan(s) for s in self._sizes]
+
+    @staticmethod
+    def _regularSpan(s: numpy.ndarray) -> tuple[int, int, int]:
+        """Get (a, k, b) if the first k fragment sizes are a and the rest are
+        b, or None"""
+        if len(s) == 0:
+            return None
+        a = int(s[0])
+        k = int(numpy.argmax(s != a)) if numpy.any(s != a) else len(s)
+        if k < len(s) and numpy.any(s[k:] != s[k]):
+            return None
+        b = int(s[k]) if k < len(s) else a
+        return (a, k, b)
+
+    @classmethod
+    def regular(cls, shape: list[int], frag_def: list[int]) -> CFAFragmentIndex:
+        """Create the index for a regular fragmentation, where each dimension
+        is divided into frag_def[d] fragments as evenly as possible: as with
+        numpy.array_split, the first size % n fragments are one larger than
+        the rest."""
+        if len(shape) != len(frag_def):
+            raise CFAException(
+                "Fragment definition does not match the aggregated dimensions"
+            )
+        sizes = []
+        for size, n in zip(shape, frag_def):
+            if n <= 0 or n > size:
+                raise CFAException(
+                    f"Dimension of size {size} cannot be divided into {n} "
+                    "fragments"
+                )
+            span, r = divmod(size, n)
+            sizes.append([span + 1] * r + [span] * (n - r))
+        return cls(shape, sizes)
+
+    def __str__(self):
+        return (f"{self.__class__}: shape={self.shape}, "
+                f"fragments={self.frag_def}, regular={self.is_regular}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def shape(self) -> list[int]:
+        """Return the shape of the aggregated data"""
+        return self._shape
+
+    @property
+    def frag_def(self) -> list[int]:
+        """Return the number of fragments along each dimension"""
+        return [len(s) for s in self._sizes]
+
+    @property
+    def nfragments(self) -> int:
+        """Return the total number of fragments"""
+        return int(numpy.prod(self.frag_def))
+
+    @property
+    def sizes(self) -> list[numpy.ndarray]:
+        """Return the size of each fragment along each dimension"""
+        return self._sizes
+
+    @property
+    def bounds(self) -> list[numpy.ndarray]:
+        """Return the boundaries of the fragments along each dimension.  For
+        each dimension this is an array of length nfragments+1 where fragment
+        i spans bounds[i] to bounds[i+1]."""
+        return self._bounds
+
+    @property
+    def is_regular(self) -> bool:
+        """Return whether the fragment boundaries along every dimension can be
+        computed arithmetically."""
+        return all(span is not None for span in self._span)
+
+    def _locate(self, d: int, x: int) -> int:
+        """Get the index of the fragment along dimension d that contains x"""
+        if x < 0 or x >= self._shape[d]:
+            raise CFAException(-502)
+        if self._span[d] is not None:
+            a, k, b = self._span[d]
+            if x < a * k:
+                return x // a
+            return k + (x - a * k) // b
+        return int(numpy.searchsorted(self._bounds[d], x, side='right')) - 1
+
+    def getFragmentLocation(self, data_loc: list[int]) -> list[int]:
+        """Get the fragment location (the index of the fragment along each
+        dimension) of the fragment containing data_loc.  For regularly
+        fragmented dimensions this is O(1)."""
+        if len(data_loc) != len(self._shape):
+            raise CFAException(-502)
+        return [self._locate(d, data_loc[d]) for d in range(0, len(self._shape))]
+
+    def getExtent(self, frag_loc: list[int]) -> list[tuple[int, int]]:
+        """Get the (start, stop) of the fragment at frag_loc along each
+        dimension of the aggregated data."""
+        if len(frag_loc) != len(self._shape):
+            raise CFAException(-502)
+        extent = []
+        for d in range(0, len(self._shape)):
+            f = frag_loc[d]
+            if f < 0 or f >= len(self._sizes[d]):
+                raise CFAException(-535)
+            if self._span[d] is not None:
+                a, k, b = self._span[d]
+                start = f * a if f < k else a * k + (f - k) * b
+                extent.append((start, start + int(self._sizes[d][f])))
+            else:
+                extent.append((int(self._bounds[d][f]),
+                               int(self._bounds[d][f+1])))
+        return extent
+
+    def intersect(self, slices: list[slice]) -> Iterator[tuple]:
+        """Iterate over the fragments that intersect a selection of the 
+        aggregated data, given as a list of slices (as returned by 
+        normalise_key).  For each fragment yields a tuple of:
+            (fragment location,
+             tuple of slices into the fragment,
+             tuple of slices into the selection)"""
+        per_dim = []
+        for d, s in enumerate(slices):
+            items = []
+            if s.start < s.stop:
+                bounds = self._bounds[d]
+                f0 = self._locate(d, s.start)
+                f1 = self._locate(d, s.stop - 1)
+                for f in range(f0, f1+1):
+                    lo = int(bounds[f])
+                    hi = min(int(bounds[f+1]), s.stop)
+                    # the first selected element in this fragment
+                    first = s.start + max(0, -(-(lo - s.start) // s.step)) * s.step
+                    if first >= hi:
+                        continue
+                    n = len(range(first, hi, s.step))
+                    out_start = (first - s.start) // s.step
+                    items.append((f, 
+                                  slice(first - lo, hi - lo, s.step),
+                                  slice(out_start, out_start + n)))
+            per_dim.append(items)
+
+        for combo in itertools.product(*per_dim):
+            yield ([c[0] for c in combo], 
+                   tuple(c[1] for c in combo), 
+                   tuple(c[2] for c in combo))
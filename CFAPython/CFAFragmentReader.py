@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import os.path
+import numpy
+from netCDF4 import default_fillvals
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import normalise_key, fragment_axes
+from CFAPython.CFAStorage import get_backend
+from CFAPython.CFAFileResolver import CFAFileResolver, parse_substitutions
+from CFAPython.CFAUnits import unit_conversion
+
+def _missing(column: numpy.ndarray) -> numpy.ndarray:
+    """Get whether each value of a fragment column is missing (masked, or
+    None for strings)"""
+    if numpy.ma.isMaskedArray(column):
+        return numpy.ma.getmaskarray(column).copy()
+    return numpy.equal(column, None)
+
+class CFAFragmentReader:
+    def __init__(self, var: object, convert_units: bool=True):
+        """Create a reader for the aggregated data of a CFAVariable, which
+        reads the intersecting part of each fragment into the output array.
+        If convert_units is True then fragments stored in different, but
+        equivalent, units to the variable are converted to its units."""
+        self._var = var
+        self.convert_units = convert_units
+        # the (scale, offset) unit conversion of each fragment, or None
+        self._conversions = {}
+        # the axes of each fragment that omits size 1 dimensions, or None
+        self._axes = {}
+        self.__resolver = None
+        self.__defaults = None
+        self.__files = None
+        # (address column, absent fragments), see _absentFragments
+        self.__absent = None
+
+    @property
+    def _resolver(self) -> CFAFileResolver:
+        """Get the CFAFileResolver of the dataset that the variable belongs to
+        or, if there is none, one that resolves against the directory of the
+        aggregation file"""
+        if self.__resolver is None:
+            with CFAPython.nc_lock:
+                grp = self._var.nc.group()
+                while grp.parent is not None:
+                    grp = grp.parent
+                resolver = getattr(grp, "__dict__", {}).get("_resolver", None)
+                if resolver is None:
+                    path = os.path.abspath(grp.filepath())
+                    resolver = CFAFileResolver(os.path.dirname(path))
+            self.__resolver = resolver
+        return self.__resolver
+
+    @property
+    def _defaults(self) -> tuple:
+        """Get the default substitutions, from the substitutions attribute of
+        the file definition variable"""
+        if self.__defaults is None:
+            defaults = ()
+            get_term = getattr(self._var, "_getTermVariable", None)
+            term_var = get_term("file") if get_term is not None else None
+            if term_var is not None:
+                with CFAPython.nc_lock:
+                    defaults = parse_substitutions(
+                        getattr(term_var, "substitutions", None)
+                    )
+            self.__defaults = defaults
+        return self.__defaults
+
+    def _fragmentFile(self, file: str) -> str:
+        """Resolve the file term of a fragment to a path, or a URI"""
+        return self._resolver.resolve(file, self._defaults)
+
+    def _fragmentFiles(self) -> numpy.ndarray:
+        """Get the resolved file of every fragment (None for fragments in the
+        aggregation file), resolved once and cached until the resolver
+        changes"""
+        resolver = self._resolver
+        if self.__files is None or self.__files[0] != resolver.generation:
+            files = resolver.resolveColumn(self._var.getFragmentColumn("file"),
+                                           self._defaults)
+            self.__files = (resolver.generation, files)
+        return self.__files[1]
+
+    def _absentFragments(self) -> numpy.ndarray:
+        """Get whether each fragment is absent (e.g. a missing tile of a
+        sparse aggregation), from the fragment table alone: it has no address,
+        or it has no file and its address is not a variable in the
+        aggregation file.  Cached until the address column changes."""
+        var = self._var
+        addresses = var.getFragmentColumn("address")
+        if self.__absent is not None and self.__absent[0] is addresses:
+            return self.__absent[1]
+        absent = _missing(addresses)
+        no_file = _missing(var.getFragmentColumn("file")) & ~absent
+        if no_file.any():
+            # check each distinct address once
+            internal = addresses[no_file]
+            missing = {a for a in set(internal.flat)
+                       if var._findNetCDFVariable(a) is None}
+            if len(missing) > 0:
+                absent[no_file] = [a in missing for a in internal.flat]
+        self.__absent = (addresses, absent)
+        return absent
+
+    @property
+    def _fillValue(self) -> object:
+        """Get the fill value of the aggregation variable"""
+        dtype = numpy.dtype(self._var.dtype)
+        with CFAPython.nc_lock:
+            fill_value = getattr(self._var.nc, "_FillValue", None)
+        if fill_value is None:
+            fill_value = default_fillvals.get(dtype.str[1:], None)
+        return fill_value
+
+    def _readFragment(self, uri: str, address: str,
+                      frag_slices: tuple[slice]) -> numpy.ndarray:
+        """Read the selection frag_slices from the fragment variable address,
+        in the (resolved) fragment file uri, using the storage backend for its
+        URI scheme.  If uri is None then the fragment is a variable in the
+        aggregation file."""
+        if uri is None:
+            nc_var = self._var._findNetCDFVariable(address)
+            if nc_var is None:
+                raise CFAException(
+                    f"Fragment variable {address} not found in the "
+                    "aggregation file"
+                )
+            with CFAPython.nc_lock:
+                return nc_var[frag_slices]
+        return get_backend(uri).read(uri, address, frag_slices)
+
+    @property
+    def _units(self) -> str:
+        """Get the units of the aggregation variable"""
+        with CFAPython.nc_lock:
+            return getattr(self._var.nc, "units", None)
+
+    def _fragmentUnits(self, uri: str, address: str) -> str:
+        """Get the units of a fragment"""
+        if uri is None:
+            nc_var = self._var._findNetCDFVariable(address)
+            with CFAPython.nc_lock:
+                return getattr(nc_var, "units", None)
+        return get_backend(uri).attribute(uri, address, "units")
+
+    def _conversion(self, uri: str, address: str) -> tuple[float, float]:
+        """Get the (scale, offset) that converts the data of a fragment to the
+        units of the aggregation variable, or None, computed once per
+        fragment"""
+        key = (uri, address)
+        if key not in self._conversions:
+            try:
+                conversion = unit_conversion(
+                    self._fragmentUnits(uri, address), self._units
+                )
+            except ValueError as e:
+                raise CFAException(f"Fragment {uri}:{address}: {e}")
+            self._conversions[key] = conversion
+        return self._conversions[key]
+
+    def _fragmentAxes(self, uri: str, address: str,
+                      span: tuple[int]) -> list[int]:
+        """Get the dimensions of the aggregated data that the axes of a
+        fragment variable correspond to, if it omits size 1 dimensions, or
+        None if it does not, computed once per fragment"""
+        key = (uri, address, span)
+        if key not in self._axes:
+            if uri is None:
+                nc_var = self._var._findNetCDFVariable(address)
+                if nc_var is None:
+                    raise CFAException(
+                        f"Fragment variable {address} not found in the "
+                        "aggregation file"
+                    )
+                with CFAPython.nc_lock:
+                    shape = nc_var.shape
+            else:
+                shape = get_backend(uri).shape(uri, address)
+            axes = None
+            if len(shape) != len(span):
+                axes = fragment_axes(span, shape)
+            self._axes[key] = axes
+        return self._axes[key]
+
+    def _plan(self, key: object) -> tuple:
+        """Plan the read of the aggregated data for key: create the (masked)
+        output array and find the (uri, address, frag_slices, span,
+        out_slices) piece of each fragment that intersects the selection.
+        Returns (out, squeeze, pieces)."""
+        var = self._var
+        index = var.getFragmentIndex()
+        slices, squeeze = normalise_key(key, index.shape)
+        out_shape = [len(range(s.start, s.stop, s.step)) for s in slices]
+        # the output is filled, and masked, in one go, so the regions of
+        # absent fragments need no I/O or assignment
+        fill_value = self._fillValue
+        if fill_value is None:
+            out = numpy.ma.masked_all(out_shape, dtype=var.dtype)
+        else:
+            out = numpy.ma.masked_array(
+                numpy.full(out_shape, fill_value, dtype=var.dtype), mask=True,
+                fill_value=fill_value
+            )
+
+        # get the file and address columns (cached in read mode) before any
+        # fragments are read, as this may call the CFA-C library
+        files = self._fragmentFiles()
+        addresses = var.getFragmentColumn("address")
+        absent = self._absentFragments()
+
+        pieces = []
+        for frag_loc, frag_slices, out_slices in index.intersect(slices):
+            frag_loc = tuple(frag_loc)
+            if absent[frag_loc]:
+                continue
+            extent = index.getExtent(frag_loc)
+            pieces.append((files[frag_loc], addresses[frag_loc], frag_slices,
+                           tuple(e1 - e0 for e0, e1 in extent), out_slices))
+        return out, squeeze, pieces
+
+    def _readSlices(self, piece: tuple) -> tuple:
+        """Get the slices to read from the fragment variable of a piece, and
+        the axes of the aggregated data they correspond to (None if the
+        fragment does not omit any size 1 dimensions)"""
+        uri, address, frag_slices, span, out_slices = piece
+        axes = self._fragmentAxes(uri, address, span)
+        if axes is None:
+            return frag_slices, None
+        return tuple(frag_slices[d] for d in axes), axes
+
+    def _place(self, out: numpy.ndarray, piece: tuple, axes: list[int],
+               data: numpy.ndarray) -> None:
+        """Assign the data read for a piece into the output array, inserting
+        any omitted size 1 axes and converting the units"""
+        uri, address, frag_slices, span, out_slices = piece
+        if axes is not None:
+            # insert the omitted size 1 axes as a view, so the data are
+            # copied once, into the output
+            data = numpy.expand_dims(
+                data, tuple(d for d in range(0, len(span)) if d not in axes)
+            )
+        conversion = None
+        if self.convert_units:
+            conversion = self._conversion(uri, address)
+        if conversion is not None and out.dtype.kind in "iu":
+            data = _convert_integers(data, conversion, out.dtype, address)
+        out[out_slices] = data
+        if conversion is not None and out.dtype.kind not in "iu":
+            # convert in place, in the output array
+            view = out.data[out_slices]
+            scale, offset = conversion
+            if scale != 1.0:
+                numpy.multiply(view, scale, out=view)
+            if offset != 0.0:
+                numpy.add(view, offset, out=view)
+
+    def read(self, key: object) -> numpy.ndarray:
+        """Read the aggregated data for key, a selection of integers, slices
+        and an Ellipsis."""
+        out, squeeze, pieces = self._plan(key)
+        read_pieces([(self, out, piece) for piece in pieces])
+        if len(squeeze) > 0:
+            out = out.squeeze(axis=tuple(squeeze))
+        return out
+
+def _convert_integers(data: numpy.ndarray, conversion: tuple[float, float],
+                      dtype: object, address: str) -> numpy.ndarray:
+    """Convert the units of integer data in floating point, rounding to the
+    nearest integer of dtype, as converting in place would truncate"""
+    scale, offset = conversion
+    valid = ~numpy.ma.getmaskarray(data)
+    values = numpy.rint(numpy.ma.getdata(data) * scale + offset)
+    values[~valid] = 0
+    limits = numpy.iinfo(dtype)
+    if numpy.any((values < limits.min) | (values > limits.max)):
+        raise CFAException(f"Values of {address} converted to the units of "
+                           f"the aggregation variable do not fit in {dtype}")
+    return numpy.ma.masked_array(values.astype(dtype), mask=~valid)
+
+def read_pieces(jobs: list[tuple]) -> None:
+    """Read the (reader, out, piece) jobs, from any number of variables, into
+    their output arrays.  The pieces are grouped by fragment file, so that
+    each file is opened once and all the addresses requested from it are read
+    in one pass, while it is held open in the backend's pool."""
+    by_file = {}
+    for job in jobs:
+        by_file.setdefault(job[2][0], []).append(job)
+    for uri, file_jobs in by_file.items():
+        if uri is None:
+            # fragments in the aggregation file
+            for reader, out, piece in file_jobs:
+                slices, axes = reader._readSlices(piece)
+                data = reader._readFragment(None, piece[1], slices)
+                reader._place(out, piece, axes, data)
+            continue
+        plan = [(job,) + job[0]._readSlices(job[2]) for job in file_jobs]
+        data = get_backend(uri).read_many(
+            uri, [(job[2][1], slices) for job, slices, axes in plan]
+        )
+        for ((reader, out, piece), slices, axes), d in zip(plan, data):
+            reader._place(out, piece, axes, d)
@@ -0,0 +1,133 @@
+"""Export of the fragment table of an aggregation variable to Apache Arrow (and
+from there to pandas or Parquet), for analysing fragment catalogues: which
+files are referenced, the distribution of fragment sizes, duplicates, etc.
+
+The table has one row per fragment, in the order of the fragment definition,
+with the columns:
+
+    fragment        : the flat index of the fragment
+    f_<dim>         : the location of the fragment along each dimension
+    start_<dim>     : the start of the fragment along each dimension
+    size_<dim>      : the size of the fragment along each dimension
+    <term>          : the value of each aggregation instruction term (other
+                      than location), null where the fragment has no value
+
+The table is built in record batches, reading only the values of each term for
+the fragments in a batch (in read mode, from the definition variables), so
+only one batch at a time is held in memory, and a Parquet file is written
+batch by batch.  This requires pyarrow (and pandas, for a DataFrame).
+"""
+from __future__ import annotations
+from typing import Iterator
+
+import numpy
+
+import CFAPython
+from CFAPython import CFAType
+from CFAPython.CFAExceptions import CFAException
+
+def _pyarrow() -> object:
+    """Import pyarrow, which is an optional dependency"""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is required to export fragment tables")
+    return pyarrow
+
+def _arrow_array(pa: object, values: numpy.ndarray, type: object) -> object:
+    """Convert a batch of a fragment column to an Arrow array of type, with
+    the missing values (masked, or None for strings) as nulls"""
+    if values.dtype == object:
+        return pa.array(values.tolist(), type=type)
+    if numpy.ma.isMaskedArray(values):
+        return pa.array(numpy.ma.getdata(values),
+                        mask=numpy.ma.getmaskarray(values), type=type)
+    return pa.array(values, type=type)
+
+def _table_columns(var: object, resolve_files: bool) -> tuple:
+    """Get the schema of the fragment table of the CFAVariable var, and a
+    function read(start, stop) for the values of each term in a batch"""
+    pa = _pyarrow()
+    dims = var._dim_names
+    fields = ([("fragment", pa.int64())] +
+              [(f"f_{d}", pa.int32()) for d in dims] +
+              [(f"start_{d}", pa.int64()) for d in dims] +
+              [(f"size_{d}", pa.int64()) for d in dims])
+    readers = {}
+    for instr in var._variable.instructions:
+        if instr.term == "location":
+            continue
+        info = CFAPython.CFATypeToInfo(instr.type)
+        if instr.type == CFAType.CFAString:
+            fields.append((instr.term, pa.string()))
+        else:
+            fields.append((instr.term, pa.from_numpy_dtype(info.dtype)))
+        read = var._fragmentColumnReader(instr.term)
+        if instr.term == "file" and resolve_files:
+            read = (lambda read: lambda start, stop:
+                    var._resolveFiles(read(start, stop)))(read)
+        readers[instr.term] = read
+    return pa.schema(fields), readers
+
+def _batches(var: object, batch_size: int, resolve_files: bool) -> tuple:
+    """Get the schema of the fragment table of the CFAVariable var, and an
+    iterator over its record batches"""
+    pa = _pyarrow()
+    if batch_size <= 0:
+        raise CFAException("batch_size must be positive")
+    schema, readers = _table_columns(var, resolve_files)
+    index = var.getFragmentIndex()
+
+    def batches():
+        frag_def = index.frag_def
+        n_frags = index.nfragments
+        for b0 in range(0, n_frags, batch_size):
+            b1 = min(b0 + batch_size, n_frags)
+            flat = numpy.arange(b0, b1, dtype=numpy.int64)
+            locs = numpy.unravel_index(flat, frag_def)
+            values = ([flat] + [loc.astype(numpy.int32) for loc in locs] +
+                      [index.bounds[d][loc] for d, loc in enumerate(locs)] +
+                      [index.sizes[d][loc] for d, loc in enumerate(locs)] +
+                      [read(b0, b1) for read in readers.values()])
+            arrays = [_arrow_array(pa, v, field.type)
+                      for v, field in zip(values, schema)]
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+    return schema, batches()
+
+def fragment_batches(var: object, batch_size: int=65536,
+                     resolve_files: bool=False) -> Iterator[object]:
+    """Iterate over the fragment table of the CFAVariable var as Arrow record
+    batches of batch_size fragments.  If resolve_files is True then the file
+    column holds the resolved paths (see CFAVariable.getFragmentFiles) rather
+    than the file names as stored.  In read mode, the values of each term are
+    read from the definition variables one batch at a time."""
+    return _batches(var, batch_size, resolve_files)[1]
+
+def fragment_table(var: object, batch_size: int=65536,
+                   resolve_files: bool=False, pandas: bool=False) -> object:
+    """Get the fragment table of the CFAVariable var as an Arrow Table or, if
+    pandas is True, a pandas DataFrame"""
+    pa = _pyarrow()
+    schema, batches = _batches(var, batch_size, resolve_files)
+    table = pa.Table.from_batches(list(batches), schema=schema)
+    if pandas:
+        return table.to_pandas()
+    return table
+
+def write_fragment_table(var: object, path: str, batch_size: int=65536,
+                         resolve_files: bool=False,
+                         compression: str="zstd") -> int:
+    """Write the fragment table of the CFAVariable var to the Parquet file at
+    path, one record batch at a time.  The file is written (with no rows) 
+    even if there are no fragments.  Returns the number of fragments
+    written."""
+    _pyarrow()
+    import pyarrow.parquet
+    schema, batches = _batches(var, batch_size, resolve_files)
+    n_rows = 0
+    with pyarrow.parquet.ParquetWriter(path, schema,
+                                       compression=compression) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    return n_rows
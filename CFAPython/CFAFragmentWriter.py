@@ -0,0 +1,211 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from netCDF4 import Dataset
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import normalise_key, fragment_axes
+from CFAPython.CFAFragmentReader import CFAFragmentReader
+from CFAPython.CFAStorage import get_backend, CFAPosixBackend
+
+def _write_file(path: str, pieces: list[tuple]) -> int:
+    """Write the (address, slices, data) pieces into the fragment file at
+    path.  This is run in a worker process."""
+    with Dataset(path, mode='a') as nc_frag:
+        for address, slices, data in pieces:
+            nc_frag[address][slices] = data
+    return len(pieces)
+
+def _unconvert(data: numpy.ndarray, conversion: tuple[float, float],
+               dtype: object, address: str) -> numpy.ndarray:
+    """Convert data in the units of the aggregation variable to the units of
+    a fragment of dtype, the inverse of the (scale, offset) conversion of the
+    fragment.  Integer fragments are rounded to the nearest integer."""
+    scale, offset = conversion
+    mask = numpy.ma.getmaskarray(data)
+    values = (numpy.ma.getdata(data).astype(numpy.float64) - offset) / scale
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "iu":
+        values = numpy.rint(values)
+        values[mask] = 0
+        limits = numpy.iinfo(dtype)
+        if numpy.any((values < limits.min) | (values > limits.max)):
+            raise CFAException(f"Values converted to the units of fragment "
+                               f"{address} do not fit in {dtype}")
+        values = values.astype(dtype)
+    return numpy.ma.masked_array(values, mask=mask)
+
+class CFAFragmentWriter(CFAFragmentReader):
+    def __init__(self, var: object, workers: int=None, buffered: bool=False,
+                 buffer_size: int=256*1024*1024):
+        """Create a writer for the aggregated data of a CFAVariable, which
+        splits an array by fragment and writes each piece into its fragment
+        file.  The fragment files are written in parallel by workers
+        processes, otherwise through the file-handle pool of the storage
+        backend.  If buffered is True then the pieces are held until flush is
+        called, or until they exceed buffer_size bytes, so that each fragment
+        file is opened once for many assignments.  Data written to fragments
+        stored in different, but equivalent, units to the variable are
+        converted to the units of the fragment."""
+        super().__init__(var)
+        self.workers = workers
+        self.buffered = buffered
+        self.buffer_size = buffer_size
+        self._buffer = {}
+        self._buffer_bytes = 0
+
+    def _pieces(self, key: object, value: object) -> list[tuple]:
+        """Split value, assigned to the selection key of the aggregated data,
+        into a (file, address, slices, data) piece for each fragment that
+        intersects the selection"""
+        var = self._var
+        index = var.getFragmentIndex()
+        slices, squeeze = normalise_key(key, index.shape)
+        out_shape = [len(range(s.start, s.stop, s.step)) for s in slices]
+        value = numpy.ma.asanyarray(value, dtype=var.dtype)
+        # restore the axes removed by integer indices, then broadcast
+        if value.ndim == len(out_shape) - len(squeeze) and len(squeeze) > 0:
+            value = value.reshape([1 if d in squeeze else n
+                                   for d, n in enumerate(out_shape)])
+        # broadcast the data and mask separately, as broadcast_to does not
+        # broadcast the mask of a masked array
+        value = numpy.ma.masked_array(
+            numpy.broadcast_to(numpy.ma.getdata(value), out_shape),
+            mask=numpy.broadcast_to(numpy.ma.getmaskarray(value), out_shape)
+        )
+
+        files = self._fragmentFiles()
+        addresses = var.getFragmentColumn("address")
+        pieces = []
+        for frag_loc, frag_slices, out_slices in index.intersect(slices):
+            frag_loc = tuple(frag_loc)
+            if addresses[frag_loc] is None:
+                raise CFAException(f"Cannot write to absent fragment "
+                                   f"{list(frag_loc)}")
+            extent = index.getExtent(frag_loc)
+            span = [e[1] - e[0] for e in extent]
+            file = files[frag_loc]
+            pieces.append((file, addresses[frag_loc], frag_slices, span,
+                           value[out_slices]))
+        return pieces
+
+    def _fragmentSlices(self, nc_var: object, slices: tuple, span: list[int],
+                        data: numpy.ndarray) -> tuple:
+        """Drop the slices (and axes of data) of the size 1 dimensions that
+        the fragment variable omits"""
+        axes = fragment_axes(span, nc_var.shape)
+        if len(axes) == len(slices):
+            return slices, data
+        return (tuple(slices[d] for d in axes),
+                data.reshape([data.shape[d] for d in axes]))
+
+    def _fragmentData(self, nc_var: object, address: str, conversion: tuple,
+                      slices: tuple, span: list[int],
+                      data: numpy.ndarray) -> tuple:
+        """Get the slices and data to write to a fragment variable: drop any
+        omitted size 1 dimensions, and convert the data to the units of the
+        fragment, given the (scale, offset) conversion of the fragment (see
+        _conversion), or None"""
+        slices, data = self._fragmentSlices(nc_var, slices, span, data)
+        if conversion is not None:
+            data = _unconvert(data, conversion, nc_var.dtype, address)
+        return slices, data
+
+    def _writeConversion(self, file: str, address: str) -> tuple:
+        """Get the (scale, offset) conversion of a fragment, whose inverse is
+        applied to the data written to it, or None"""
+        if not self.convert_units:
+            return None
+        return self._conversion(file, address)
+
+    def _writePieces(self, pieces: list[tuple]) -> None:
+        """Write pieces, grouped by fragment file"""
+        by_file = {}
+        for file, address, slices, span, data in pieces:
+            if file is None:
+                # fragments in the aggregation file
+                nc_var = self._var._findNetCDFVariable(address)
+                if nc_var is None:
+                    raise CFAException(
+                        f"Fragment variable {address} not found in the "
+                        "aggregation file"
+                    )
+                conversion = self._writeConversion(None, address)
+                with CFAPython.nc_lock:
+                    slices, data = self._fragmentData(nc_var, address,
+                                                      conversion, slices,
+                                                      span, data)
+                    nc_var[slices] = data
+            else:
+                by_file.setdefault(file, []).append((address, slices, span,
+                                                     data))
+        if len(by_file) == 0:
+            return
+
+        if self.workers:
+            for file in by_file:
+                if not isinstance(get_backend(file), CFAPosixBackend):
+                    raise CFAException(f"Fragment {file} cannot be written "
+                                       "by worker processes")
+            # the worker processes need the shape of each fragment variable to
+            # drop omitted dimensions, so read it with the pooled handles
+            jobs = {}
+            for file, items in by_file.items():
+                backend = get_backend(file)
+                jobs[file] = []
+                for address, slices, span, data in items:
+                    conversion = self._writeConversion(file, address)
+                    with backend.dataset(file) as nc_object:
+                        with backend._lock:
+                            jobs[file].append(
+                                (address,) + self._fragmentData(
+                                    nc_object[address], address, conversion,
+                                    slices, span, data)
+                            )
+                # the file must not be open in this process while it is
+                # written by another
+                backend.release(file)
+            # the workers open the local path of each file, as the serial
+            # path does through its backend
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(_write_file,
+                              [get_backend(file)._path(file) for file in jobs],
+                              list(jobs.values())))
+        else:
+            for file, items in by_file.items():
+                backend = get_backend(file)
+                for address, slices, span, data in items:
+                    conversion = self._writeConversion(file, address)
+                    with backend.dataset(file, mode='a') as nc_object:
+                        with backend._lock:
+                            slices, data = self._fragmentData(
+                                nc_object[address], address, conversion,
+                                slices, span, data
+                            )
+                    backend.write(file, address, slices, data)
+                backend.sync(file)
+
+    def write(self, key: object, value: object) -> None:
+        """Write value into the selection key (integers, slices and an
+        Ellipsis) of the aggregated data"""
+        pieces = self._pieces(key, value)
+        if not self.buffered:
+            self._writePieces(pieces)
+            return
+        for piece in pieces:
+            # the data are a view of value, which may change before flush
+            piece = piece[:4] + (piece[4].copy(),)
+            self._buffer.setdefault(piece[0], []).append(piece)
+            self._buffer_bytes += piece[4].nbytes
+        if self._buffer_bytes > self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write any buffered pieces to the fragment files"""
+        pieces = [p for items in self._buffer.values() for p in items]
+        self._buffer = {}
+        self._buffer_bytes = 0
+        if len(pieces) > 0:
+            self._writePieces(pieces)
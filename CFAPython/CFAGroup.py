@@ -1,15 +1,19 @@
 
 from __future__ import annotations
-from typing import Iterable
+from typing import Iterable, Iterator, Callable
+import time
 
 import CFAPython
-from CFAPython._CFADatatypes import C_AggregationContainer
+from CFAPython._CFADatatypes import (C_AggregationContainer,
+                                     AggregationContainerInfo)
 from CFAPython.CFAExceptions import CFAException
 from CFAPython.CFADimension import CFADimension
 from CFAPython.CFAVariable import CFAVariable
+from CFAPython.CFAFragmentReader import CFAFragmentReader, read_pieces
+import CFAPython._CFASerialise as CFASerialise
 from netCDF4 import Variable
 
-from ctypes import c_int, c_char_p, pointer, byref, sizeof
+from ctypes import c_int, c_char_p, pointer, byref, sizeof, POINTER
 
 class CFAGroup:
     def __init__(self, id: int=-1, nc_object: object=None):
@@ -22,50 +26,66 @@ class CFAGroup:
         self._variables = []
         self._groups = []
         self.__serialised = False
+        self.__name = None
+        self.__info = None
+        self._definition_options = None
 
     @property
-    def _container(self) -> object:
+    def _c_container(self) -> object:
         """Get the underlying CFA-C AggregationContainer for this CFAGroup.
+        This is a view onto the structure owned by the CFA-C library, so no
+        (MAX_*-sized) structure is allocated on the Python side.
         Hidden (private) as we don't want users to access this method as it
         returns a C_AggregationContainer structure."""
-        cfa_cont = C_AggregationContainer()
-        cfa_cont_p = pointer(cfa_cont)
+        cfa_cont_p = POINTER(C_AggregationContainer)()
         cfa_err = CFAPython.lib().cfa_get(
-            self._cfa_id, pointer(cfa_cont_p)
+            self._cfa_id, byref(cfa_cont_p)
         )
         if (cfa_err != 0):
             raise CFAException(cfa_err)
         return cfa_cont_p.contents
 
+    @property
+    def _container(self) -> object:
+        """Get a snapshot of the CFA-C AggregationContainer for this CFAGroup,
+        as an AggregationContainerInfo."""
+        if self.__info is not None:
+            return self.__info
+        return AggregationContainerInfo(self._c_container)
+
+    def _freeze(self) -> None:
+        """Cache the metadata of the group.  This is only called in read
+        mode, where the metadata cannot change, so that reading the metadata
+        does not have to call (and lock) the CFA-C library."""
+        self.__info = AggregationContainerInfo(self._c_container)
+        self.__name = self.__info.name
+
     @property
     def _dim_ids(self) -> list[int]:
         """Get the CFADimension ids - this function is hidden as we want users
         to call getDimensions() or getDimension()"""
-        container = self._container # call this just once
-        dimids = []
-        for d in range(0, container.n_dims):
-            dimids.append(container.cfa_dimids[d])
-        return dimids
+        if self.__info is not None:
+            return self.__info.dim_ids
+        container = self._c_container # call this just once
+        return container.cfa_dimids[0:container.n_dims]
 
     @property
     def _var_ids(self) -> list[int]:
         """Get the CFAVariable ids - this function is hidden as we want users
         to call getVariables() or getVariable()"""
-        container = self._container # call this just once
-        varids = []
-        for v in range(0, container.n_vars):
-            varids.append(container.cfa_varids[v])
-        return varids
+        if self.__info is not None:
+            return self.__info.var_ids
+        container = self._c_container # call this just once
+        return container.cfa_varids[0:container.n_vars]
 
     @property
     def _grp_ids(self) -> list[int]:
         """Get the CFAGroup ids - this function is hidden as we want users
         to call getGroups() or get getGroup()"""
-        container = self._container # call this just once
-        grpids = []
-        for g in range(0, container.n_conts):
-            grpids.append(container.cfa_contids[g])
-        return grpids
+        if self.__info is not None:
+            return self.__info.cont_ids
+        container = self._c_container # call this just once
+        return container.cfa_contids[0:container.n_conts]
 
     def parse(self) -> None:
         """Parse the dataset that this group belongs to (or is) and attach r
@@ -74,6 +94,7 @@ class CFAGroup:
         2. netCDF Dimensions to the CFA Dimensions
         3. netCDF Variables to the CFA Variables"""
         # do this group first, then do the sub groups
+        self._freeze()
 
         # reset the dimensions in case parse called twice
         self._dimensions = []
@@ -82,6 +103,7 @@ class CFAGroup:
             dim = CFADimension(self._cfa_id, d)
             # get the netCDF dimension and assign to the CFADimension
             dim._nc_object = self._nc_object.dimensions[dim.name]
+            dim._freeze()
             self._dimensions.append(dim)
 
         # reset the variables in case parse called twice
@@ -104,37 +126,164 @@ class CFAGroup:
             # parse the sub groups from this group
             grp.parse()
 
-    def serialise(self) -> None:
-        """Serialise the CFA Group into the netCDF Group.
-        Note: CFA Dataset is derived from CFA Group, so serialising the root group
-        will serialise the Dataset."""
-        # Don't serialise if already serialised
+    def _refreshFrom(self, grp: object) -> None:
+        """Take the state of grp, this group parsed again after its dataset 
+        was refreshed (see CFADataset.refresh).  The existing CFAGroup and 
+        CFAVariable objects are kept for the groups and variables that still
+        exist, so references held to them stay valid."""
+        old_variables = {v.name: v for v in self._variables}
+        old_groups = {g.name: g for g in self._groups}
+        self.__dict__.update(grp.__dict__)
+        variables = []
+        for v in self._variables:
+            if v.name in old_variables:
+                old_variables[v.name]._refreshFrom(v)
+                v = old_variables[v.name]
+            variables.append(v)
+        self._variables = variables
+        groups = []
+        for g in self._groups:
+            if g.name in old_groups:
+                old_groups[g.name]._refreshFrom(g)
+                g = old_groups[g.name]
+            groups.append(g)
+        self._groups = groups
+
+    def _serialisePlan(self, options: dict=None) -> list[tuple[object, object]]:
+        """Flatten this group and its sub groups into a list of 
+        (group, variable, options) tuples, in the order they are serialised: 
+        sub groups first, then the variables in this group.  Groups that have
+        already been serialised are skipped.  Sub groups inherit the 
+        definition options of their parent unless they have their own."""
+        plan = []
         if self.__serialised:
-            return
-        
-        # recursively serialise any groups
+            return plan
+        if self._definition_options is not None:
+            options = self._definition_options
         for g in self._groups:
-            g.serialise()
+            plan.extend(g._serialisePlan(options))
+        for v in self._variables:
+            plan.append((self, v, options))
+        return plan
+
+    def setDefinitionOptions(self, compression: str=None, complevel: int=4,
+                             shuffle: bool=True, chunksizes: dict=None,
+                             deduplicate: bool=True) -> None:
+        """Set the write-time options for the aggregation definition variables
+        of the variables in this group (and its sub groups):
+        compression : the compression filter, e.g. "zlib" or "zstd", as 
+                      accepted by netCDF4 createVariable
+        complevel   : the compression level
+        shuffle     : whether to apply the HDF5 shuffle filter
+        chunksizes  : the chunk shape of the definition variable for a term,
+                      keyed by term, e.g. {"file": (1000, 1, 1, 1)}
+        deduplicate : whether string definition variables with identical
+                      values (e.g. the file term of variables that share
+                      fragment files) are written once and shared.  Only
+                      whole definition variables are shared: repeated
+                      values within a variable are still written
+        Variable length strings cannot be compressed in netCDF-4, so when
+        compression is set the string definition variables (e.g. the file
+        names) are written as compressed, fixed width, char arrays, which
+        netCDF4 reads back as strings.  Their chunk shape has the string 
+        length appended."""
+        self._definition_options = {
+            "compression": compression,
+            "complevel"  : complevel,
+            "shuffle"    : shuffle,
+            "chunksizes" : dict(chunksizes or {}),
+            "deduplicate": deduplicate,
+        }
+
+    def _setSerialised(self) -> None:
+        """Mark this group and its sub groups as serialised"""
+        for g in self._groups:
+            g._setSerialised()
+        self.__serialised = True
+
+    def serialise(self, bulk: bool=False, progress: Callable=None,
+                  check_coverage: bool=False) -> list[dict]:
+        """Serialise the CFA Group into the netCDF Group.
+        Note: CFA Dataset is derived from CFA Group, so serialising the root group
+        will serialise the Dataset.
+        By default the fragments of each variable are serialised in turn by the
+        CFA-C library.  If bulk is True, or definition options have been set
+        with setDefinitionOptions, or the fragments of a variable were set in
+        bulk with CFAVariable.setFragments, then the aggregation definition
+        arrays of each variable are prepared in bulk, and each definition 
+        variable is written with a single netCDF write.  This is also the case
+        for variables with a regular fragmentation (see 
+        CFAVariable.setFragmentDefinition), for which the location definition
+        variable is not written.
+        The variables are prepared in turn: preparing the arrays is almost
+        all calls into the CFA-C library (which hold cfa_lock) and netCDF
+        reads, so it would not run in parallel in threads.
+        If progress is given then progress(done, total, variable) is called 
+        after each variable is serialised.
+        If check_coverage is True then, before anything is written, the 
+        fragments of every variable are checked to tile its aggregated data
+        exactly (see CFAVariable.checkCoverage), and a CFAException is raised
+        if any do not.
+        Returns the timing breakdown (in seconds) for each variable, as a list
+        of dictionaries."""
+        plan = self._serialisePlan()
+        timings = []
+        if len(plan) == 0:
+            return timings
+
+        if check_coverage:
+            reports = [v.checkCoverage() for grp, v, options in plan]
+            failed = [r.summary() for r in reports if not r.ok]
+            if len(failed) > 0:
+                raise CFAException("Fragments do not tile the aggregated "
+                                   "data: " + " | ".join(failed))
 
         # no need to serialise the dimensions - all the necessary steps for the CFA
         # dimensions are performed by dimension.CFA.createDimension
-        
-        # serialise the variables - write out the CFA fragments and the aggregation
-        # instructions
-        for v in self._variables:
-            cfa_err = CFAPython.lib()._serialise_cfa_fragments_netcdf(
-                self.nc_id, self.cfa_id, v.cfa_id
-            )
-            if (cfa_err != 0):
-                raise CFAException(cfa_err)
-            
+
+        # digests of the string definition variables written, for 
+        # deduplication
+        written = {}
+        for n, (grp, v, options) in enumerate(plan):
+            timing = {"group": grp.nc.path, "variable": v.name}
+            # write out the CFA fragments ...
+            t0 = time.perf_counter()
+            if (not bulk and options is None and 
+                    not v._hasBulkFragments() and not v._isRegular()):
+                # serialised by the CFA-C library
+                cfa_err = CFAPython.lib()._serialise_cfa_fragments_netcdf(
+                    grp.nc_id, grp.cfa_id, v.cfa_id
+                )
+                if (cfa_err != 0):
+                    raise CFAException(cfa_err)
+            else:
+                definition = CFASerialise.prepare_definition(v)
+                timing["prepare"] = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                CFASerialise.write_definition(
+                    grp.nc, v, definition, 
+                    options or CFASerialise.DEFAULT_OPTIONS, written
+                )
+                v._releaseShards()
+            t1 = time.perf_counter()
+            timing["fragments"] = t1 - t0
+
+            # ... and the aggregation instructions
             cfa_err = CFAPython.lib()._serialise_cfa_aggregation_instructions(
-                self.nc_id, v.nc_id, self.cfa_id, v.cfa_id                 
+                grp.nc_id, v.nc_id, grp.cfa_id, v.cfa_id
             )
             if (cfa_err != 0):
                 raise CFAException(cfa_err)
+            if v._isRegular():
+                CFASerialise.drop_location(v._nc_object)
+            timing["instructions"] = time.perf_counter() - t1
+            timings.append(timing)
+            if progress:
+                progress(n+1, len(plan), v)
+
         # indicate already serialised, so close doesn't try to serialise again
-        self.__serialised = True
+        self._setSerialised()
+        return timings
 
     def createDimension(self, dimname: str, datatype: CFAPython.CFAType=4, 
                         size: int=1) -> object:
@@ -245,6 +394,55 @@ class CFAGroup:
         self._groups.append(grp)
         return grp
 
+    def walkVariables(self) -> Iterator[tuple[object, object]]:
+        """Iterate over the (group, variable) pairs of the CFAVariables in this
+        group and, recursively, its sub groups"""
+        for v in self._variables:
+            yield self, v
+        for g in self._groups:
+            yield from g.walkVariables()
+
+    def _findVariable(self, path: str) -> object:
+        """Find a CFAVariable from its path: a name in this group, a path
+        relative to this group, e.g. "grp/var", or an absolute path"""
+        with CFAPython.nc_lock:
+            root = self._nc_object.path.rstrip("/")
+        if not path.startswith("/"):
+            path = root + "/" + path
+        for grp, var in self.walkVariables():
+            with CFAPython.nc_lock:
+                var_path = grp.nc.path.rstrip("/") + "/" + var.name
+            if var_path == path:
+                return var
+        raise CFAException("Variable {} not found".format(path))
+
+    @CFAPython.shared_access
+    def read(self, requests: dict) -> dict:
+        """Read the aggregated data of several variables, in this group or
+        its sub groups, in one pass: requests maps a variable (name, or path 
+        relative to this group) to a selection of integers, slices and an 
+        Ellipsis, e.g. {"temp": (0, slice(None)), "time": ...}.  The fragment
+        reads of all the variables are grouped by fragment file, so a file 
+        shared by several variables is opened once.
+        Returns the data of each variable, keyed as in requests."""
+        jobs = []
+        outputs = {}
+        for path, key in requests.items():
+            var = self._findVariable(path)
+            if var._fragment_reader is None:
+                var._fragment_reader = CFAFragmentReader(var)
+            reader = var._fragment_reader
+            out, squeeze, pieces = reader._plan(key)
+            outputs[path] = (out, squeeze)
+            jobs.extend((reader, out, piece) for piece in pieces)
+        read_pieces(jobs)
+        result = {}
+        for path, (out, squeeze) in outputs.items():
+            if len(squeeze) > 0:
+                out = out.squeeze(axis=tuple(squeeze))
+            result[path] = out
+        return result
+
     @property
     def groups(self) -> list[object]:
         """Get the list of CFAGroups in this container"""
@@ -266,22 +464,25 @@ class CFAGroup:
     def ngroups(self) -> int:
         """Return the number of containers (groups) in this container (group).
         """
-        return self._container.n_conts
+        return len(self._grp_ids)
 
     @property
     def nvariables(self) -> int:
         """Return the number of variables in this container."""
-        return self._container.n_vars
+        return len(self._var_ids)
 
     @property
     def ndimensions(self) -> int:
         """Return the number of dimensions in this container."""
-        return self._container.n_dims
+        return len(self._dim_ids)
 
     @property
     def name(self) -> str:
         """Return the name of the group."""
-        return self._container.name.decode('utf-8')
+        # the name cannot change once the group is defined, so cache it
+        if self.__name is None:
+            self.__name = self._c_container.name.decode('utf-8')
+        return self.__name
     
     @property
     def nc(self) -> object:
@@ -0,0 +1,312 @@
+from __future__ import annotations
+from typing import Iterable
+from concurrent.futures import ProcessPoolExecutor
+import os.path
+
+import numpy
+
+import CFAPython
+from CFAPython.CFADataset import CFADataset
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import CFAFragmentIndex
+from CFAPython.CFAFragmentReader import CFAFragmentReader
+
+# attributes written by the CFA-C library, which are not copied when saving
+_CFA_ATTRIBUTES = ("aggregated_dimensions", "aggregated_data")
+
+def _resolve_files(files: numpy.ndarray, path: str) -> numpy.ndarray:
+    """Resolve the fragments stored in the CFA file at path itself (no file)
+    to the CFA file.  The other files have already been resolved, to paths or
+    URIs, by getFragmentFiles."""
+    resolved = numpy.empty(files.shape, dtype=object)
+    for i, f in enumerate(files.flat):
+        resolved.flat[i] = path if f is None else f
+    return resolved
+
+def _read_tables(path: str, concat_dim: str) -> dict:
+    """Read the fragment tables of the aggregation variables in the root group
+    of the CFA file at path that span concat_dim.  This is run in a worker
+    process, so only returns plain (picklable) data."""
+    path = os.path.abspath(path)
+    ds = CFADataset(path, mode='r')
+    try:
+        tables = {}
+        for var in ds.CFA.getVariables():
+            dims = [d.name for d in var.getDimensions()]
+            if concat_dim not in dims:
+                continue
+            instrs = [(i.term, i.value, i.scalar, i.type)
+                      for i in var._variable.instructions]
+            columns = {}
+            for term, value, scalar, T in instrs:
+                if term == "location":
+                    continue
+                columns[term] = var.getFragmentColumn(term)
+            if "file" in columns:
+                # apply the file substitutions, then resolve the fragments in
+                # the CFA file itself to it
+                columns["file"] = _resolve_files(var.getFragmentFiles(), path)
+            index = var.getFragmentIndex()
+            tables[var.name] = {
+                "type"        : var._variable.type,
+                "dims"        : dims,
+                "shape"       : index.shape,
+                "sizes"       : index.sizes,
+                "instructions": instrs,
+                "columns"     : columns,
+            }
+        coords = None
+        if concat_dim in ds.variables:
+            coords = ds.variables[concat_dim][:]
+        dim_sizes = {d.name: d.size for d in ds.CFA.getDimensions()}
+        return {"path": path, "variables": tables, "coords": coords,
+                "dim_sizes": dim_sizes}
+    finally:
+        ds.close()
+
+class CFAVirtualVariable:
+    def __init__(self, name: str, type: int, dims: list[str], concat_dim: str,
+                 tables: list[dict], nc_object: object):
+        """Create a virtual aggregation variable by concatenating the fragment
+        tables of the same aggregation variable in several CFA files along
+        concat_dim."""
+        self._name = name
+        self._type = type
+        self._dims = dims
+        self._nc_object = nc_object
+        self._instructions = tables[0]["instructions"]
+        axis = dims.index(concat_dim)
+
+        # the other dimensions, and their fragmentation, must match
+        for t in tables[1:]:
+            if t["dims"] != dims:
+                raise CFAException(
+                    f"Variable {name} has different dimensions in {t['path']}"
+                )
+            for d in range(0, len(dims)):
+                if d == axis:
+                    continue
+                if not numpy.array_equal(t["sizes"][d], tables[0]["sizes"][d]):
+                    raise CFAException(
+                        f"Variable {name} has a different shape or "
+                        f"fragmentation along {dims[d]} in {t['path']}"
+                    )
+
+        # concatenate the fragment sizes along the concatenation dimension -
+        # this shifts the location of each fragment by the size of the files
+        # before it
+        shape = list(tables[0]["shape"])
+        shape[axis] = sum(t["shape"][axis] for t in tables)
+        sizes = list(tables[0]["sizes"])
+        sizes[axis] = numpy.concatenate([t["sizes"][axis] for t in tables])
+        self._fragment_index = CFAFragmentIndex(shape, sizes)
+
+        # concatenate the columns of each term
+        self._columns = {}
+        for term in tables[0]["columns"]:
+            self._columns[term] = numpy.ma.concatenate(
+                [t["columns"][term] for t in tables], axis=axis
+            )
+        self._fragment_reader = None
+
+    def __str__(self):
+        return f"{self.name}: {self.__class__}: name={self.name}"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def name(self) -> str:
+        """Return the name of the variable"""
+        return self._name
+
+    @property
+    def type(self) -> CFAPython.CFAType:
+        """Return the CFAType of the variable"""
+        return CFAPython.CFAType(self._type)
+
+    @property
+    def ndims(self) -> int:
+        """Get the number of dimensions the variable is defined over"""
+        return len(self._dims)
+
+    @property
+    def dimension_names(self) -> list[str]:
+        """Get the names of the dimensions the variable is defined over"""
+        return self._dims
+
+    @property
+    def shape(self) -> list[int]:
+        """Get the shape of the aggregated data"""
+        return self._fragment_index.shape
+
+    @property
+    def dtype(self) -> object:
+        """Return the NumPy dtype of the aggregated data"""
+        return self._nc_object.dtype
+
+    @property
+    def nc(self) -> object:
+        """Return the netCDF variable in the first file, which holds the
+        metadata of the variable"""
+        return self._nc_object
+
+    @property
+    def instructions(self) -> list[tuple]:
+        """Return the aggregation instructions as (term, value, scalar, type)"""
+        return self._instructions
+
+    def getFragmentDefinition(self) -> list[int]:
+        """Get the number of fragments along each dimension"""
+        return self._fragment_index.frag_def
+
+    def getFragmentIndex(self) -> CFAFragmentIndex:
+        """Get the CFAFragmentIndex of the concatenated fragments"""
+        return self._fragment_index
+
+    def getFragmentColumn(self, term: str) -> numpy.ndarray:
+        """Get the value of a single term for every fragment"""
+        if term not in self._columns:
+            raise CFAException(-531)
+        return self._columns[term]
+
+    def getFragment(self, frag_loc: list[int] = [],
+                    data_loc: list[int] = []) -> dict:
+        """Get a fragment, either from a Fragment Location, or a Data
+        Location, as a dictionary of the index, location and terms"""
+        if len(frag_loc) == 0:
+            if len(data_loc) == 0:
+                raise CFAException(-536)
+            frag_loc = self._fragment_index.getFragmentLocation(data_loc)
+        frag = {"index": list(frag_loc),
+                "location": self._fragment_index.getExtent(frag_loc)}
+        for term, column in self._columns.items():
+            value = column[tuple(frag_loc)]
+            frag[term] = None if value is numpy.ma.masked else value
+        return frag
+
+    def _findNetCDFVariable(self, path: str) -> object:
+        """Fragments are always resolved to a file, so there are no fragments
+        in the (virtual) aggregation file"""
+        return None
+
+    def __getitem__(self, key: object) -> numpy.ndarray:
+        """Read the aggregated data for a selection of integers, slices and an
+        Ellipsis, from the fragments that intersect the selection."""
+        if self._fragment_reader is None:
+            self._fragment_reader = CFAFragmentReader(self)
+        return self._fragment_reader.read(key)
+
+class CFAMultiDataset:
+    def __init__(self, paths: Iterable[str], concat_dim: str="time",
+                 workers: int=None):
+        """Open several CFA files and concatenate the aggregation variables in
+        their root groups along concat_dim, without rewriting any files.  The
+        fragment tables of the files are read in parallel by workers
+        processes.  Only variables that span concat_dim and are present in
+        every file are concatenated."""
+        self._paths = [os.path.abspath(p) for p in paths]
+        if len(self._paths) == 0:
+            raise CFAException("No files to concatenate")
+        self._concat_dim = concat_dim
+
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                files = list(pool.map(_read_tables, self._paths,
+                                      [concat_dim] * len(self._paths)))
+        else:
+            files = [_read_tables(p, concat_dim) for p in self._paths]
+
+        # keep the first file open, to provide the metadata
+        self._first = CFADataset(self._paths[0], mode='r')
+        self._concat_size = sum(f["dim_sizes"][concat_dim] for f in files)
+        self._coords = None
+        if all(f["coords"] is not None for f in files):
+            self._coords = numpy.ma.concatenate([f["coords"] for f in files])
+
+        self._variables = []
+        for name, table in files[0]["variables"].items():
+            if not all(name in f["variables"] for f in files):
+                continue
+            tables = [dict(f["variables"][name], path=f["path"]) for f in files]
+            self._variables.append(CFAVirtualVariable(
+                name, table["type"], table["dims"], concat_dim, tables,
+                self._first.variables[name]
+            ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def paths(self) -> list[str]:
+        """Return the paths of the concatenated files"""
+        return self._paths
+
+    @property
+    def variables(self) -> list[CFAVirtualVariable]:
+        """Get the list of concatenated variables"""
+        return self._variables
+
+    def getVariables(self) -> list[CFAVirtualVariable]:
+        """Just a wrapper to variables property above"""
+        return self.variables
+
+    def getVariable(self, varname: str) -> CFAVirtualVariable:
+        """Get a single variable, matching the name"""
+        for var in self._variables:
+            if var.name == varname:
+                return var
+        raise CFAException("Variable {} not found".format(varname))
+
+    def close(self) -> None:
+        """Close the first file, which provides the metadata"""
+        self._first.close()
+
+    def save(self, path: str) -> None:
+        """Save the concatenated aggregation as a new CFA file, writing the
+        fragment tables in bulk.  The fragment files are not copied, and are
+        referred to by their absolute paths."""
+        first = self._first
+        ds = CFADataset(path, mode='w')
+        try:
+            for dim in first.CFA.getDimensions():
+                size = dim.size
+                if dim.name == self._concat_dim:
+                    size = self._concat_size
+                ds.CFA.createDimension(dim.name, dim.type, size)
+                # copy the coordinate variable
+                if dim.name in first.variables:
+                    src = first.variables[dim.name]
+                    dst = ds.variables[dim.name]
+                    dst.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+                    if dim.name == self._concat_dim:
+                        if self._coords is not None:
+                            dst[:] = self._coords
+                    else:
+                        dst[:] = src[:]
+
+            for vv in self._variables:
+                var = ds.CFA.createVariable(vv.name, vv.type,
+                                            vv.dimension_names)
+                var.setAggregationInstruction({
+                    term: (value, scalar, T)
+                    for term, value, scalar, T in vv.instructions
+                })
+                index = vv.getFragmentIndex()
+                var.setFragmentDefinition(index.frag_def)
+                var.setFragments(vv._columns, sizes=index.sizes)
+                var.nc.setncatts({a: vv.nc.getncattr(a)
+                                  for a in vv.nc.ncattrs()
+                                  if a not in _CFA_ATTRIBUTES})
+            ds.CFA.serialise()
+        finally:
+            ds.close()
+
+def open_mfcfa(paths: Iterable[str], concat_dim: str="time",
+               workers: int=None) -> CFAMultiDataset:
+    """Open several CFA files as a single, virtual, aggregation concatenated
+    along concat_dim.  See CFAMultiDataset."""
+    return CFAMultiDataset(paths, concat_dim, workers)
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import numpy
+
+from CFAPython.CFAExceptions import CFAException
+
+class CFARaggedIndex:
+    def __init__(self, counts: object):
+        """Create an index of the features of a discrete sampling geometry
+        stored as a contiguous ragged array, from the count variable: the
+        number of elements (e.g. observations) of each feature.  The elements
+        of feature k are [offsets[k], offsets[k+1]) along the sample
+        dimension."""
+        counts = numpy.ma.filled(numpy.ma.asanyarray(counts), 0)
+        if counts.ndim != 1:
+            raise CFAException("Count variable must be one dimensional")
+        if numpy.any(counts < 0):
+            raise CFAException("Count variable must not be negative")
+        self._offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=self._offsets[1:])
+
+    def __str__(self):
+        return (f"{self.__class__}: nfeatures={self.nfeatures}, "
+                f"nelements={self.nelements}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def offsets(self) -> numpy.ndarray:
+        """Return the offset of the first element of each feature, followed
+        by the total number of elements"""
+        return self._offsets
+
+    @property
+    def counts(self) -> numpy.ndarray:
+        """Return the number of elements of each feature"""
+        return numpy.diff(self._offsets)
+
+    @property
+    def nfeatures(self) -> int:
+        """Return the number of features"""
+        return len(self._offsets) - 1
+
+    @property
+    def nelements(self) -> int:
+        """Return the total number of elements of all the features"""
+        return int(self._offsets[-1])
+
+    def getFeatureSlice(self, start: int, stop: int=None) -> slice:
+        """Get the slice along the sample dimension of the elements of the
+        features start to stop (exclusive), or of feature start if stop is
+        None"""
+        n = self.nfeatures
+        if stop is None:
+            if start < 0:
+                start += n
+            stop = start + 1
+        if start < 0 or stop > n or start > stop:
+            raise CFAException(f"Features {start}:{stop} out of range")
+        return slice(int(self._offsets[start]), int(self._offsets[stop]))
+
+    def getFeatureOf(self, elements: object) -> object:
+        """Get the feature that each element index along the sample dimension
+        belongs to, with a binary search"""
+        elements = numpy.asarray(elements)
+        if numpy.any(elements < 0) or numpy.any(elements >= self.nelements):
+            raise CFAException("Element index out of range")
+        return numpy.searchsorted(self._offsets, elements, side="right") - 1
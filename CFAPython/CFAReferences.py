@@ -0,0 +1,579 @@
+"""Export of the aggregation variables in a CFA-netCDF file as a kerchunk
+reference set, so that the aggregated data can be read as a Zarr (v2) store
+without copying it, and without the netCDF library.  Each chunk of the Zarr
+array refers to the byte range of an HDF5 chunk in a fragment file.
+
+The HDF5 chunk layout of the fragment files is scanned in parallel, with h5py,
+one variable and one batch of fragments at a time.  References are written as
+they are found, either as kerchunk JSON or, if pyarrow is installed, as a
+kerchunk Parquet directory.
+
+Every fragment of a variable must have the same chunk shape, dtype and filters,
+and fragments must be aligned to the chunk shape, so that the chunks form a
+regular Zarr chunk grid.  Fragments must also have the units, packing
+(scale_factor and add_offset) and fill value of their aggregation variable, as
+Zarr readers cannot convert them.  Coordinate variables in the aggregation file are
+also exported.
+
+Usage: python -m CFAPython.CFAReferences [--workers N] [--format F] file out
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator
+import argparse
+import json
+import math
+import os
+import os.path
+import sys
+
+import numpy
+from netCDF4 import default_fillvals
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import fragment_axes
+from CFAPython.CFAStorage import uri_scheme, CFAFileURIBackend
+
+# attributes of the aggregation variables that are not copied to .zattrs
+_SKIP_ATTRIBUTES = ("aggregated_dimensions", "aggregated_data", "_FillValue")
+
+# attributes of a fragment that change the values its stored data represent
+_ENCODING_ATTRIBUTES = ("units", "scale_factor", "add_offset", "_FillValue")
+
+def _open_hdf5(uri: str) -> object:
+    """Open a fragment file (a path or a URI) with h5py"""
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is required to export kerchunk references")
+    scheme = uri_scheme(uri)
+    if scheme == "":
+        return h5py.File(uri, mode="r")
+    if scheme == "file":
+        return h5py.File(CFAFileURIBackend()._path(uri), mode="r")
+    try:
+        import fsspec
+    except ImportError:
+        raise ImportError(
+            "fsspec is required to read fragments from remote storage"
+        )
+    return h5py.File(fsspec.open(uri, mode="rb").open(), mode="r")
+
+def _filters(dset: object) -> list[dict]:
+    """Convert the HDF5 filters of a dataset to the equivalent numcodecs
+    filters, in the order they are applied when encoding"""
+    if dset.fletcher32 or dset.scaleoffset is not None:
+        raise CFAException(
+            f"HDF5 filters of {dset.name} are not supported by Zarr"
+        )
+    filters = []
+    if dset.shuffle:
+        filters.append({"id": "shuffle", "elementsize": dset.dtype.itemsize})
+    if dset.compression == "gzip":
+        filters.append({"id": "zlib", "level": dset.compression_opts})
+    elif dset.compression is not None:
+        raise CFAException(
+            f"HDF5 compression {dset.compression} of {dset.name} is not "
+            "supported"
+        )
+    return filters
+
+def _encoding(dset: object) -> dict:
+    """Get the attributes of an HDF5 dataset that change the values that its
+    stored data represent (see _ENCODING_ATTRIBUTES)"""
+    encoding = {}
+    for name in _ENCODING_ATTRIBUTES:
+        if name not in dset.attrs:
+            continue
+        value = dset.attrs[name]
+        if isinstance(value, numpy.ndarray) and value.size == 1:
+            value = value.reshape(())[()]
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, numpy.generic):
+            value = value.item()
+        encoding[name] = value
+    return encoding
+
+def _same_value(a: object, b: object) -> bool:
+    """Return whether two attribute values are equal, treating NaNs as
+    equal"""
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    a = numpy.asarray(a, dtype=numpy.float64)
+    b = numpy.asarray(b, dtype=numpy.float64)
+    return a.shape == b.shape and bool(numpy.all((a == b) |
+                                                 (numpy.isnan(a) &
+                                                  numpy.isnan(b))))
+
+def _scan_dataset(dset: object) -> dict:
+    """Get the chunk layout of an HDF5 dataset: the chunk shape, dtype,
+    filters, encoding attributes, and the element offset, byte offset and
+    byte size of each stored chunk"""
+    if dset.dtype.kind not in "biufc":
+        raise CFAException(f"Variable {dset.name} of type {dset.dtype} cannot "
+                           "be exported")
+    layout = {"shape": dset.shape, "dtype": dset.dtype.str,
+              "filters": _filters(dset), "encoding": _encoding(dset)}
+    dsid = dset.id
+    if dset.chunks is None:
+        # contiguous storage is a single chunk, if it has been written
+        layout["chunks"] = dset.shape
+        offset = dsid.get_offset()
+        if offset is None:
+            starts = numpy.zeros((0, len(dset.shape)), dtype="i8")
+            byte_offsets = sizes = numpy.zeros(0, dtype="i8")
+        else:
+            starts = numpy.zeros((1, len(dset.shape)), dtype="i8")
+            byte_offsets = numpy.array([offset], dtype="i8")
+            sizes = numpy.array([dsid.get_storage_size()], dtype="i8")
+    else:
+        layout["chunks"] = dset.chunks
+        n = dsid.get_num_chunks()
+        starts = numpy.zeros((n, len(dset.shape)), dtype="i8")
+        byte_offsets = numpy.zeros(n, dtype="i8")
+        sizes = numpy.zeros(n, dtype="i8")
+        for i in range(0, n):
+            info = dsid.get_chunk_info(i)
+            starts[i] = info.chunk_offset
+            byte_offsets[i] = info.byte_offset
+            sizes[i] = info.size
+    layout.update(starts=starts, byte_offsets=byte_offsets, sizes=sizes)
+    return layout
+
+def _scan_file(uri: str, addresses: list[str]) -> dict:
+    """Scan the chunk layout of the variables at addresses in the fragment
+    file at uri.  This is run in a worker process, so returns plain
+    (picklable) data, with any error as a string."""
+    layouts = {}
+    try:
+        with _open_hdf5(uri) as h5_file:
+            for address in addresses:
+                try:
+                    layouts[address] = _scan_dataset(h5_file[address])
+                except (KeyError, CFAException) as e:
+                    layouts[address] = {"error": str(e)}
+    except (OSError, ImportError) as e:
+        for address in addresses:
+            layouts[address] = {"error": f"cannot open {uri}: {e}"}
+    return layouts
+
+def _json_value(value: object) -> object:
+    """Convert an attribute or fill value to a value that can be written as
+    JSON, following the Zarr conventions for non-finite floats"""
+    if isinstance(value, numpy.ndarray):
+        return [_json_value(v) for v in value.tolist()]
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "Infinity" if value > 0 else "-Infinity"
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+class _ExportVariable:
+    def __init__(self, key: str, shape: list[int], dims: list[str],
+                 attrs: dict, fill_value: object):
+        """A variable being exported, which collects the layout of its first
+        fragment to define the Zarr chunk grid"""
+        self.key = key.lstrip("/")
+        self.shape = list(shape)
+        self.dims = dims
+        self.attrs = attrs
+        self.fill_value = fill_value
+        self.chunks = None
+        self.dtype = None
+        self.filters = None
+
+    def zarray(self) -> dict:
+        """Return the .zarray metadata"""
+        return {
+            "zarr_format": 2,
+            "shape": self.shape,
+            "chunks": self.chunks,
+            "dtype": self.dtype,
+            "compressor": None,
+            "fill_value": _json_value(self.fill_value),
+            "order": "C",
+            "filters": self.filters if len(self.filters) > 0 else None,
+        }
+
+    def zattrs(self) -> dict:
+        """Return the .zattrs metadata"""
+        attrs = {k: _json_value(v) for k, v in self.attrs.items()}
+        attrs["_ARRAY_DIMENSIONS"] = self.dims
+        return attrs
+
+    @property
+    def grid(self) -> list[int]:
+        """Return the number of chunks along each dimension"""
+        return [-(-s // c) for s, c in zip(self.shape, self.chunks)]
+
+    def _checkEncoding(self, encoding: dict, dtype: str) -> None:
+        """Check that the stored data of a fragment, with the encoding
+        attributes and dtype from its layout, represent the same values as
+        they would in the variable: Zarr readers do not convert the units of
+        fragments, nor apply their own packing and fill values"""
+        for name in ("units", "scale_factor", "add_offset"):
+            value = self.attrs.get(name, None)
+            if isinstance(value, bytes):
+                value = value.decode()
+            frag_value = encoding.get(name, None)
+            if name == "units" and frag_value is None:
+                # fragments without units have the units of the variable
+                continue
+            if not _same_value(frag_value, value):
+                raise CFAException(
+                    f"A fragment of {self.key} has {name} {frag_value!r}, "
+                    f"not {value!r}, which cannot be exported as references"
+                )
+        default = default_fillvals.get(numpy.dtype(dtype).str[1:], None)
+        fill_value = self.fill_value
+        if fill_value is None:
+            fill_value = default
+        frag_fill_value = encoding.get("_FillValue", default)
+        if not _same_value(frag_fill_value, fill_value):
+            raise CFAException(
+                f"A fragment of {self.key} has _FillValue "
+                f"{frag_fill_value!r}, not {fill_value!r}, which cannot be "
+                "exported as references"
+            )
+
+    def chunkRefs(self, start: tuple[int], span: tuple[int],
+                  layout: dict) -> tuple:
+        """Convert the layout of a fragment, at start with span in the
+        aggregated array, to the Zarr chunk indices of its chunks.  Returns
+        (chunk indices, byte offsets, sizes)"""
+        if "error" in layout:
+            raise CFAException(layout["error"])
+        self._checkEncoding(layout.get("encoding", {}), layout["dtype"])
+        # fragments may omit size 1 dimensions
+        axes = fragment_axes(span, layout["shape"])
+        chunks = [1] * len(span)
+        for j, d in enumerate(axes):
+            chunks[d] = layout["chunks"][j]
+
+        # the first fragment defines the chunk grid
+        if self.chunks is None:
+            self.chunks = chunks
+            self.dtype = layout["dtype"]
+            self.filters = layout["filters"]
+        if (chunks != self.chunks or layout["dtype"] != self.dtype or
+                layout["filters"] != self.filters):
+            raise CFAException(
+                f"Fragments of {self.key} have different chunk shapes, dtypes "
+                "or filters, which cannot be exported as a single Zarr array"
+            )
+        for d in range(0, len(span)):
+            end = start[d] + span[d]
+            if (start[d] % chunks[d] != 0 or
+                    (end % chunks[d] != 0 and end != self.shape[d])):
+                raise CFAException(
+                    f"Fragments of {self.key} are not aligned to the chunk "
+                    f"shape {tuple(chunks)}"
+                )
+
+        starts = numpy.zeros((len(layout["starts"]), len(span)), dtype="i8")
+        for j, d in enumerate(axes):
+            starts[:, d] = layout["starts"][:, j]
+        indices = (starts + numpy.array(start, dtype="i8")) // chunks
+        return indices, layout["byte_offsets"], layout["sizes"]
+
+class _JSONWriter:
+    def __init__(self, path: str):
+        """Write a kerchunk reference JSON file, one reference per line, as
+        the references are found"""
+        self._fh = open(path, "w")
+        self._fh.write('{"version": 1, "refs": {\n')
+        self._first = True
+
+    def _write(self, key: str, value: object) -> None:
+        if not self._first:
+            self._fh.write(",\n")
+        self._first = False
+        self._fh.write(json.dumps(key) + ": " + json.dumps(value))
+
+    def metadata(self, key: str, value: dict) -> None:
+        self._write(key, json.dumps(value))
+
+    def variable(self, var: _ExportVariable) -> None:
+        pass
+
+    def chunks(self, var: _ExportVariable, url: str, indices: numpy.ndarray,
+               byte_offsets: numpy.ndarray, sizes: numpy.ndarray) -> None:
+        for index, offset, size in zip(indices, byte_offsets, sizes):
+            key = var.key + "/" + ".".join(str(i) for i in index)
+            self._write(key, [url, int(offset), int(size)])
+
+    def close(self) -> None:
+        self._fh.write("\n}}\n")
+        self._fh.close()
+
+class _ParquetWriter:
+    def __init__(self, path: str, record_size: int):
+        """Write a kerchunk Parquet reference directory.  The references of
+        each variable are written as record_size rows (chunks) per Parquet
+        file, and each file is written as soon as all of its chunks have been
+        found, so only the incomplete records are held in memory."""
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                "pyarrow is required to export Parquet references"
+            )
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._path = path
+        self._record_size = record_size
+        self._metadata = {}
+        self._urls = {}
+        # the incomplete records of each variable, keyed by record number, as
+        # (url index, byte offsets, sizes, number of chunks found), and the
+        # records written
+        self._records = {}
+        self._written = {}
+        os.makedirs(path, exist_ok=True)
+
+    def metadata(self, key: str, value: dict) -> None:
+        self._metadata[key] = value
+
+    def _recordLength(self, var: _ExportVariable, r: int) -> int:
+        """Get the number of chunks in record r of a variable"""
+        n = int(numpy.prod(var.grid))
+        return min(self._record_size, n - r * self._record_size)
+
+    def _newRecord(self, var: _ExportVariable, r: int) -> list:
+        n = self._recordLength(var, r)
+        return [numpy.full(n, -1, dtype="i4"), numpy.zeros(n, dtype="i8"),
+                numpy.zeros(n, dtype="i8"), 0]
+
+    def _writeRecord(self, var: _ExportVariable, r: int,
+                     record: list) -> None:
+        """Write record r of a variable to its Parquet file"""
+        url_index, byte_offsets, sizes, found = record
+        urls = list(self._urls)
+        var_dir = os.path.join(self._path, var.key)
+        os.makedirs(var_dir, exist_ok=True)
+        table = self._pa.table({
+            "path": [urls[u] if u >= 0 else None for u in url_index],
+            "offset": byte_offsets,
+            "size": sizes,
+            "raw": self._pa.nulls(len(url_index), self._pa.binary()),
+        })
+        self._pq.write_table(table, os.path.join(var_dir, f"refs.{r}.parq"))
+        self._written.setdefault(var.key, set()).add(r)
+
+    def variable(self, var: _ExportVariable) -> None:
+        """Write the remaining records of a complete variable, including
+        those without any stored chunks"""
+        records = self._records.pop(var.key, {})
+        written = self._written.pop(var.key, set())
+        n_records = -(-int(numpy.prod(var.grid)) // self._record_size)
+        for r in range(0, n_records):
+            if r in written:
+                continue
+            record = records.pop(r, None)
+            if record is None:
+                record = self._newRecord(var, r)
+            self._writeRecord(var, r, record)
+
+    def chunks(self, var: _ExportVariable, url: str, indices: numpy.ndarray,
+               byte_offsets: numpy.ndarray, sizes: numpy.ndarray) -> None:
+        records = self._records.setdefault(var.key, {})
+        u = self._urls.setdefault(url, len(self._urls))
+        flat = numpy.ravel_multi_index(tuple(indices.T), var.grid)
+        rec = flat // self._record_size
+        for r in numpy.unique(rec).tolist():
+            select = rec == r
+            if r not in records:
+                records[r] = self._newRecord(var, r)
+            record = records[r]
+            i = flat[select] - r * self._record_size
+            record[0][i] = u
+            record[1][i] = byte_offsets[select]
+            record[2][i] = sizes[select]
+            record[3] += len(i)
+            if record[3] == len(record[0]):
+                self._writeRecord(var, r, records.pop(r))
+
+    def close(self) -> None:
+        with open(os.path.join(self._path, ".zmetadata"), "w") as fh:
+            json.dump({"metadata": self._metadata,
+                       "record_size": self._record_size}, fh)
+
+def _key(nc_grp: object, name: str) -> str:
+    """Get the Zarr key of the variable name in the netCDF group nc_grp"""
+    path = nc_grp.path.strip("/")
+    return name if path == "" else path + "/" + name
+
+def _aggregation_variable(grp: object, var: object) -> _ExportVariable:
+    """Get the _ExportVariable for an aggregation variable"""
+    attrs = {a: var.nc.getncattr(a) for a in var.nc.ncattrs()
+             if a not in _SKIP_ATTRIBUTES}
+    return _ExportVariable(_key(grp.nc, var.name), var.shape, var._dim_names,
+                           attrs, getattr(var.nc, "_FillValue", None))
+
+def _fragments(var: object, agg_path: str) -> Iterator[tuple]:
+    """Iterate over the (uri, address, start, span) of the fragments of an
+    aggregation variable"""
+    index = var.getFragmentIndex()
+    files = var.getFragmentFiles()
+    addresses = var.getFragmentColumn("address")
+    for frag_loc in numpy.ndindex(*index.frag_def):
+        if addresses[frag_loc] is None:
+            # absent fragments are read as the fill value
+            continue
+        extent = index.getExtent(frag_loc)
+        start = tuple(e[0] for e in extent)
+        span = tuple(e[1] - e[0] for e in extent)
+        uri = files[frag_loc]
+        if uri is None:
+            uri = agg_path
+        yield (uri, addresses[frag_loc], start, span)
+
+def _export_variables(ds: object, agg_path: str) -> Iterator[tuple]:
+    """Iterate over the variables to export, one at a time: each aggregation
+    variable followed by its coordinate variables (if they have not already
+    been exported).  Yields (_ExportVariable, iterator over its fragments)"""
+    exported = set()
+    for grp, var in ds.CFA.walkVariables():
+        ev = _aggregation_variable(grp, var)
+        exported.add(ev.key)
+        yield ev, _fragments(var, agg_path)
+        for dim in var.getDimensions():
+            nc_var = var._findNetCDFVariable(dim.name)
+            if nc_var is None:
+                continue
+            key = _key(nc_var.group(), nc_var.name)
+            # aggregated coordinates are exported as aggregation variables
+            if key in exported or "aggregated_data" in nc_var.ncattrs():
+                continue
+            exported.add(key)
+            attrs = {a: nc_var.getncattr(a) for a in nc_var.ncattrs()
+                     if a not in _SKIP_ATTRIBUTES}
+            ev = _ExportVariable(key, nc_var.shape,
+                                 list(nc_var.dimensions), attrs,
+                                 getattr(nc_var, "_FillValue", None))
+            shape = tuple(nc_var.shape)
+            yield ev, iter([(agg_path, nc_var.name, (0,) * len(shape),
+                             shape)])
+
+def _export_batch(ev: _ExportVariable, batch: list[tuple], writer: object,
+                  scan: Callable) -> set[str]:
+    """Scan the files of a batch of fragments of a variable and write their
+    references.  Returns the files scanned."""
+    by_file = {}
+    for fragment in batch:
+        by_file.setdefault(fragment[0], []).append(fragment)
+    uris = list(by_file)
+    addresses = [sorted(set(f[1] for f in by_file[uri])) for uri in uris]
+    for uri, layouts in zip(uris, scan(uris, addresses)):
+        for uri, address, start, span in by_file[uri]:
+            refs = ev.chunkRefs(start, span, layouts[address])
+            writer.chunks(ev, uri, *refs)
+    return set(uris)
+
+def export_references(ds: object, path: str, format: str=None,
+                      workers: int=None, batch_size: int=1024,
+                      record_size: int=100000) -> dict:
+    """Export the aggregation variables (and coordinate variables) of the read
+    mode CFADataset ds as a kerchunk reference set at path.  format is "json"
+    or "parquet", and defaults to "parquet" if path ends with .parq or
+    .parquet.  The variables are exported one at a time, and the fragment 
+    files of each are scanned by workers processes, batch_size fragments at a
+    time, with the references of each batch written before the next is 
+    scanned, so the references are not all held in memory.  Returns a
+    summary of the number of variables, files and fragments exported."""
+    if format is None:
+        format = "json"
+        if path.endswith((".parq", ".parquet")):
+            format = "parquet"
+    if format == "json":
+        writer = _JSONWriter(path)
+    elif format == "parquet":
+        writer = _ParquetWriter(path, record_size)
+    else:
+        raise CFAException(f"Unknown reference format {format}")
+
+    with CFAPython.nc_lock:
+        agg_path = os.path.abspath(ds.filepath())
+
+    pool = None
+    if workers:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        scan = lambda uris, addresses: pool.map(_scan_file, uris, addresses)
+    else:
+        scan = lambda uris, addresses: map(_scan_file, uris, addresses)
+
+    n_vars = n_frags = 0
+    files = set()
+    groups = set()
+    try:
+        writer.metadata(".zgroup", {"zarr_format": 2})
+        for ev, fragments in _export_variables(ds, agg_path):
+            parts = ev.key.split("/")[:-1]
+            for g in ("/".join(parts[:i+1]) for i in range(0, len(parts))):
+                if g not in groups:
+                    groups.add(g)
+                    writer.metadata(g + "/.zgroup", {"zarr_format": 2})
+            n = 0
+            batch = []
+            for fragment in fragments:
+                batch.append(fragment)
+                if len(batch) == batch_size:
+                    files |= _export_batch(ev, batch, writer, scan)
+                    n += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                files |= _export_batch(ev, batch, writer, scan)
+                n += len(batch)
+            # the chunks of a variable are defined by its first fragment
+            if n == 0:
+                raise CFAException(f"Variable {ev.key} has no fragments to "
+                                   "define its chunks")
+            writer.metadata(ev.key + "/.zarray", ev.zarray())
+            writer.metadata(ev.key + "/.zattrs", ev.zattrs())
+            writer.variable(ev)
+            n_vars += 1
+            n_frags += n
+    finally:
+        if pool:
+            pool.shutdown()
+        writer.close()
+    return {"variables": n_vars, "files": len(files), "fragments": n_frags}
+
+def main(argv: list[str]=None) -> int:
+    """Command line interface to export a CFA-netCDF file as kerchunk
+    references"""
+    from CFAPython.CFADataset import CFADataset
+    parser = argparse.ArgumentParser(
+        prog="cfa-references",
+        description="Export a CFA-netCDF file as a kerchunk reference set"
+    )
+    parser.add_argument("file", help="the CFA-netCDF file to export")
+    parser.add_argument("out", help="the reference JSON file, or Parquet "
+                                    "directory, to write")
+    parser.add_argument("--format", choices=["json", "parquet"], default=None,
+                        help="the reference format (default: from out)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    ds = CFADataset(args.file, mode='r')
+    try:
+        summary = export_references(ds, args.out, args.format, args.workers)
+    finally:
+        ds.close()
+    print(f"{summary['fragments']} fragments in {summary['files']} files "
+          f"exported for {summary['variables']} variables")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""Rewriting of an aggregation variable with a new fragment layout, e.g. to
+consolidate daily fragments into monthly ones, or to tile them spatially.
+Each new fragment is read from the existing fragments and written to a new
+fragment file, one fragment per task, on a pool of worker processes, and a new
+CFA-netCDF file is written that refers to the new fragments.  Each new
+fragment is copied in chunks of at most a bounded number of bytes, so memory
+use does not grow with the size of the new fragments.
+
+Usage: python -m CFAPython.CFARefragment [--workers N] [--out F] file variable
+                                         frag_def out_dir
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable
+import argparse
+import atexit
+import os
+import os.path
+import sys
+
+import numpy
+from netCDF4 import Dataset
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import CFAFragmentIndex
+
+# attributes written by the CFA-C library, which are not copied
+_CFA_ATTRIBUTES = ("aggregated_dimensions", "aggregated_data")
+
+# the aggregation file opened by each worker process
+_worker_ds = None
+
+# the default maximum size of the chunks a new fragment is copied in (bytes)
+CHUNK_BYTES = 64 * 1024 * 1024
+
+def _init_worker(agg_path: str) -> None:
+    """Open the aggregation file once in each worker process"""
+    global _worker_ds
+    from CFAPython.CFADataset import CFADataset
+    _worker_ds = CFADataset(agg_path, mode='r')
+    atexit.register(_worker_ds.close)
+
+def _find_variable(ds: object, var_path: str) -> object:
+    """Find the aggregation variable at var_path (group path and name)"""
+    for grp, var in ds.CFA.walkVariables():
+        if grp.nc.path.rstrip("/") + "/" + var.name == var_path:
+            return var
+    raise CFAException(f"Variable {var_path} not found")
+
+def _var_path(var: object) -> str:
+    """Get the path of an aggregation variable in its file"""
+    with CFAPython.nc_lock:
+        return var.nc.group().path.rstrip("/") + "/" + var.name
+
+def _chunks(extent: list[tuple[int, int]], itemsize: int,
+            max_bytes: int) -> list[tuple[slice]]:
+    """Divide extent into chunks of at most max_bytes (but at least one
+    element).  Trailing dimensions are taken whole while they fit, so that
+    each chunk is contiguous.  Returns the slices of each chunk, relative to
+    the start of extent."""
+    shape = [e1 - e0 for e0, e1 in extent]
+    chunk = [1] * len(shape)
+    n = max(1, max_bytes // max(1, itemsize))
+    for d in range(len(shape) - 1, -1, -1):
+        chunk[d] = max(1, min(shape[d], n))
+        if chunk[d] < shape[d]:
+            break
+        n //= max(1, shape[d])
+    grid = [-(-size // c) for size, c in zip(shape, chunk)]
+    return [tuple(slice(i * c, min((i + 1) * c, size))
+                  for i, c, size in zip(loc, chunk, shape))
+            for loc in numpy.ndindex(*grid)]
+
+def _write_fragment(var: object, extent: list[tuple[int, int]],
+                    frag_path: str, chunk_bytes: int=CHUNK_BYTES) -> str:
+    """Copy the aggregated data of var within extent, with the corresponding
+    coordinates, to a new fragment file at frag_path, in chunks of at most
+    chunk_bytes"""
+    key = tuple(slice(e0, e1) for e0, e1 in extent)
+    dims = var._dim_names
+    with CFAPython.nc_lock:
+        attrs = {a: var.nc.getncattr(a) for a in var.nc.ncattrs()
+                 if a not in _CFA_ATTRIBUTES}
+        coords = {}
+        for d, (dim, k) in enumerate(zip(dims, key)):
+            nc_coord = var._findNetCDFVariable(dim)
+            if nc_coord is not None and nc_coord.dimensions == (dim,):
+                coords[dim] = (nc_coord[k], nc_coord.dtype,
+                               {a: nc_coord.getncattr(a)
+                                for a in nc_coord.ncattrs()})
+        fill_value = attrs.pop("_FillValue", None)
+        nc_frag = Dataset(frag_path, mode='w')
+    try:
+        with CFAPython.nc_lock:
+            for dim, (e0, e1) in zip(dims, extent):
+                nc_frag.createDimension(dim, e1 - e0)
+            for dim, (values, dtype, coord_attrs) in coords.items():
+                coord_fill = coord_attrs.pop("_FillValue", None)
+                nc_coord = nc_frag.createVariable(dim, dtype, (dim,),
+                                                  fill_value=coord_fill)
+                nc_coord.setncatts(coord_attrs)
+                nc_coord[:] = values
+            nc_var = nc_frag.createVariable(var.name, var.dtype, tuple(dims),
+                                            fill_value=fill_value)
+            nc_var.setncatts(attrs)
+        # the aggregated data is read without holding nc_lock
+        for chunk in _chunks(extent, var.dtype.itemsize, chunk_bytes):
+            data = var[tuple(slice(e0 + c.start, e0 + c.stop)
+                             for (e0, e1), c in zip(extent, chunk))]
+            with CFAPython.nc_lock:
+                nc_var[chunk] = data
+    finally:
+        with CFAPython.nc_lock:
+            nc_frag.close()
+    return frag_path
+
+def _write_fragment_worker(var_path: str, extent: list[tuple[int, int]],
+                           frag_path: str, chunk_bytes: int) -> str:
+    """Write a new fragment in a worker process"""
+    return _write_fragment(_find_variable(_worker_ds, var_path), extent,
+                           frag_path, chunk_bytes)
+
+def _run_bounded(pool: object, func: Callable, jobs: list[tuple],
+                 window: int) -> None:
+    """Run func(*job) for each job on the executor pool, with at most window
+    jobs in flight at once: a job is submitted as soon as any other finishes,
+    so a slow job does not hold up the rest.  Raises the first error."""
+    jobs = iter(jobs)
+    in_flight = set()
+    try:
+        while True:
+            for job in jobs:
+                in_flight.add(pool.submit(func, *job))
+                if len(in_flight) >= window:
+                    break
+            if len(in_flight) == 0:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def _new_index(shape: list[int], new_frag_def: list[object]) -> object:
+    """Get the CFAFragmentIndex of a new fragmentation, given for each
+    dimension as the number of fragments (dividing the dimension as evenly as
+    possible) or the size of each fragment"""
+    if len(new_frag_def) != len(shape):
+        raise CFAException(
+            "Fragment definition does not match the aggregated dimensions"
+        )
+    sizes = []
+    for size, n in zip(shape, new_frag_def):
+        if isinstance(n, (int, numpy.integer)):
+            sizes.append(CFAFragmentIndex.regular([size], [n]).sizes[0])
+        else:
+            sizes.append(numpy.asarray(n, dtype=numpy.int64))
+            if len(sizes[-1]) == 0 or numpy.any(sizes[-1] <= 0):
+                raise CFAException("Fragment sizes must be positive")
+    return CFAFragmentIndex(shape, sizes)
+
+def refragment(var: object, new_frag_def: list[object], out_dir: str,
+               out_path: str=None, workers: int=None,
+               window: int=None, chunk_bytes: int=CHUNK_BYTES) -> str:
+    """Rewrite the aggregation variable var (of a read mode CFADataset) with
+    the fragmentation new_frag_def, which gives for each dimension either the
+    number of fragments, which divide the dimension as evenly as possible
+    (see CFAFragmentIndex.regular), or a list of the size of each fragment,
+    e.g. the lengths of the months for monthly fragments, or [365] for a
+    single fragment of size 365.  The new fragment files are written to 
+    out_dir by workers processes, with at most window fragments in flight 
+    at once (a new fragment is started as soon as any finishes), each 
+    copied in chunks of at most 
+    chunk_bytes, and a new CFA-netCDF file is written to out_path (by 
+    default, <variable>.nc in out_dir) that refers to them.  Returns 
+    out_path."""
+    from CFAPython.CFADataset import CFADataset
+    index = _new_index(var.shape, list(new_frag_def))
+    new_frag_def = index.frag_def
+    os.makedirs(out_dir, exist_ok=True)
+    if out_path is None:
+        out_path = os.path.join(out_dir, var.name + ".nc")
+
+    # the new fragment files, named by fragment location
+    width = len(str(max(new_frag_def) - 1))
+    frag_locs = list(numpy.ndindex(*new_frag_def))
+    frag_paths = [
+        os.path.join(out_dir, var.name + "_" +
+                     "_".join(str(f).zfill(width) for f in frag_loc) + ".nc")
+        for frag_loc in frag_locs
+    ]
+    extents = [index.getExtent(frag_loc) for frag_loc in frag_locs]
+
+    if workers:
+        with CFAPython.nc_lock:
+            agg_path = os.path.abspath(var.nc.group().filepath())
+        var_path = _var_path(var)
+        window = window or workers * 2
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(agg_path,)) as pool:
+            _run_bounded(pool, _write_fragment_worker,
+                         [(var_path, extent, frag_path, chunk_bytes)
+                          for extent, frag_path in zip(extents, frag_paths)],
+                         window)
+    else:
+        for extent, frag_path in zip(extents, frag_paths):
+            _write_fragment(var, extent, frag_path, chunk_bytes)
+
+    # the new aggregation file
+    out_dir_abs = os.path.dirname(os.path.abspath(out_path))
+    files = numpy.empty(new_frag_def, dtype=object)
+    for frag_loc, frag_path in zip(frag_locs, frag_paths):
+        files[frag_loc] = os.path.relpath(os.path.abspath(frag_path),
+                                          out_dir_abs)
+    ds = CFADataset(out_path, mode='w')
+    try:
+        for dim in var.getDimensions():
+            ds.CFA.createDimension(dim.name, dim.type, dim.size)
+            with CFAPython.nc_lock:
+                src = var._findNetCDFVariable(dim.name)
+                if src is not None and dim.name in ds.variables:
+                    dst = ds.variables[dim.name]
+                    dst.setncatts({a: src.getncattr(a) for a in src.ncattrs()
+                                   if a != "_FillValue"})
+                    dst[:] = src[:]
+        new_var = ds.CFA.createVariable(var.name, var._variable.type,
+                                        var._dim_names)
+        new_var.setAggregationInstruction({
+            "location": ("aggregation_location", False,
+                         CFAPython.CFAType.CFAInt),
+            "file"    : ("aggregation_file", False,
+                         CFAPython.CFAType.CFAString),
+            "format"  : ("aggregation_format", True,
+                         CFAPython.CFAType.CFAString),
+            "address" : ("aggregation_address", False,
+                         CFAPython.CFAType.CFAString),
+        })
+        new_var.setFragmentDefinition(new_frag_def)
+        new_var.setFragments({"file": files, "format": "nc",
+                              "address": var.name}, sizes=index.sizes)
+        with CFAPython.nc_lock:
+            new_var.nc.setncatts({a: var.nc.getncattr(a)
+                                  for a in var.nc.ncattrs()
+                                  if a not in _CFA_ATTRIBUTES and
+                                  a != "_FillValue"})
+    finally:
+        ds.close()
+    return out_path
+
+def _parse_frag_def(frag_def: str) -> list[object]:
+    """Parse the fragmentation given on the command line: for each dimension
+    (separated by ','), the number of fragments, or the sizes of the 
+    fragments separated by ':' (with a trailing ':' for a single fragment of
+    the given size)"""
+    return [int(n) if ":" not in n else [int(s) for s in n.split(":") if s]
+            for n in frag_def.split(",")]
+
+def main(argv: list[str]=None) -> int:
+    """Command line interface to refragment an aggregation variable"""
+    from CFAPython.CFADataset import CFADataset
+    parser = argparse.ArgumentParser(
+        prog="cfa-refragment",
+        description="Rewrite an aggregation variable with a new fragment "
+                    "layout"
+    )
+    parser.add_argument("file", help="the CFA-netCDF file")
+    parser.add_argument("variable", help="the aggregation variable")
+    parser.add_argument("frag_def", help="the number of fragments along each "
+                                         "dimension, e.g. 12,1,1, or the "
+                                         "sizes of the fragments separated "
+                                         "by ':', e.g. 31:28:31,1,1, with a "
+                                         "trailing ':' for a single "
+                                         "fragment, e.g. 365:,1,1")
+    parser.add_argument("out_dir", help="the directory for the new fragments")
+    parser.add_argument("--out", default=None,
+                        help="the new CFA-netCDF file (default: "
+                             "out_dir/<variable>.nc)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    frag_def = _parse_frag_def(args.frag_def)
+    ds = CFADataset(args.file, mode='r')
+    try:
+        var = _find_variable(ds, "/" + args.variable.lstrip("/"))
+        out_path = refragment(var, frag_def, args.out_dir, args.out,
+                              args.workers)
+    finally:
+        ds.close()
+    print(f"{args.variable} refragmented into {out_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
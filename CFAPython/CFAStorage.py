@@ -0,0 +1,488 @@
+"""Storage backends for reading (and writing) fragments.  The backend for a
+fragment is selected by the scheme of its file URI:
+
+    no scheme   : CFAPosixBackend, a path on the local file system
+    file://     : CFAFileURIBackend, a file URI on the local file system
+    (any other) : CFAFsspecBackend, any file system supported by fsspec, e.g.
+                  s3:// or https://
+
+Each backend keeps a bounded pool of open fragment files (or connections, for
+remote file systems), so that fragments in the same file do not reopen it, and
+keeps statistics of its activity.  Other backends can be added with
+register_backend.
+"""
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Iterator
+import abc
+import contextlib
+from urllib.parse import urlparse, unquote
+import threading
+import time
+
+import numpy
+from netCDF4 import Dataset, default_fillvals
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+
+class CFAStorageStats:
+    def __init__(self):
+        """Statistics of the activity of a storage backend"""
+        self._lock = threading.Lock()
+        self.opens = 0          # number of files opened
+        self.pool_hits = 0      # number of reads from an already open file
+        self.reads = 0          # number of fragment reads
+        self.writes = 0         # number of fragment writes
+        self.range_requests = 0 # number of byte-range requests
+        self.bytes_read = 0     # number of bytes read by byte-range requests
+        self.read_time = 0.0    # time spent reading (seconds)
+
+    def add(self, **kwargs) -> None:
+        """Increment the statistics named by the keyword arguments"""
+        with self._lock:
+            for name, value in kwargs.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self) -> dict:
+        """Return the statistics as a dictionary"""
+        return {k: v for k, v in self.__dict__.items() if k != "_lock"}
+
+    def __str__(self):
+        return f"{self.__class__}: {self.to_dict()}"
+
+    def __repr__(self):
+        return self.__str__()
+
+class _PoolEntry:
+    """A file in the pool of a storage backend.  refs counts the users of the
+    file, which is only closed once it has been evicted from the pool and has
+    no users."""
+    __slots__ = ("mode", "nc_object", "refs", "evicted", "ready", "error")
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.nc_object = None
+        self.refs = 0
+        self.evicted = False
+        # set once the file has been opened (or has failed to open)
+        self.ready = threading.Event()
+        self.error = None
+
+class CFAStorageBackend(abc.ABC):
+    def __init__(self, max_open: int=64):
+        """Base class for storage backends.  Subclasses implement _open, to
+        open a fragment file as a netCDF4 (like) Dataset, exists and 
+        read_range.  At most max_open files are kept open in the pool (more
+        while more are in use), with the mode they were opened with.  The 
+        pool is only locked while a file is looked up, so files can be read
+        concurrently when _lock allows it, and a file is not closed while it
+        is in use."""
+        self._max_open = max_open
+        self._pool = OrderedDict()
+        self._pool_lock = threading.RLock()
+        self.stats = CFAStorageStats()
+
+    def __str__(self):
+        return f"{self.__class__}: open={len(self._pool)}, stats={self.stats}"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def _lock(self) -> object:
+        """The lock to hold while reading from a file opened by this backend.
+        netCDF-C is not thread-safe, so this is nc_lock by default."""
+        return CFAPython.nc_lock
+
+    @abc.abstractmethod
+    def _open(self, uri: str, mode: str='r') -> object:
+        """Open the file at uri as a netCDF4 (like) Dataset, with mode 'r' to
+        read or 'a' to read and write, holding _lock only while the file is
+        opened (not while it is fetched)"""
+
+    @abc.abstractmethod
+    def exists(self, uri: str) -> bool:
+        """Return whether the file at uri exists"""
+
+    @abc.abstractmethod
+    def read_range(self, uri: str, offset: int, size: int) -> bytes:
+        """Read size bytes from offset in the file at uri"""
+
+    def read_ranges(self, uri: str, ranges: list[tuple[int, int]]) -> list[bytes]:
+        """Read several (offset, size) byte ranges from the file at uri"""
+        return [self.read_range(uri, offset, size) for offset, size in ranges]
+
+    def _evict(self, uri: str) -> list[_PoolEntry]:
+        """Remove the file at uri from the pool, holding _pool_lock.  Returns
+        the entries to close: the file, if it is not in use."""
+        entry = self._pool.pop(uri)
+        entry.evicted = True
+        return [entry] if entry.refs == 0 else []
+
+    def _trim(self) -> list[_PoolEntry]:
+        """Evict the least recently used files that are not in use while the
+        pool is full, holding _pool_lock.  Returns the entries to close."""
+        to_close = []
+        for uri in list(self._pool):
+            if len(self._pool) <= self._max_open:
+                break
+            if self._pool[uri].refs == 0:
+                to_close.extend(self._evict(uri))
+        return to_close
+
+    def _closeDataset(self, nc_object: object) -> None:
+        """Close a Dataset opened by _open"""
+        with self._lock:
+            nc_object.close()
+
+    def _close(self, entries: list[_PoolEntry]) -> None:
+        """Close the files of evicted entries, not holding _pool_lock"""
+        for entry in entries:
+            if entry.nc_object is not None:
+                self._closeDataset(entry.nc_object)
+                entry.nc_object = None
+
+    def _acquire(self, uri: str, mode: str='r') -> _PoolEntry:
+        """Get the pool entry for the file at uri, opening the file (outside
+        _pool_lock) if it is not open, and mark it as in use.  A file open 
+        for reading is reopened if mode is 'a'."""
+        to_close = []
+        with self._pool_lock:
+            entry = self._pool.get(uri, None)
+            hit = entry is not None and (entry.mode == 'a' or mode == 'r')
+            if hit:
+                self._pool.move_to_end(uri)
+            else:
+                if entry is not None:
+                    to_close = self._evict(uri)
+                entry = _PoolEntry(mode)
+                self._pool[uri] = entry
+            entry.refs += 1
+            to_close.extend(self._trim())
+        self._close(to_close)
+
+        if hit:
+            entry.ready.wait()
+            if entry.error is not None:
+                self._unpin(entry)
+                raise entry.error
+            self.stats.add(pool_hits=1)
+            return entry
+        try:
+            entry.nc_object = self._open(uri, mode)
+        except BaseException as e:
+            entry.error = e
+            with self._pool_lock:
+                if self._pool.get(uri, None) is entry:
+                    self._pool.pop(uri)
+            entry.ready.set()
+            raise
+        entry.ready.set()
+        self.stats.add(opens=1)
+        return entry
+
+    def _unpin(self, entry: _PoolEntry) -> None:
+        """Mark a pool entry as no longer in use by one user, closing its file
+        if it has been evicted and this was the last user"""
+        with self._pool_lock:
+            entry.refs -= 1
+            to_close = [entry] if entry.refs == 0 and entry.evicted else []
+        self._close(to_close)
+
+    @contextlib.contextmanager
+    def dataset(self, uri: str, mode: str='r') -> Iterator[object]:
+        """Use the open Dataset for the file at uri from the pool, opening it
+        if it is not open.  The file is not closed while it is in use.  Hold
+        _lock while using the Dataset."""
+        entry = self._acquire(uri, mode)
+        try:
+            yield entry.nc_object
+        finally:
+            self._unpin(entry)
+
+    def release(self, uri: str) -> None:
+        """Close the file at uri, if it is open in the pool, e.g. before it
+        is opened by another process.  A file in use is closed when it is no
+        longer in use."""
+        with self._pool_lock:
+            to_close = self._evict(uri) if uri in self._pool else []
+        self._close(to_close)
+
+    def read(self, uri: str, address: str, slices: tuple) -> numpy.ndarray:
+        """Read the selection slices of the variable address in the file at
+        uri"""
+        return self.read_many(uri, [(address, slices)])[0]
+
+    def read_many(self, uri: str,
+                  selections: list[tuple[str, tuple]]) -> list[numpy.ndarray]:
+        """Read several (address, slices) selections from the file at uri,
+        getting the open file from the pool once"""
+        t0 = time.perf_counter()
+        with self.dataset(uri) as nc_object:
+            with self._lock:
+                data = [_read_variable(nc_object[address], slices)
+                        for address, slices in selections]
+        self.stats.add(reads=len(selections),
+                       read_time=time.perf_counter() - t0)
+        return data
+
+    def attribute(self, uri: str, address: str, name: str) -> object:
+        """Get the attribute name of the variable address in the file at uri,
+        or None if it does not have the attribute"""
+        with self.dataset(uri) as nc_object:
+            with self._lock:
+                nc_var = nc_object[address]
+                if hasattr(nc_var, "attrs"):
+                    # h5netcdf variables
+                    return nc_var.attrs.get(name, None)
+                return getattr(nc_var, name, None)
+
+    def shape(self, uri: str, address: str) -> tuple[int]:
+        """Get the shape of the variable address in the file at uri"""
+        with self.dataset(uri) as nc_object:
+            with self._lock:
+                return tuple(nc_object[address].shape)
+
+    def write(self, uri: str, address: str, slices: tuple,
+              data: numpy.ndarray) -> None:
+        """Write data into the selection slices of the variable address in
+        the file at uri"""
+        with self.dataset(uri, mode='a') as nc_object:
+            with self._lock:
+                nc_object[address][slices] = data
+        self.stats.add(writes=1)
+
+    def sync(self, uri: str=None) -> None:
+        """Flush the writes to the file at uri (or all files) to storage"""
+        with self._pool_lock:
+            entries = [e for pool_uri, e in self._pool.items()
+                       if e.mode == 'a' and e.ready.is_set() and 
+                       e.error is None and (uri is None or uri == pool_uri)]
+            for entry in entries:
+                entry.refs += 1
+        for entry in entries:
+            try:
+                with self._lock:
+                    entry.nc_object.sync()
+            finally:
+                self._unpin(entry)
+
+    def close(self) -> None:
+        """Close all the files in the pool (files in use are closed when they
+        are no longer in use)"""
+        with self._pool_lock:
+            to_close = []
+            for uri in list(self._pool):
+                to_close.extend(self._evict(uri))
+        self._close(to_close)
+
+class CFAPosixBackend(CFAStorageBackend):
+    """Backend for fragments given as paths on the local file system"""
+
+    def _path(self, uri: str) -> str:
+        """Convert a uri to a path"""
+        return uri
+
+    def _open(self, uri: str, mode: str='r') -> object:
+        with self._lock:
+            return Dataset(self._path(uri), mode=mode)
+
+    def exists(self, uri: str) -> bool:
+        import os.path
+        return os.path.exists(self._path(uri))
+
+    def read_range(self, uri: str, offset: int, size: int) -> bytes:
+        with open(self._path(uri), "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(size)
+        self.stats.add(range_requests=1, bytes_read=len(data))
+        return data
+
+class CFAFileURIBackend(CFAPosixBackend):
+    """Backend for fragments given as file:// URIs"""
+
+    def _path(self, uri: str) -> str:
+        return unquote(urlparse(uri).path)
+
+class CFAFsspecBackend(CFAStorageBackend):
+    def __init__(self, max_open: int=64, block_size: int=8*1024*1024,
+                 **storage_options):
+        """Backend for fragments on any file system supported by fsspec, e.g.
+        object storage (s3://) or web servers (https://).  storage_options are
+        passed to fsspec.filesystem, e.g. the endpoint_url of an S3-compatible
+        object store.  One file system instance (with its connection pool) is
+        kept per protocol.
+        If h5netcdf is installed then fragments are opened with it, so only
+        the byte ranges that contain the requested data are fetched.
+        Otherwise the whole fragment file is fetched, as concurrent byte-range
+        requests of block_size, and opened in memory."""
+        super().__init__(max_open)
+        try:
+            import fsspec
+        except ImportError:
+            raise ImportError(
+                "fsspec is required to read fragments from remote storage"
+            )
+        self._fsspec = fsspec
+        self._block_size = block_size
+        self._storage_options = storage_options
+        self._filesystems = {}
+        # the fsspec file handle of each file opened with h5netcdf, keyed by
+        # the id of the h5netcdf File
+        self._handles = {}
+        try:
+            import h5netcdf
+            self._h5netcdf = h5netcdf
+        except ImportError:
+            self._h5netcdf = None
+
+    @property
+    def _lock(self) -> object:
+        # h5py serialises its own calls, so files opened with h5netcdf do not
+        # need to hold nc_lock
+        if self._h5netcdf is not None:
+            return _NO_LOCK
+        return CFAPython.nc_lock
+
+    def _filesystem(self, uri: str) -> object:
+        """Get the (cached) fsspec file system for the protocol of uri"""
+        protocol = urlparse(uri).scheme
+        with self._pool_lock:
+            if protocol not in self._filesystems:
+                self._filesystems[protocol] = self._fsspec.filesystem(
+                    protocol, **self._storage_options
+                )
+            return self._filesystems[protocol]
+
+    def _open(self, uri: str, mode: str='r') -> object:
+        if mode != 'r':
+            raise CFAException(f"Fragment {uri} in remote storage cannot be "
+                               "written")
+        fs = self._filesystem(uri)
+        if self._h5netcdf is not None:
+            fh = fs.open(uri, mode="rb", block_size=self._block_size)
+            try:
+                with self._lock:
+                    nc_object = self._h5netcdf.File(fh, mode="r")
+            except BaseException:
+                fh.close()
+                raise
+            with self._pool_lock:
+                self._handles[id(nc_object)] = fh
+            return nc_object
+        # fetch the whole file with concurrent byte-range requests
+        size = fs.size(uri)
+        ranges = [(offset, min(self._block_size, size - offset))
+                  for offset in range(0, size, self._block_size)]
+        data = b"".join(self.read_ranges(uri, ranges))
+        with self._lock:
+            return Dataset(uri, mode='r', memory=data)
+
+    def _closeDataset(self, nc_object: object) -> None:
+        super()._closeDataset(nc_object)
+        with self._pool_lock:
+            fh = self._handles.pop(id(nc_object), None)
+        if fh is not None:
+            fh.close()
+
+    def exists(self, uri: str) -> bool:
+        return self._filesystem(uri).exists(uri)
+
+    def read_range(self, uri: str, offset: int, size: int) -> bytes:
+        return self.read_ranges(uri, [(offset, size)])[0]
+
+    def read_ranges(self, uri: str, ranges: list[tuple[int, int]]) -> list[bytes]:
+        # fsspec fetches the ranges concurrently for asynchronous file systems
+        fs = self._filesystem(uri)
+        data = fs.cat_ranges([uri] * len(ranges),
+                             [offset for offset, size in ranges],
+                             [offset + size for offset, size in ranges])
+        self.stats.add(range_requests=len(ranges),
+                       bytes_read=sum(len(d) for d in data))
+        return data
+
+def _read_variable(nc_var: object, slices: tuple) -> numpy.ndarray:
+    """Read the selection slices of a netCDF4 or h5netcdf variable.  The data
+    of h5netcdf variables are masked and scaled as netCDF4 does."""
+    data = nc_var[slices]
+    if hasattr(nc_var, "attrs"):
+        data = _mask_and_scale(data, nc_var.dtype, nc_var.attrs)
+    return data
+
+def _mask_and_scale(data: numpy.ndarray, dtype: object,
+                    attrs: object) -> numpy.ndarray:
+    """Mask the values of data equal to the _FillValue (or the default fill
+    value of dtype, other than for bytes) or missing_value attributes, then
+    apply the scale_factor and add_offset attributes"""
+    dtype = numpy.dtype(dtype)
+    values = numpy.ma.getdata(data)
+    mask = numpy.ma.getmaskarray(data).copy()
+    fill_values = [attrs.get("_FillValue", None)]
+    if fill_values[0] is None and dtype.itemsize > 1:
+        fill_values = [default_fillvals.get(dtype.str[1:], None)]
+    missing = attrs.get("missing_value", None)
+    if missing is not None:
+        fill_values.extend(numpy.atleast_1d(missing))
+    for fill_value in fill_values:
+        if fill_value is None:
+            continue
+        if dtype.kind == "f" and numpy.isnan(fill_value):
+            mask |= numpy.isnan(values)
+        else:
+            mask |= values == numpy.asarray(fill_value).astype(dtype)
+    scale = attrs.get("scale_factor", None)
+    offset = attrs.get("add_offset", None)
+    if scale is not None:
+        values = values * scale
+    if offset is not None:
+        values = values + offset
+    return numpy.ma.masked_array(values, mask=mask)
+
+class _NoLock:
+    """A lock that does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NO_LOCK = _NoLock()
+
+# the registered backends, keyed by URI scheme
+_backends = {}
+_backends_lock = threading.Lock()
+_backend_types = {"": CFAPosixBackend, "file": CFAFileURIBackend}
+
+def register_backend(scheme: str, backend: CFAStorageBackend) -> None:
+    """Register the backend used for fragment files with the URI scheme (e.g.
+    "s3"), replacing any backend already registered for the scheme"""
+    with _backends_lock:
+        _backends[scheme] = backend
+
+def uri_scheme(uri: str) -> str:
+    """Return the scheme of a fragment file URI, or "" for a plain path"""
+    if "://" not in uri:
+        return ""
+    return urlparse(uri).scheme
+
+def get_backend(uri: str) -> CFAStorageBackend:
+    """Get the backend for a fragment file URI, creating the default backend
+    for its scheme if none has been registered"""
+    scheme = uri_scheme(uri)
+    with _backends_lock:
+        if scheme not in _backends:
+            backend_type = _backend_types.get(scheme, CFAFsspecBackend)
+            _backends[scheme] = backend_type()
+        return _backends[scheme]
+
+def backend_stats() -> dict:
+    """Return the statistics of each backend in use, keyed by scheme"""
+    with _backends_lock:
+        return {scheme: b.stats.to_dict() for scheme, b in _backends.items()}
+
+def close_backends() -> None:
+    """Close all the files held open by the backends"""
+    with _backends_lock:
+        for backend in _backends.values():
+            backend.close()
@@ -0,0 +1,94 @@
+"""Conversion between equivalent units, e.g. for fragments stored in different
+units to their aggregation variable.  Conversions are affine (a scale and an
+offset).  If cf_units is installed it is used to find the conversion,
+otherwise a table of common units is used."""
+from __future__ import annotations
+from functools import lru_cache
+
+# the scale and offset to convert each unit to a reference unit, grouped by
+# the reference unit
+_UNITS_TABLE = {
+    "K": {
+        "K": (1.0, 0.0), "kelvin": (1.0, 0.0), "degK": (1.0, 0.0),
+        "degC": (1.0, 273.15), "degreesC": (1.0, 273.15),
+        "degree_C": (1.0, 273.15), "degrees_C": (1.0, 273.15),
+        "deg_C": (1.0, 273.15), "Celsius": (1.0, 273.15),
+        "celsius": (1.0, 273.15),
+        "degF": (5/9, 273.15 - 32*5/9), "degreesF": (5/9, 273.15 - 32*5/9),
+        "degree_F": (5/9, 273.15 - 32*5/9), "Fahrenheit": (5/9, 273.15 - 32*5/9),
+    },
+    "Pa": {
+        "Pa": (1.0, 0.0), "hPa": (100.0, 0.0), "kPa": (1000.0, 0.0),
+        "mbar": (100.0, 0.0), "millibar": (100.0, 0.0), "bar": (1e5, 0.0),
+    },
+    "m": {
+        "m": (1.0, 0.0), "metre": (1.0, 0.0), "meter": (1.0, 0.0),
+        "km": (1000.0, 0.0), "cm": (0.01, 0.0), "mm": (0.001, 0.0),
+    },
+    "kg": {
+        "kg": (1.0, 0.0), "g": (0.001, 0.0),
+    },
+    "s": {
+        "s": (1.0, 0.0), "second": (1.0, 0.0), "seconds": (1.0, 0.0),
+        "min": (60.0, 0.0), "minute": (60.0, 0.0), "minutes": (60.0, 0.0),
+        "h": (3600.0, 0.0), "hour": (3600.0, 0.0), "hours": (3600.0, 0.0),
+        "d": (86400.0, 0.0), "day": (86400.0, 0.0), "days": (86400.0, 0.0),
+    },
+    "1": {
+        "1": (1.0, 0.0), "fraction": (1.0, 0.0), "%": (0.01, 0.0),
+        "percent": (0.01, 0.0),
+    },
+}
+
+def _table_lookup(units: str) -> tuple[str, float, float]:
+    """Find (reference unit, scale, offset) for units in the table"""
+    for reference, table in _UNITS_TABLE.items():
+        if units in table:
+            return (reference,) + table[units]
+    return None
+
+def _cf_units_conversion(from_units: str, to_units: str) -> tuple:
+    """Find the conversion with cf_units, or None if it is not installed or
+    the units are not convertible"""
+    try:
+        import cf_units
+    except ImportError:
+        return None
+    try:
+        u_from = cf_units.Unit(from_units)
+        u_to = cf_units.Unit(to_units)
+        if not u_from.is_convertible(u_to):
+            return None
+        offset = float(u_from.convert(0.0, u_to))
+        scale = float(u_from.convert(1.0, u_to)) - offset
+    except ValueError:
+        return None
+    return scale, offset
+
+@lru_cache(maxsize=1024)
+def unit_conversion(from_units: str, to_units: str) -> tuple[float, float]:
+    """Get the (scale, offset) that converts values in from_units to
+    to_units, as value * scale + offset.  Returns None if no conversion is
+    needed, and raises ValueError if the units are not known to be
+    convertible."""
+    if from_units is None or to_units is None:
+        return None
+    from_units = from_units.strip()
+    to_units = to_units.strip()
+    if from_units == to_units:
+        return None
+    conversion = _cf_units_conversion(from_units, to_units)
+    if conversion is None:
+        u_from = _table_lookup(from_units)
+        u_to = _table_lookup(to_units)
+        if u_from is None or u_to is None or u_from[0] != u_to[0]:
+            raise ValueError(
+                f"Cannot convert units '{from_units}' to '{to_units}'"
+            )
+        # convert to the reference unit, and then from it
+        scale = u_from[1] / u_to[1]
+        offset = (u_from[2] - u_to[2]) / u_to[1]
+        conversion = (scale, offset)
+    if conversion == (1.0, 0.0):
+        return None
+    return conversion
@@ -0,0 +1,213 @@
+"""Validation of the present fragments of the aggregation variables in a
+CFA-netCDF file: that each fragment file exists, that it contains the variable at the
+fragment's address, and that the shape, dtype and units of that variable are
+compatible with the fragment's location and the aggregation variable.
+Fragments are grouped by file, so that each file is opened once (with the
+storage backend for its URI), and the files are checked in parallel.
+
+Usage: python -m CFAPython.CFAValidate [--workers N] [--threads] [--json] file
+"""
+from __future__ import annotations
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import json
+import os.path
+import sys
+
+import numpy
+
+import CFAPython
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAStorage import get_backend
+
+# a single problem found with a fragment
+CFAValidationIssue = namedtuple(
+    "CFAValidationIssue",
+    ["severity", "check", "variable", "index", "file", "address", "message"]
+)
+
+class CFAValidationReport:
+    def __init__(self, issues: list[CFAValidationIssue], n_fragments: int,
+                 n_files: int):
+        """The result of validating the fragments of a CFA-netCDF file"""
+        self.issues = issues
+        self.n_fragments = n_fragments
+        self.n_files = n_files
+
+    def __str__(self):
+        return (f"{self.__class__}: fragments={self.n_fragments}, "
+                f"files={self.n_files}, errors={len(self.errors)}, "
+                f"warnings={len(self.warnings)}")
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def errors(self) -> list[CFAValidationIssue]:
+        """Return the issues that prevent a fragment being read"""
+        return [i for i in self.issues if i.severity == "error"]
+
+    @property
+    def warnings(self) -> list[CFAValidationIssue]:
+        """Return the issues that do not prevent a fragment being read"""
+        return [i for i in self.issues if i.severity == "warning"]
+
+    @property
+    def ok(self) -> bool:
+        """Return whether no errors were found"""
+        return len(self.errors) == 0
+
+    def to_dict(self) -> dict:
+        """Return the report as a dictionary, e.g. for writing as JSON"""
+        return {
+            "n_fragments": self.n_fragments,
+            "n_files": self.n_files,
+            "ok": self.ok,
+            "issues": [i._asdict() for i in self.issues],
+        }
+
+def _shape_matches(frag_shape: tuple, span: tuple) -> bool:
+    """Return whether the shape of a fragment matches the span of its location.
+    Fragments may omit size 1 dimensions."""
+    if tuple(frag_shape) == tuple(span):
+        return True
+    return (len(frag_shape) <= len(span) and
+            [s for s in frag_shape if s != 1] == [s for s in span if s != 1])
+
+def _check_fragments(nc_object: object, fragments: list[tuple],
+                     variables: dict, file: str) -> list[CFAValidationIssue]:
+    """Check the fragments stored in an open netCDF Dataset"""
+    issues = []
+    for varpath, frag_loc, address, span in fragments:
+        dtype, units = variables[varpath]
+        def issue(severity, check, message):
+            issues.append(CFAValidationIssue(
+                severity, check, varpath, frag_loc, file, address, message
+            ))
+        try:
+            frag_var = nc_object[address]
+        except (KeyError, IndexError):
+            issue("error", "address",
+                  f"variable {address} not found in fragment")
+            continue
+        if not _shape_matches(frag_var.shape, span):
+            issue("error", "shape",
+                  f"fragment shape {tuple(frag_var.shape)} does not match "
+                  f"location span {tuple(span)}")
+        if not numpy.can_cast(frag_var.dtype, dtype, casting="same_kind"):
+            issue("error", "dtype",
+                  f"fragment dtype {frag_var.dtype} is not compatible with "
+                  f"{dtype}")
+        if hasattr(frag_var, "attrs"):
+            # h5netcdf variables
+            frag_units = frag_var.attrs.get("units", None)
+        else:
+            frag_units = getattr(frag_var, "units", None)
+        if units is not None and frag_units is not None and frag_units != units:
+            issue("warning", "units",
+                  f"fragment units '{frag_units}' differ from '{units}'")
+    return issues
+
+def _check_file(file: str, fragments: list[tuple],
+                variables: dict) -> list[CFAValidationIssue]:
+    """Check all the fragments stored in one file, opened with the storage
+    backend for its URI.  This is run in a worker process or thread."""
+    backend = get_backend(file)
+    def file_issues(message):
+        return [CFAValidationIssue("error", "file", varpath, frag_loc, file,
+                                   address, message)
+                for varpath, frag_loc, address, span in fragments]
+    try:
+        if not backend.exists(file):
+            return file_issues("fragment file does not exist")
+        with backend.dataset(file) as nc_frag:
+            with backend._lock:
+                return _check_fragments(nc_frag, fragments, variables, file)
+    except (OSError, CFAException) as e:
+        return file_issues(f"cannot open fragment file: {e}")
+
+def validate(ds: object, workers: int=None,
+             threads: bool=False) -> CFAValidationReport:
+    """Validate every present fragment of every aggregation variable in the
+    (read mode) CFADataset ds.  The fragment files are checked in parallel by
+    workers processes (or threads, if threads is True)."""
+    # group the fragments by file, so that each file is only opened once
+    by_file = {}
+    internal = []
+    variables = {}
+    n_fragments = 0
+    for grp, var in ds.CFA.walkVariables():
+        varpath = grp.nc.path.rstrip("/") + "/" + var.name
+        variables[varpath] = (var.dtype, getattr(var.nc, "units", None))
+        index = var.getFragmentIndex()
+        files = var.getFragmentFiles()
+        addresses = var.getFragmentColumn("address")
+        # absent fragments are read as missing data, so are not checked
+        present = var.getPresentFragments()
+        for frag_loc in numpy.argwhere(present):
+            frag_loc = tuple(int(f) for f in frag_loc)
+            span = tuple(int(index.sizes[d][f]) for d, f in enumerate(frag_loc))
+            file = files[frag_loc]
+            fragment = (varpath, frag_loc, addresses[frag_loc], span)
+            if file is None:
+                internal.append(fragment)
+            else:
+                by_file.setdefault(file, []).append(fragment)
+            n_fragments += 1
+
+    # fragments in the aggregation file itself
+    with CFAPython.nc_lock:
+        issues = _check_fragments(ds, internal, variables, None)
+
+    if workers:
+        if threads:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        with pool:
+            futures = [pool.submit(_check_file, file, fragments, variables)
+                       for file, fragments in by_file.items()]
+            for f in futures:
+                issues.extend(f.result())
+    else:
+        for file, fragments in by_file.items():
+            issues.extend(_check_file(file, fragments, variables))
+
+    return CFAValidationReport(issues, n_fragments, len(by_file))
+
+def main(argv: list[str]=None) -> int:
+    """Command line interface to validate a CFA-netCDF file"""
+    from CFAPython.CFADataset import CFADataset
+    parser = argparse.ArgumentParser(
+        prog="cfa-validate",
+        description="Check the fragments of a CFA-netCDF file"
+    )
+    parser.add_argument("file", help="the CFA-netCDF file to validate")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--threads", action="store_true",
+                        help="use threads rather than processes")
+    parser.add_argument("--json", action="store_true",
+                        help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    ds = CFADataset(args.file, mode='r')
+    try:
+        report = validate(ds, args.workers, args.threads)
+    finally:
+        ds.close()
+
+    if args.json:
+        json.dump(report.to_dict(), sys.stdout, indent=2, default=str)
+        print()
+    else:
+        for i in report.issues:
+            print(f"{i.severity.upper()}: {i.variable} {list(i.index)} "
+                  f"{i.file}:{i.address}: {i.check}: {i.message}")
+        print(f"{report.n_fragments} fragments in {report.n_files} files: "
+              f"{len(report.errors)} errors, {len(report.warnings)} warnings")
+    return 0 if report.ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,23 @@
 from __future__ import annotations
-from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+import os.path
+import shutil
+import tempfile
+
+import numpy
 
 import CFAPython
 from CFAPython import CFAType
 import CFAPython._CFADatatypes as CFADatatypes
-from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAExceptions import CFAException, FRAGMENT_DATUM_NOT_FOUND
 from CFAPython.CFADimension import CFADimension
+from CFAPython.CFAFragmentIndex import CFAFragmentIndex
+from CFAPython.CFACoordinateIndex import CFACoordinateIndex
+from CFAPython.CFAFragmentReader import CFAFragmentReader
+from CFAPython.CFAFragmentWriter import CFAFragmentWriter
+from CFAPython.CFARaggedIndex import CFARaggedIndex
+import CFAPython._CFASerialise as CFASerialise
 
 from ctypes import *
 
@@ -16,6 +28,34 @@ class CFAVariable:
         self.__cfa_id = id
         self._nc_object = nc_object
         self._dimensions = []
+        self.__name = None
+        self.__regular = False
+        self._fragment_index = None
+        self._fragment_reader = None
+        self._fragment_writer = None
+        # the (CFARaggedIndex, sample axis) used by getFeature(s), and those
+        # built by getRaggedIndex, keyed by (count, sample dimension)
+        self._ragged = None
+        self._ragged_indexes = {}
+        # the flat index of each fragment set with setFragment, to find the
+        # fragments set more than once, see checkCoverage
+        self._fragment_writes = []
+        # the CFACoordinateIndex of each dimension, see getCoordinateIndex
+        self._coordinate_index = {}
+        # metadata cached by _freeze (in read mode) and fragment columns
+        self.__info = None
+        self.__shape = None
+        self.__frag_def = None
+        self._columns = {}
+        # in write mode, the values put by setFragment, keyed by term and
+        # then by flat fragment index, so that getFragmentColumn does not
+        # have to get them back from the CFA-C library one by one.  Values
+        # put by data location are only located by the CFA-C library.
+        self._put_values = {}
+        self._put_by_data_loc = False
+        # shard files of the fragment columns, see setFragmentsSharded
+        self._shards = []
+        self._shard_dir = None
 
     def __str__(self):
         return f"{self.name}: {self.__class__}: name={self.name}"
@@ -24,42 +64,69 @@ class CFAVariable:
         return self.__str__()
 
     @property
-    def _variable(self) -> object:
+    def _c_variable(self) -> object:
         """Get the underlying CFA-C AggregationVariable for this CFAVariable.
-        Hidden as we don't users to access this method."""
-        cfa_var = CFADatatypes.C_AggregationVariable()
-        cfa_var_p = pointer(cfa_var)
+        This is a view onto the structure owned by the CFA-C library, so no
+        (MAX_*-sized) structure is allocated on the Python side."""
+        cfa_var_p = POINTER(CFADatatypes.C_AggregationVariable)()
         cfa_err = CFAPython.lib().cfa_get_var(
-            self.__parent_id, self.__cfa_id, pointer(cfa_var_p)
+            self.__parent_id, self.__cfa_id, byref(cfa_var_p)
         )
         if (cfa_err != 0):
             raise CFAException(cfa_err)
         return cfa_var_p.contents
 
+    @property
+    def _variable(self) -> object:
+        """Get a snapshot of the CFA-C AggregationVariable for this CFAVariable,
+        as an AggregationVariableInfo.
+        Hidden as we don't users to access this method."""
+        if self.__info is not None:
+            return self.__info
+        return CFADatatypes.AggregationVariableInfo(self._c_variable)
+
     @property
     def name(self) -> str:
         """Return the name of the variable"""
-        return self._variable.name.decode('utf-8')
+        # the name cannot change once the variable is defined, so cache it
+        if self.__name is None:
+            self.__name = self._c_variable.name.decode('utf-8')
+        return self.__name
 
     @property
     def ndims(self) -> int:
         """Get the number of dimensions the variable is defined over"""
-        return self._variable.cfa_ndim
+        if self.__info is not None:
+            return self.__info.ndim
+        return self._c_variable.cfa_ndim
     
     @property
     def ninstr(self) -> int:
         """Get the number of Aggregation Instructions"""
-        return self._variable.n_instr
+        if self.__info is not None:
+            return len(self.__info.instructions)
+        return self._c_variable.n_instr
 
     @property
     def _dim_ids(self) -> list[int]:
         """Get the CFADimension ids that this CFAVariable is defined over"""
-        variable = self._variable
-        dimids = []
-        for d in range(0, self.ndims):
-            dimids.append(variable.cfa_dim_idp[d])
-        return dimids
+        if self.__info is not None:
+            return self.__info.dim_ids
+        variable = self._c_variable
+        return variable.cfa_dim_idp[0:variable.cfa_ndim]
     
+    @property
+    def _dim_names(self) -> list[str]:
+        """Get the names of the CFADimensions this CFAVariable is defined over"""
+        return [CFADimension(self.__parent_id, d).name for d in self._dim_ids]
+
+    @property
+    def shape(self) -> list[int]:
+        """Get the shape of the aggregated data"""
+        if self.__shape is not None:
+            return list(self.__shape)
+        return [CFADimension(self.__parent_id, d).size for d in self._dim_ids]
+
     @property
     def nc(self) -> object:
         """Return the netcdf object this variable maps to."""
@@ -75,13 +142,49 @@ class CFAVariable:
         """Return the CFA id this variable maps to."""
         return self.__cfa_id
 
+    def _refreshFrom(self, var: object) -> None:
+        """Take the state of var, this variable parsed again after its dataset
+        was refreshed (see CFADataset.refresh), keeping the caches that are
+        still valid"""
+        # the metadata of this variable is frozen, so is still available
+        old_sizes = {d.name: d.size for d in self._dimensions}
+        coordinate_index = self._coordinate_index
+        reader = self._fragment_reader
+        self.__dict__.update(var.__dict__)
+        # the coordinate indexes of dimensions whose size has not changed
+        sizes = {d.name: d.size for d in self._dimensions}
+        self._coordinate_index = {
+            dim: index for dim, index in coordinate_index.items()
+            if old_sizes.get(dim, None) == sizes.get(dim, None)
+        }
+        if reader is not None:
+            # the unit conversions and axes of fragments are keyed by file 
+            # and address, so are still valid for the fragments that remain
+            self._fragment_reader = CFAFragmentReader(self, 
+                                                      reader.convert_units)
+            self._fragment_reader._conversions = reader._conversions
+            self._fragment_reader._axes = reader._axes
+
     def parse(self, parent: object) -> None:
         """Assign netCDF dimensions to the CFAVariable"""
         self._dimensions = []
         for d in self._dim_ids:
             dim = CFADimension(self.__parent_id, d)
             dim._nc_object = parent._nc_object.dimensions[dim.name]
+            dim._freeze()
             self._dimensions.append(dim)
+        self._freeze()
+
+    def _freeze(self) -> None:
+        """Cache the metadata of the variable.  This is only called in read
+        mode, where the metadata cannot change, so that reading the metadata
+        does not have to call (and lock) the CFA-C library."""
+        info = CFADatatypes.AggregationVariableInfo(self._c_variable)
+        shape = self.shape
+        frag_def = self.getFragmentDefinition()
+        self.__info = info
+        self.__shape = shape
+        self.__frag_def = frag_def
 
     def setAggregationInstruction(self, agg_instrs: dict) -> None:
         """Set the aggration instructions - that is the location, file, format,
@@ -99,9 +202,17 @@ class CFAVariable:
             if (cfa_err != 0):
                 raise CFAException(cfa_err)
 
-    def setFragmentDefinition(self, frag_def: list[int]) -> None:
+    def setFragmentDefinition(self, frag_def: list[int], 
+                              regular: bool=False) -> None:
         """Set the Fragmentation definitions, i.e. how many times each dimension
-        is subdivided."""
+        is subdivided.
+        If regular is True then each dimension is divided as evenly as
+        possible (see CFAFragmentIndex.regular), the fragment boundaries are
+        computed arithmetically, and the location definition variable is not
+        written when the variable is serialised."""
+        if regular:
+            # check that the dimensions can be divided
+            CFAFragmentIndex.regular(self.shape, frag_def)
         # create the fragment location as a pointer to a size_t array
         if len(frag_def) != 0:
             frag_def_c = (c_int * len(frag_def))(0)
@@ -114,6 +225,8 @@ class CFAVariable:
         )
         if (cfa_err != 0):
             raise CFAException(cfa_err)
+        self.__regular = regular
+        self._fragment_index = None
 
     def setFragment(self, frag_loc: iter = None, data_loc: iter = None,
                     frag: dict = None) -> None:
@@ -134,54 +247,29 @@ class CFAVariable:
         else:
             data_loc_c = None
 
+        flat = None
+        if frag_loc_c is not None:
+            flat = int(numpy.ravel_multi_index(
+                tuple(frag_loc), self.getFragmentDefinition()
+            ))
+        put = False
         for item, value in frag.items():
             cterm = c_char_p(item.encode())
 
-            c_agg_instr = CFADatatypes.C_AggregationInstruction()
-            c_agg_instr_p = pointer(c_agg_instr)
+            c_agg_instr_p = POINTER(CFADatatypes.C_AggregationInstruction)()
             # get the AggregationInstruction type
             cfa_err = CFAPython.lib().cfa_var_get_agg_instr(
                 self.__parent_id, self.__cfa_id,
-                cterm, pointer(c_agg_instr_p)
+                cterm, byref(c_agg_instr_p)
             )
             if cfa_err != 0:
                 raise CFAException(cfa_err)
             
-            # switch on the type to get the data in the correct format
+            # encode the data in the correct format for the type
             T = c_agg_instr_p.contents.type.type
-            length = 1
             if value is None:
                 continue
-            if T == CFAType.CFANat:
-                raise CFAException(-504)
-            elif T == CFAType.CFAByte:
-                cdata = pointer(c_byte(value))
-            elif T == CFAType.CFAChar:
-                cdata = pointer(c_char(value))
-            elif T == CFAType.CFAShort:
-                cdata = pointer(c_short(value))
-            elif T == CFAType.CFAInt:
-                cdata = pointer(c_int(value))
-            elif T == CFAType.CFAFloat:
-                cdata = pointer(c_float(value))
-            elif T == CFAType.CFADouble:
-                cdata = pointer(c_double(value))
-            elif T == CFAType.CFAUByte:
-                cdata = pointer(c_ubyte(value))
-            elif T == CFAType.CFAUShort:
-                cdata = pointer(c_ushort(value))
-            elif T == CFAType.CFAUInt:
-                cdata = pointer(c_uint(value))
-            elif T == CFAType.CFAInt64:
-                cdata = pointer(c_longlong(value))
-            elif T == CFAType.CFAUInt64:
-                cdata = pointer(c_ulonglong(value))
-            elif T == CFAType.CFAString:
-                cdata = c_char_p(value.encode())
-                length = c_int(len(value)+1)
-            else:
-                # not a type error
-                raise CFAException(-504)
+            cdata, length = CFAPython.CFATypeToInfo(T).encode(value)
 
             cfa_err = CFAPython.lib().cfa_var_put1_frag(
                     self.__parent_id, self.__cfa_id,
@@ -190,6 +278,143 @@ class CFAVariable:
             )
             if cfa_err != 0:
                 raise CFAException(cfa_err)
+            put = True
+            if flat is not None:
+                self._put_values.setdefault(item, {})[flat] = value
+            else:
+                self._put_by_data_loc = True
+
+        if put:
+            self._recordFragmentWrite(frag_loc, data_loc)
+
+    def _recordFragmentWrite(self, frag_loc: iter, data_loc: iter) -> None:
+        """Record the data location that a fragment was set from with 
+        setFragment, so that different data locations that fall in the same
+        fragment can be found.  Fragments set by their fragment location are
+        not recorded, as setting their terms in several calls is allowed."""
+        frag_def = self.getFragmentDefinition()
+        if len(frag_def) == 0 or frag_loc or not data_loc:
+            return
+        frag_loc = self.getFragmentIndex().getFragmentLocation(list(data_loc))
+        self._fragment_writes.append((
+            int(numpy.ravel_multi_index(tuple(frag_loc), frag_def)),
+            int(numpy.ravel_multi_index(tuple(data_loc), self.shape))
+        ))
+
+    def _setFragmentSizes(self, sizes: list) -> None:
+        """Set the size of each fragment along each dimension, given to
+        setFragments or setFragmentsSharded"""
+        index = CFAFragmentIndex(self.shape, sizes)
+        if index.frag_def != self.getFragmentDefinition():
+            raise CFAException(
+                "Fragment sizes do not match the fragment definition"
+            )
+        if self.__regular:
+            # the location variable is not written for a regular 
+            # fragmentation, so the sizes must be those that it implies
+            regular = CFAFragmentIndex.regular(self.shape, index.frag_def)
+            if not all(numpy.array_equal(a, b)
+                       for a, b in zip(index.sizes, regular.sizes)):
+                raise CFAException(
+                    "Fragment sizes do not match the regular fragmentation"
+                )
+        self._fragment_index = index
+
+    def setFragments(self, frag: dict, sizes: list = None) -> None:
+        """Set the value of terms for every fragment in bulk, rather than
+        calling setFragment for each fragment.  frag is a dictionary of arrays
+        with the shape of the fragment definition (or scalars, which apply to
+        every fragment), keyed by term.
+        sizes optionally gives the size of each fragment along each dimension,
+        for an irregular fragmentation.
+        The definition variables are written directly from these arrays when
+        the variable is serialised, rather than passing each fragment to the
+        CFA-C library."""
+        frag_def = self.getFragmentDefinition()
+        if sizes is not None:
+            self._setFragmentSizes(sizes)
+        for term, values in frag.items():
+            if term == "location":
+                raise CFAException(-553)
+            info = CFAPython.CFATypeToInfo(self._getInstruction(term).type)
+            column = numpy.ma.asanyarray(values, dtype=info.dtype)
+            if column.ndim == 0:
+                column = numpy.full(frag_def, column[()], dtype=info.dtype)
+            elif list(column.shape) != frag_def:
+                raise CFAException(-502)
+            self._columns[term] = column
+        # every fragment is set once in bulk
+        self._fragment_writes = []
+
+    def setFragmentsSharded(self, build: object, workers: int=None,
+                            shard_size: int=None, sizes: list=None,
+                            tmp_dir: str=None) -> None:
+        """Set the value of terms for every fragment in shards, built in
+        parallel by workers processes, for very large fragment tables.
+        build(start, stop) is called for disjoint ranges of the first
+        dimension of the fragment definition, of shard_size fragments, and
+        returns a dictionary of arrays (with the shape of the fragment
+        definition, but start:stop along the first dimension) or scalars,
+        keyed by term, as for setFragments.  build must be a module level
+        function, so that it can be sent to the worker processes.
+        Each shard is written to a temporary netCDF file (in tmp_dir), and the
+        shards are merged into the definition variables, one shard at a time,
+        when the variable is serialised.  Neither the workers nor the writing
+        process hold the whole fragment table in memory."""
+        frag_def = self.getFragmentDefinition()
+        if len(frag_def) == 0:
+            raise CFAException(-502)
+        if sizes is not None:
+            self._setFragmentSizes(sizes)
+        terms = {i.term: i.type for i in self._variable.instructions
+                 if i.term != "location"}
+        n = frag_def[0]
+        if shard_size is None:
+            shard_size = max(1, -(-n // ((workers or 1) * 4)))
+        self._releaseShards()
+        self._shard_dir = tempfile.mkdtemp(prefix="cfa_shards_", dir=tmp_dir)
+        ranges = [(start, min(start + shard_size, n))
+                  for start in range(0, n, shard_size)]
+        paths = [os.path.join(self._shard_dir, f"shard_{r}.nc")
+                 for r in range(0, len(ranges))]
+        args = ([build] * len(ranges), [r[0] for r in ranges],
+                [r[1] for r in ranges], [terms] * len(ranges),
+                [frag_def] * len(ranges), paths)
+        try:
+            if workers:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(CFASerialise.write_shard, *args))
+            else:
+                with CFAPython.nc_lock:
+                    list(map(CFASerialise.write_shard, *args))
+        except BaseException:
+            self._releaseShards()
+            raise
+        self._shards = [(r[0], r[1], p) for r, p in zip(ranges, paths)]
+        self._fragment_writes = []
+
+    def _releaseShards(self) -> None:
+        """Remove the shard files, once they have been merged"""
+        if self._shard_dir is not None:
+            shutil.rmtree(self._shard_dir, ignore_errors=True)
+        self._shards = []
+        self._shard_dir = None
+
+    def _isRegular(self) -> bool:
+        """Return whether the fragmentation was declared regular with
+        setFragmentDefinition"""
+        return self.__regular
+
+    def _hasBulkFragments(self) -> bool:
+        """Return whether the fragments have been set with setFragments or
+        setFragmentsSharded"""
+        return (self.__info is None and 
+                (len(self._columns) > 0 or len(self._shards) > 0))
+
+    @property
+    def dtype(self) -> object:
+        """Return the NumPy dtype of the aggregated data"""
+        return self._nc_object.dtype
 
     @property
     def dimensions(self) -> list[object]:
@@ -214,13 +439,14 @@ class CFAVariable:
         list of integers, the length of the number of dimensions this variable
         is defined over.  Each element in the list is the number of times the
         corresponding dimension is divided by."""
+        if self.__frag_def is not None:
+            return list(self.__frag_def)
         frag_def = []
+        frag_dim_p = POINTER(CFADatatypes.C_FragmentDimension)()
         for d in range(0, self.ndims):
             # get the fragment definition
-            frag_dim = CFADatatypes.C_FragmentDimension()
-            frag_dim_p = pointer(frag_dim)
             cfa_err = CFAPython.lib().cfa_var_get_frag_dim(
-                    self.__parent_id, self.__cfa_id, d, pointer(frag_dim_p)
+                    self.__parent_id, self.__cfa_id, d, byref(frag_dim_p)
             )
             if (cfa_err != 0):
                 raise CFAException(cfa_err)
@@ -260,77 +486,583 @@ class CFAVariable:
         # return the fragment as a dictionary - need to get the value for
         # each key in the AggregationInstructions
         V = self._variable
+        ndims = V.ndim
         cfa_frag = {} # return dictionary
 
         # Get the index - this is outside the terms
-        cdata = (c_size_t * self.ndims)(0)
+        cdata = (c_size_t * ndims)(0)
         cfa_err = CFAPython.lib().cfa_var_get1_frag(
             self.__parent_id, self.__cfa_id, frag_loc_c, data_loc_c,
             "index".encode(), cdata,
         )
-        data = [cdata[d] for d in range(0, self.ndims)]
+        data = [cdata[d] for d in range(0, ndims)]
         cfa_frag["index"] = data
 
-        for i in range(0, self.ninstr):
+        for instr in V.instructions:
             # get the term from the aggregation
-            cterm = V.cfa_instructionsp[i].term
-            T = V.cfa_instructionsp[i].type.type
-            term = cterm.decode()
+            term = instr.term
+            cterm = term.encode()
+            T = instr.type
             data = None
 
             if term == "location":
                 # Get the location (in the Aggregated Data)
-                data_loc_dims = 2 * self.ndims
+                data_loc_dims = 2 * ndims
                 cdata = (c_size_t * data_loc_dims)(0)
                 cfa_err = CFAPython.lib().cfa_var_get1_frag(
                     self.__parent_id, self.__cfa_id, frag_loc_c, data_loc_c,
                     cterm, cdata,
                 )
                 # transform data
-                data = [cdata[d] for d in range(0, self.ndims)]
+                data = [cdata[d] for d in range(0, ndims)]
             else:
-                if T == CFAType.CFANat:
-                    raise CFAException(-504)
-                elif T == CFAType.CFAByte:
-                    cdata = pointer(c_byte(0))
-                elif T == CFAType.CFAChar:
-                    cdata = pointer(c_char(0))
-                elif T == CFAType.CFAShort:
-                    cdata = pointer(c_short(0))
-                elif T == CFAType.CFAInt:
-                    cdata = pointer(c_int(0))
-                elif T == CFAType.CFAFloat:
-                    cdata = pointer(c_float(0))
-                elif T == CFAType.CFADouble:
-                    cdata = pointer(c_double(0))
-                elif T == CFAType.CFAUByte:
-                    cdata = pointer(c_ubyte(0))
-                elif T == CFAType.CFAUShort:
-                    cdata = pointer(c_ushort(0))
-                elif T == CFAType.CFAUInt:
-                    cdata = pointer(c_uint(0))
-                elif T == CFAType.CFAInt64:
-                    cdata = pointer(c_longlong(0))
-                elif T == CFAType.CFAUInt64:
-                    cdata = pointer(c_ulonglong(0))
-                elif T == CFAType.CFAString:
-                    cdata = c_char_p(1*1024)
-                else:
-                    # not a type error
-                    raise CFAException(-504)
-                
+                # the CFA-C library returns a pointer to the datum
+                info = CFAPython.CFATypeToInfo(T)
+                cdata = info.ptype()
                 cfa_err = CFAPython.lib().cfa_var_get1_frag(
                     self.__parent_id, self.__cfa_id, frag_loc_c, data_loc_c,
-                    cterm, pointer(cdata)
+                    cterm, byref(cdata)
                 )
                 if (cfa_err != 0):
                     raise CFAException(cfa_err)
-                
-                if T == CFAType.CFAString:
-                    data = cdata.value.decode('utf-8')
-                else:
-                    data = cdata.contents.value
+                data = info.decode(cdata)
                                 
             cfa_frag[term] = data
             
-        return cfa_frag
\ No newline at end of file
+        return cfa_frag
+
+    def _getInstruction(self, term: str) -> object:
+        """Get the AggregationInstructionInfo for a single term"""
+        for instr in self._variable.instructions:
+            if instr.term == term:
+                return instr
+        raise CFAException(-531)
+
+    @CFAPython.shared_access
+    def getFragmentColumn(self, term: str) -> numpy.ndarray:
+        """Get the value of a single term (other than location) for every 
+        fragment in this variable, as a NumPy array with the shape of the
+        fragment definition.  The values are decoded with a single call per
+        column, rather than per value.  Fragments without a value for the term
+        are masked (or None for strings).
+        In read mode, the column is read from the netCDF definition variable
+        with a single read, and cached.  In write mode, it is built from the
+        values put by setFragment, unless any were put by data location (or
+        the term is scalar), when each value is got from the CFA-C library."""
+        if term == "location":
+            raise CFAException(-553)
+        if term in self._columns:
+            return self._columns[term]
+        instr = self._getInstruction(term)
+        if len(self._shards) > 0:
+            return CFASerialise.ShardedColumn(
+                self._shards, instr, self.getFragmentDefinition()
+            ).read()
+        T = instr.type
+        info = CFAPython.CFATypeToInfo(T)
+        frag_def = self.getFragmentDefinition()
+        n_frags = int(numpy.prod(frag_def))
+
+        if self.__info is not None:
+            term_var = self._getTermVariable(term)
+            if term_var is not None:
+                with CFAPython.nc_lock:
+                    values = term_var[...]
+                if instr.scalar or numpy.ndim(values) == 0:
+                    column = numpy.full(frag_def, values, dtype=info.dtype)
+                else:
+                    column = numpy.asanyarray(values).reshape(frag_def)
+                if T == CFAType.CFAString:
+                    # netCDF fills missing strings with the empty string
+                    column = numpy.where(column == "", None, column)
+                self._columns[term] = column
+                return column
+
+        if (self.__info is None and not instr.scalar and 
+                not self._put_by_data_loc):
+            # the values put by setFragment, without calling the CFA-C library
+            return self._putColumn(term, info, frag_def)
+
+        # get a pointer to each datum - the CFA-C library returns a pointer to
+        # the datum for each fragment
+        cterm = term.encode()
+        frag_loc_c = (c_size_t * len(frag_def))(0)
+        cdata = (info.ptype * n_frags)()
+        missing = numpy.zeros(n_frags, dtype=bool)
+        for f, frag_loc in enumerate(numpy.ndindex(*frag_def)):
+            frag_loc_c[:] = frag_loc
+            cfa_err = CFAPython.lib().cfa_var_get1_frag(
+                self.__parent_id, self.__cfa_id, frag_loc_c, None,
+                cterm, byref(cdata, f * sizeof(info.ptype))
+            )
+            if cfa_err == FRAGMENT_DATUM_NOT_FOUND:
+                missing[f] = True
+            elif cfa_err != 0:
+                raise CFAException(cfa_err)
+
+        if T != CFAType.CFAString:
+            # gather the data into a contiguous buffer, so that it can be 
+            # decoded in one go
+            buffer = (info.ctype * n_frags)()
+            for f in numpy.flatnonzero(~missing):
+                memmove(byref(buffer, int(f) * info.itemsize), cdata[f], 
+                        info.itemsize)
+            cdata = buffer
+
+        column = CFAPython.CFADecodeColumn(T, cdata).reshape(frag_def)
+        if T != CFAType.CFAString and missing.any():
+            column = numpy.ma.masked_array(column, mask=missing.reshape(frag_def))
+        if self.__info is not None:
+            self._columns[term] = column
+        return column
+
+    def _putColumn(self, term: str, info: object,
+                   frag_def: list[int]) -> numpy.ndarray:
+        """Build the column of a term from the values put by setFragment, with
+        the fragments without a value masked (or None for strings)"""
+        values = self._put_values.get(term, {})
+        n_frags = int(numpy.prod(frag_def))
+        flat = numpy.fromiter(values.keys(), dtype=numpy.int64,
+                              count=len(values))
+        if info.dtype == object:
+            column = numpy.full(n_frags, None, dtype=object)
+            column[flat] = list(values.values())
+            return column.reshape(frag_def)
+        data = numpy.zeros(n_frags, dtype=info.dtype)
+        data[flat] = list(values.values())
+        missing = numpy.ones(n_frags, dtype=bool)
+        missing[flat] = False
+        if not missing.any():
+            return data.reshape(frag_def)
+        return numpy.ma.masked_array(data, mask=missing).reshape(frag_def)
+
+    def _fragmentColumnReader(self, term: str) -> Callable:
+        """Get a function read(start, stop) that gets the values of a term
+        (other than location) for the fragments start:stop, in the flattened
+        order of the fragment definition.  In read mode, only the rows (along
+        the first dimension of the fragment definition) of the definition
+        variable that hold those fragments are read, so the whole column is
+        not held in memory."""
+        instr = self._getInstruction(term)
+        term_var = None
+        if (self.__info is not None and term not in self._columns and
+                len(self._shards) == 0):
+            term_var = self._getTermVariable(term)
+        if term_var is None:
+            column = self.getFragmentColumn(term).reshape(-1)
+            return lambda start, stop: column[start:stop]
+
+        info = CFAPython.CFATypeToInfo(instr.type)
+        frag_def = self.getFragmentDefinition()
+        with CFAPython.nc_lock:
+            scalar = instr.scalar or len(term_var.shape) == 0
+            if scalar:
+                value = numpy.ma.asanyarray(term_var[...]).reshape(-1)[0]
+        if scalar:
+            return lambda start, stop: numpy.full(stop - start, value,
+                                                  dtype=info.dtype)
+        row = int(numpy.prod(frag_def[1:]))
+
+        def read(start, stop):
+            r0 = start // row
+            r1 = -(-stop // row)
+            with CFAPython.nc_lock:
+                values = term_var[r0:r1]
+            values = numpy.ma.asanyarray(values).reshape(-1)
+            values = values[start - r0 * row:stop - r0 * row]
+            if instr.type == CFAType.CFAString:
+                values = numpy.where(numpy.ma.getdata(values) == "", None,
+                                     numpy.ma.getdata(values))
+            return values
+        return read
+
+    def _resolveFiles(self, files: numpy.ndarray) -> numpy.ndarray:
+        """Resolve fragment file names as getFragmentFiles does"""
+        if self._fragment_reader is None:
+            self._fragment_reader = CFAFragmentReader(self)
+        reader = self._fragment_reader
+        return reader._resolver.resolveColumn(files, reader._defaults)
+
+    @CFAPython.shared_access
+    def __getitem__(self, key: object) -> numpy.ndarray:
+        """Read the aggregated data for a selection of integers, slices and an
+        Ellipsis, from the fragments that intersect the selection."""
+        if self._fragment_reader is None:
+            self._fragment_reader = CFAFragmentReader(self)
+        return self._fragment_reader.read(key)
+
+    @CFAPython.shared_access
+    def getFragmentFiles(self) -> numpy.ndarray:
+        """Get the file of every fragment, resolved to an absolute path (or
+        URI) with the dataset's file substitutions and base directory.  
+        Fragments in the aggregation file have None.  See 
+        CFADataset.setFileSubstitutions."""
+        if self._fragment_reader is None:
+            self._fragment_reader = CFAFragmentReader(self)
+        return self._fragment_reader._fragmentFiles()
+
+    @CFAPython.shared_access
+    def getFragmentTable(self, batch_size: int=65536,
+                         resolve_files: bool=False,
+                         pandas: bool=False) -> object:
+        """Get the fragment table of this variable as an Apache Arrow Table
+        (or, if pandas is True, a pandas DataFrame), with a row per fragment
+        and a column per term, plus the location, start and size of each 
+        fragment along each dimension.  See CFAPython.CFAFragmentTable."""
+        from CFAPython.CFAFragmentTable import fragment_table
+        return fragment_table(self, batch_size, resolve_files, pandas)
+
+    @CFAPython.shared_access
+    def writeFragmentTable(self, path: str, batch_size: int=65536,
+                           resolve_files: bool=False) -> int:
+        """Write the fragment table of this variable to a Parquet file, in 
+        record batches of batch_size fragments.  Returns the number of 
+        fragments written.  See getFragmentTable."""
+        from CFAPython.CFAFragmentTable import write_fragment_table
+        return write_fragment_table(self, path, batch_size, resolve_files)
+
+    @CFAPython.shared_access
+    def getPresentFragments(self) -> numpy.ndarray:
+        """Get whether each fragment is present, as a boolean array with the
+        shape of the fragment definition.  Absent fragments (e.g. the land
+        tiles of an ocean-only aggregation) have no address, or no file and
+        no variable in the aggregation file, and are read as missing data
+        without any I/O.  Only the fragment table is read."""
+        if self._fragment_reader is None:
+            self._fragment_reader = CFAFragmentReader(self)
+        return ~self._fragment_reader._absentFragments()
+
+    @CFAPython.shared_access
+    def getCoverage(self) -> float:
+        """Get the fraction of the aggregated data that is in present 
+        fragments, computed from the fragment table and fragment index 
+        alone"""
+        present = self.getPresentFragments()
+        index = self.getFragmentIndex()
+        size = numpy.prod(index.shape, dtype=numpy.float64)
+        if size == 0:
+            return 1.0
+        # the number of elements of each fragment is the outer product of
+        # its sizes along each dimension
+        counts = numpy.ones(present.shape, dtype=numpy.float64)
+        for d, sizes in enumerate(index.sizes):
+            shape = [1] * present.ndim
+            shape[d] = len(sizes)
+            counts = counts * numpy.asarray(sizes).reshape(shape)
+        return float(counts[present].sum() / size)
+
+    def __setitem__(self, key: object, value: object) -> None:
+        """Write value into a selection of integers, slices and an Ellipsis of
+        the aggregated data, by splitting it by fragment and writing each 
+        piece into its fragment file.  See setWriteOptions."""
+        if self._fragment_writer is None:
+            self._fragment_writer = CFAFragmentWriter(self)
+        self._fragment_writer.write(key, value)
+
+    def setReadOptions(self, convert_units: bool=True) -> None:
+        """Set how the aggregated data are read: if convert_units is True then
+        fragments stored in different, but equivalent, units to the variable 
+        are converted to its units (with cf_units, if installed)."""
+        self._fragment_reader = CFAFragmentReader(self, convert_units)
+
+    def setWriteOptions(self, workers: int=None, buffered: bool=False,
+                        buffer_size: int=256*1024*1024) -> None:
+        """Set how assignments to the aggregated data are written: by workers
+        processes, in parallel, or through the file-handle pool of the 
+        storage backend, and whether writes are buffered (up to buffer_size 
+        bytes) until flush is called."""
+        self.flush()
+        self._fragment_writer = CFAFragmentWriter(self, workers, buffered,
+                                                  buffer_size)
+
+    def flush(self) -> None:
+        """Write any buffered assignments to the fragment files"""
+        if self._fragment_writer is not None:
+            self._fragment_writer.flush()
+
+    def _getTermVariable(self, term: str) -> object:
+        """Get the netCDF variable that holds the values of a term, or None if
+        the variable has not been written (i.e. before serialisation)."""
+        try:
+            path = self._getInstruction(term).value
+        except CFAException:
+            return None
+        if self._nc_object is None:
+            return None
+        return self._findNetCDFVariable(path)
+
+    def _findNetCDFVariable(self, path: str) -> object:
+        """Find a netCDF variable from its path.  Absolute paths are resolved
+        from the root group, otherwise the variable is searched for in this 
+        variable's group and then its ancestors.  Returns None if there is no
+        such variable."""
+        with CFAPython.nc_lock:
+            grp = self._nc_object.group()
+            if path.startswith("/"):
+                while grp.parent is not None:
+                    grp = grp.parent
+                try:
+                    return grp[path]
+                except (KeyError, IndexError):
+                    return None
+            while grp is not None:
+                if path in grp.variables:
+                    return grp.variables[path]
+                grp = grp.parent
+        return None
+
+    def _findCountVariable(self) -> object:
+        """Find the count variable of a contiguous ragged array: the netCDF
+        variable, in this variable's group or its ancestors, whose
+        sample_dimension is a dimension of this variable"""
+        dim_names = self._dim_names
+        with CFAPython.nc_lock:
+            grp = self._nc_object.group()
+            while grp is not None:
+                for nc_var in grp.variables.values():
+                    if getattr(nc_var, "sample_dimension", None) in dim_names:
+                        return nc_var
+                grp = grp.parent
+        return None
+
+    @CFAPython.shared_access
+    def getRaggedIndex(self, count: object=None,
+                       sample_dimension: str=None) -> CFARaggedIndex:
+        """Get the CFARaggedIndex of the features of a discrete sampling
+        geometry stored as a contiguous ragged array, which maps each feature
+        to its elements along the sample dimension.  By default the count
+        variable is found from its sample_dimension attribute.  If the count
+        variable is itself an aggregation variable then it must be given as
+        count (a CFAVariable, or an array of counts).  The index is cached for
+        each count variable and sample dimension, and the index last got is
+        the one used by getFeature and getFeatures."""
+        if count is None:
+            count = self._findCountVariable()
+            if count is None:
+                raise CFAException(f"No count variable found for {self.name}")
+        if sample_dimension is None:
+            nc_count = getattr(count, "nc", count)
+            with CFAPython.nc_lock:
+                sample_dimension = getattr(nc_count, "sample_dimension", None)
+            if sample_dimension is None:
+                if self.ndims != 1:
+                    raise CFAException("The sample dimension must be given")
+                sample_dimension = self._dim_names[0]
+        # the count is held in the cache, so its id is not reused
+        key = (id(count), sample_dimension)
+        cached = self._ragged_indexes.get(key, None)
+        if cached is not None and cached[0] is count:
+            count, index, axis = cached
+        else:
+            index, axis = self._buildRaggedIndex(count, sample_dimension)
+            self._ragged_indexes[key] = (count, index, axis)
+        self._ragged = (index, axis)
+        return index
+
+    def _buildRaggedIndex(self, count: object,
+                          sample_dimension: str) -> tuple:
+        """Build the CFARaggedIndex from a count variable (or array), and get
+        the axis of the sample dimension"""
+        if sample_dimension not in self._dim_names:
+            raise CFAException(
+                f"{sample_dimension} is not a dimension of {self.name}"
+            )
+        with CFAPython.nc_lock:
+            if hasattr(count, "aggregated_data"):
+                raise CFAException(
+                    "The count variable is an aggregation variable, pass it "
+                    "as count"
+                )
+        if isinstance(count, CFAVariable):
+            counts = count[...]
+        else:
+            with CFAPython.nc_lock:
+                counts = count[...]
+        index = CFARaggedIndex(counts)
+        axis = self._dim_names.index(sample_dimension)
+        if index.nelements != self.shape[axis]:
+            raise CFAException(
+                f"Counts sum to {index.nelements}, but {sample_dimension} has "
+                f"size {self.shape[axis]}"
+            )
+        return index, axis
+
+    def _currentRaggedIndex(self) -> tuple[CFARaggedIndex, int]:
+        """Get the (index, sample axis) last got with getRaggedIndex, or the
+        default one"""
+        if self._ragged is None:
+            self.getRaggedIndex()
+        return self._ragged
+
+    def _sampleKey(self, s: slice, axis: int) -> tuple:
+        """Get the key selecting s along the sample axis"""
+        key = [slice(None)] * self.ndims
+        key[axis] = s
+        return tuple(key)
+
+    @CFAPython.shared_access
+    def getFeature(self, k: int) -> numpy.ndarray:
+        """Read the elements of feature k of a contiguous ragged array, from
+        only the fragments that contain them.  See getRaggedIndex."""
+        index, axis = self._currentRaggedIndex()
+        return self[self._sampleKey(index.getFeatureSlice(k), axis)]
+
+    @CFAPython.shared_access
+    def getFeatures(self, start: int=0, 
+                    stop: int=None) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Read the elements of features start to stop (exclusive) of a
+        contiguous ragged array, without padding them to a dense array.
+        Returns (values, offsets), where the elements of the i-th feature
+        read are values[offsets[i]:offsets[i+1]] along the sample 
+        dimension.  See getRaggedIndex."""
+        index, axis = self._currentRaggedIndex()
+        if stop is None:
+            stop = index.nfeatures
+        s = index.getFeatureSlice(start, stop)
+        offsets = index.offsets[start:stop+1] - index.offsets[start]
+        return self[self._sampleKey(s, axis)], offsets
+
+    def _findAggregationVariable(self, nc_var: object) -> object:
+        """Find the CFAVariable of a netCDF variable that is an aggregation
+        variable, from the CFADataset that this variable belongs to, or None
+        if it is not an aggregation variable"""
+        with CFAPython.nc_lock:
+            if not hasattr(nc_var, "aggregated_data"):
+                return None
+            path = nc_var.group().path.rstrip("/") + "/" + nc_var.name
+            root = nc_var.group()
+            while root.parent is not None:
+                root = root.parent
+        cfa = getattr(root, "__dict__", {}).get("CFA", None)
+        if cfa is None:
+            return None
+        for grp, var in cfa.walkVariables():
+            with CFAPython.nc_lock:
+                var_path = grp.nc.path.rstrip("/") + "/" + var.name
+            if var_path == path:
+                return var
+        return None
+
+    @CFAPython.shared_access
+    def getCoordinateIndex(self, dimname: str) -> CFACoordinateIndex:
+        """Get the CFACoordinateIndex of the coordinate variable of a 
+        dimension of this variable, which may itself be an aggregation 
+        variable.  The coordinate values are read once and cached."""
+        if dimname in self._coordinate_index:
+            return self._coordinate_index[dimname]
+        if dimname not in self._dim_names:
+            raise CFAException(f"{dimname} is not a dimension of {self.name}")
+        nc_coord = self._findNetCDFVariable(dimname)
+        if nc_coord is None:
+            raise CFAException(f"No coordinate variable for {dimname}")
+        cfa_coord = self._findAggregationVariable(nc_coord)
+        with CFAPython.nc_lock:
+            units = getattr(nc_coord, "units", None)
+            calendar = getattr(nc_coord, "calendar", "standard")
+            if cfa_coord is None:
+                values = nc_coord[:]
+        if cfa_coord is not None:
+            values = cfa_coord[...]
+        index = CFACoordinateIndex(values, units, calendar)
+        axis = self._dim_names.index(dimname)
+        if index.size != self.shape[axis]:
+            raise CFAException(
+                f"Coordinate variable {dimname} has {index.size} values, but "
+                f"the dimension has size {self.shape[axis]}"
+            )
+        self._coordinate_index[dimname] = index
+        return index
+
+    @CFAPython.shared_access
+    def getSelection(self, **selections) -> tuple[slice]:
+        """Get the index selection for coordinate ranges, keyed by dimension 
+        name, e.g. getSelection(time=slice("2001-03", "2001-05"), 
+        latitude=slice(-10, 10)), by binary search of the coordinate values.
+        See CFACoordinateIndex.getSlice."""
+        key = [slice(None)] * self.ndims
+        for dimname, label in selections.items():
+            index = self.getCoordinateIndex(dimname)
+            key[self._dim_names.index(dimname)] = index.getSlice(label)
+        return tuple(key)
+
+    @CFAPython.shared_access
+    def sel(self, **selections) -> numpy.ndarray:
+        """Read the aggregated data within coordinate ranges, keyed by 
+        dimension name, e.g. sel(time=slice("2001-03", "2001-05"), 
+        latitude=slice(-10, 10)).  Only the fragments that intersect the
+        selection are read.  See getSelection."""
+        return self[self.getSelection(**selections)]
+
+    @CFAPython.shared_access
+    def getFragmentIndex(self) -> CFAFragmentIndex:
+        """Get the CFAFragmentIndex for this variable, which maps between 
+        fragment locations and data locations without querying each fragment.
+        If the fragmentation was declared regular, or there is no location
+        term, or the location term describes a regular fragmentation, then the
+        fragment boundaries are computed arithmetically."""
+        if self._fragment_index is None:
+            sizes = self._locationSizes()
+            if sizes is None:
+                self._fragment_index = CFAFragmentIndex.regular(
+                    self.shape, self.getFragmentDefinition()
+                )
+            else:
+                self._fragment_index = CFAFragmentIndex(
+                    self.shape, [numpy.ma.getdata(s) for s in sizes]
+                )
+        return self._fragment_index
+
+    def _locationSizes(self) -> list[numpy.ndarray]:
+        """Read the size of the fragments along each dimension from the 
+        location variable, in a single call, or None if the fragmentation is
+        regular (or there is no location variable).  Missing sizes are 
+        masked."""
+        loc_var = None
+        if not self.__regular:
+            loc_var = self._getTermVariable("location")
+        if loc_var is None:
+            return None
+        shape = self.shape
+        frag_def = self.getFragmentDefinition()
+        # each row is the size of the fragments along one dimension
+        with CFAPython.nc_lock:
+            location = loc_var[:]
+        location = numpy.ma.asanyarray(location).reshape(len(shape), -1)
+        return [location[d, 0:frag_def[d]] for d in range(0, len(shape))]
+
+    def _fragmentSizes(self) -> list[numpy.ndarray]:
+        """Get the size of the fragments along each dimension, without 
+        checking that they tile the aggregated data"""
+        if self._fragment_index is None:
+            sizes = self._locationSizes()
+            if sizes is not None:
+                return sizes
+        return self.getFragmentIndex().sizes
+
+    @CFAPython.shared_access
+    def checkCoverage(self, allow_absent: bool=False) -> object:
+        """Check that the fragments tile the aggregated data exactly, with no
+        holes (fragments without a value, unless allow_absent is True, or a
+        shortfall in the fragment sizes of a location table read from a file)
+        and no overlaps (fragments set by setFragment from more than one data
+        location, or extending past the aggregated data).  The check is made
+        on whole arrays at once.  Returns a CFACoverageReport, with the 
+        indices of the offending fragments."""
+        from CFAPython.CFACoverage import check_coverage
+        return check_coverage(self, allow_absent)
+
+    def getFragmentLocation(self, data_loc: list[int]) -> list[int]:
+        """Get the location of the fragment (i.e. its index along each 
+        fragment dimension) that contains the Data Location data_loc."""
+        return self.getFragmentIndex().getFragmentLocation(data_loc)
+
+    def getFragmentExtent(self, frag_loc: list[int] = [],
+                          data_loc: list[int] = []) -> list[tuple[int, int]]:
+        """Get the (start, stop) of a fragment along each aggregated dimension,
+        either from a Fragment Location, or a Data Location."""
+        index = self.getFragmentIndex()
+        if len(frag_loc) == 0:
+            if len(data_loc) == 0:
+                raise CFAException(-536)
+            frag_loc = index.getFragmentLocation(data_loc)
+        return index.getExtent(frag_loc)
@@ -59,4 +59,59 @@ class C_FragmentDimension(Structure):
     _fields_ = [("name", c_char_p),
                 ("length", c_int),
                 ("cfa_dim_id", c_int)
-            ]
\ No newline at end of file
+            ]
+
+# Lightweight Python mirrors of the CFA-C structures above.  The CFA-C library
+# returns pointers to its own (MAX_*-sized) structures, so these copy out only
+# the live portion of each structure, rather than allocating a structure of
+# several kilobytes for every attribute that is read.
+
+class AggregationContainerInfo:
+    """Snapshot of the fields of a C_AggregationContainer"""
+    __slots__ = ("name", "path", "format", "var_ids", "dim_ids", "cont_ids")
+
+    def __init__(self, c_cont: C_AggregationContainer):
+        self.name = c_cont.name.decode('utf-8') if c_cont.name else ""
+        self.path = c_cont.path.decode('utf-8') if c_cont.path else ""
+        self.format = c_cont.format
+        self.var_ids = c_cont.cfa_varids[0:c_cont.n_vars]
+        self.dim_ids = c_cont.cfa_dimids[0:c_cont.n_dims]
+        self.cont_ids = c_cont.cfa_contids[0:c_cont.n_conts]
+
+
+class AggregatedDimensionInfo:
+    """Snapshot of the fields of a C_AggregatedDimension"""
+    __slots__ = ("name", "length", "type")
+
+    def __init__(self, c_dim: C_AggregatedDimension):
+        self.name = c_dim.name.decode('utf-8')
+        self.length = c_dim.length
+        self.type = c_dim.cfa_dtype.type
+
+
+class AggregationInstructionInfo:
+    """Snapshot of the fields of a C_AggregationInstruction"""
+    __slots__ = ("term", "value", "scalar", "type")
+
+    def __init__(self, c_instr: C_AggregationInstruction):
+        self.term = c_instr.term.decode('utf-8')
+        self.value = c_instr.value.decode('utf-8') if c_instr.value else ""
+        self.scalar = bool(c_instr.scalar)
+        self.type = c_instr.type.type
+
+
+class AggregationVariableInfo:
+    """Snapshot of the fields of a C_AggregationVariable"""
+    __slots__ = ("name", "ndim", "dim_ids", "frag_dim_ids", "type",
+                 "instructions")
+
+    def __init__(self, c_var: C_AggregationVariable):
+        self.name = c_var.name.decode('utf-8')
+        self.ndim = c_var.cfa_ndim
+        self.dim_ids = c_var.cfa_dim_idp[0:c_var.cfa_ndim]
+        self.frag_dim_ids = c_var.cfa_frag_dim_idp[0:c_var.cfa_ndim]
+        self.type = c_var.cfa_dtype.type
+        self.instructions = [
+            AggregationInstructionInfo(c_var.cfa_instructionsp[i])
+            for i in range(0, c_var.n_instr)
+        ]
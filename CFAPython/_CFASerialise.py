@@ -0,0 +1,311 @@
+"""Helpers for serialising the aggregation definition variables of
+CFAVariables from Python, rather than from the CFA-C library.  The definition
+arrays for a variable are gathered from the CFA-C library in bulk, and then
+written with a single netCDF write per definition variable.
+Very large fragment tables can instead be built in shards, by several worker
+processes, into temporary netCDF files which are merged into the definition
+variables one shard at a time (see CFAVariable.setFragmentsSharded)."""
+from __future__ import annotations
+
+import hashlib
+import numpy
+from netCDF4 import Dataset
+
+import CFAPython
+from CFAPython import CFAType
+from CFAPython.CFAExceptions import CFAException
+
+# names of the extra dimensions of the location variable
+LOCATION_DIMS = ("i", "j")
+
+# default write-time options for the definition variables
+DEFAULT_OPTIONS = {
+    "compression": None,    # None, "zlib", "zstd", ... (see netCDF4 docs)
+    "complevel"  : 4,
+    "shuffle"    : True,
+    "chunksizes" : {},      # chunk shape, keyed by term
+    "deduplicate": True,    # share identical string definition variables
+}
+
+def prepare_definition(var: object) -> list[tuple[object, object]]:
+    """Gather the aggregation definition arrays for a CFAVariable from the
+    CFA-C library.  Returns a list of (AggregationInstructionInfo, array)."""
+    definition = []
+    for instr in var._variable.instructions:
+        if instr.term == "location" and var._isRegular():
+            # the fragment sizes are computed from the fragment definition
+            continue
+        elif instr.term == "location":
+            # the location is the size of each fragment along each dimension,
+            # padded to the maximum number of fragments along any dimension
+            sizes = var.getFragmentIndex().sizes
+            n_frags = max([len(s) for s in sizes] + [1])
+            array = numpy.ma.masked_all((len(sizes), n_frags), dtype='i4')
+            for d, s in enumerate(sizes):
+                array[d, 0:len(s)] = s
+        elif len(var._shards) > 0 and instr.term not in var._columns:
+            array = ShardedColumn(var._shards, instr, var.getFragmentDefinition())
+            if instr.scalar:
+                array = array.read(scalar=True)
+        else:
+            array = var.getFragmentColumn(instr.term)
+            if instr.scalar:
+                array = array.reshape(-1)[0:1].reshape(())
+            if instr.type == CFAType.CFAString:
+                # netCDF string variables cannot contain None
+                array = numpy.where(array == None, "", array)
+        definition.append((instr, array))
+    return definition
+
+def drop_location(nc_var: object) -> None:
+    """Remove the location term from the aggregated_data attribute of an
+    aggregation variable with a regular fragmentation, whose location
+    definition variable is not written"""
+    with CFAPython.nc_lock:
+        terms = nc_var.getncattr("aggregated_data").split()
+        pairs = [(terms[i], terms[i+1]) for i in range(0, len(terms) - 1, 2)]
+        nc_var.setncattr("aggregated_data", " ".join(
+            f"{term} {value}" for term, value in pairs if term != "location:"
+        ))
+
+def _find_dim(nc_grp: object, name: str, size: int) -> object:
+    """Find a dimension with name and size in nc_grp or its ancestors"""
+    grp = nc_grp
+    while grp is not None:
+        if name in grp.dimensions:
+            dim = grp.dimensions[name]
+            if dim.size == size:
+                return dim
+            # dimension names in a group shadow those in its ancestors
+            return None
+        grp = grp.parent
+    return None
+
+def define_dim(nc_grp: object, name: str, size: int) -> str:
+    """Get the name of a dimension of size that is visible from nc_grp,
+    creating it if necessary.  If a dimension called name already exists with
+    a different size then a numeric suffix is added to the name."""
+    dimname = name
+    n = 1
+    while True:
+        if _find_dim(nc_grp, dimname, size) is not None:
+            return dimname
+        if dimname not in nc_grp.dimensions:
+            nc_grp.createDimension(dimname, size)
+            return dimname
+        dimname = f"{name}{n}"
+        n += 1
+
+def _term_group(nc_grp: object, path: str) -> tuple[object, str]:
+    """Resolve the path of a term variable to the netCDF group it belongs in,
+    creating any groups in the path, and the name of the variable"""
+    if path.startswith("/"):
+        while nc_grp.parent is not None:
+            nc_grp = nc_grp.parent
+    elements = [p for p in path.split("/") if p]
+    for g in elements[:-1]:
+        if g in nc_grp.groups:
+            nc_grp = nc_grp.groups[g]
+        else:
+            nc_grp = nc_grp.createGroup(g)
+    return nc_grp, elements[-1]
+
+def _create_options(options: dict, term: str, dtype: object, 
+                    dims: tuple) -> dict:
+    """Build the keyword arguments for netCDF4 createVariable for the 
+    definition variable of a term"""
+    kwargs = {}
+    # scalar variables cannot be chunked or compressed
+    if len(dims) == 0:
+        return kwargs
+    chunksizes = options["chunksizes"].get(term, None)
+    if chunksizes is not None:
+        kwargs["chunksizes"] = chunksizes
+    # filters cannot be applied to variable length strings in netCDF-4 (see
+    # _string_width)
+    if options["compression"] and dtype is not str:
+        kwargs["compression"] = options["compression"]
+        kwargs["complevel"] = options["complevel"]
+        kwargs["shuffle"] = options["shuffle"]
+    return kwargs
+
+def _string_width(array: object) -> int:
+    """Get the width, in bytes, of the fixed width char array that holds a
+    string definition array.  Variable length strings cannot be compressed, so
+    when compression is set the string definition variables (e.g. the highly
+    repetitive file names) are written as compressed char arrays, which 
+    netCDF4 reads back as strings."""
+    if isinstance(array, ShardedColumn):
+        return array.width()
+    return max([len(v.encode()) for v in array.ravel()] + [1])
+
+def _assign_scalar(nc_var: object, value: object) -> None:
+    """Assign the value of a scalar netCDF variable.  netCDF4-python only
+    assigns variable length strings by integer index."""
+    if nc_var.dtype is str:
+        nc_var[0] = value
+    else:
+        nc_var.assignValue(value)
+
+def _assign_chars(nc_var: object, key: object, values: object) -> None:
+    """Assign strings to the selection key of a char definition variable (see
+    _string_width), encoded as UTF-8.  netCDF4 only converts one dimensional
+    string arrays to chars itself."""
+    width = nc_var.shape[-1]
+    values = numpy.asarray(numpy.ma.getdata(values))
+    chars = numpy.array([v.encode() for v in values.ravel()],
+                        dtype=f"S{width}").reshape(values.shape)
+    nc_var.set_auto_chartostring(False)
+    try:
+        nc_var[key] = chars.view("S1").reshape(values.shape + (width,))
+    finally:
+        nc_var.set_auto_chartostring(True)
+
+def _digest(array: numpy.ndarray) -> str:
+    """Return a digest of the shape and contents of a string array"""
+    h = hashlib.sha1(str(array.shape).encode())
+    for s in array.ravel():
+        h.update(s.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def write_definition(nc_grp: object, var: object,
+                     definition: list[tuple[object, object]],
+                     options: dict=DEFAULT_OPTIONS,
+                     written: dict=None) -> None:
+    """Write the aggregation definition arrays for a CFAVariable into the
+    netCDF group nc_grp, with a single write per definition variable.
+    Definition variables that already exist (for example, a file variable that
+    is shared between aggregation variables) are not written again.
+    If options["deduplicate"] is set then written maps the digest of each
+    string definition variable written so far to its path, and the aggregation
+    instruction of a term with identical values is pointed at the existing
+    variable instead of writing a copy."""
+    dimnames = var._dim_names
+    for instr, array in definition:
+        dedup = (options["deduplicate"] and written is not None and 
+                 instr.type == CFAType.CFAString and not instr.scalar and
+                 not isinstance(array, ShardedColumn))
+        if dedup:
+            digest = _digest(array)
+            if digest in written and written[digest] != instr.value:
+                var.setAggregationInstruction({
+                    instr.term: (written[digest], instr.scalar, instr.type)
+                })
+                continue
+        term_grp, name = _term_group(nc_grp, instr.value)
+        if dedup:
+            written[digest] = term_grp.path.rstrip("/") + "/" + name
+        if name in term_grp.variables:
+            continue
+        if instr.term == "location":
+            dims = tuple(define_dim(term_grp, LOCATION_DIMS[d], array.shape[d])
+                         for d in range(0, 2))
+            dtype = 'i4'
+        else:
+            if instr.scalar:
+                dims = ()
+            else:
+                dims = tuple(define_dim(term_grp, "f_" + dimnames[d],
+                                        array.shape[d])
+                             for d in range(0, len(dimnames)))
+            dtype = CFAPython.CFATypeToNumpy(instr.type)
+        kwargs = _create_options(options, instr.term, dtype, dims)
+        chars = (dtype is str and len(dims) > 0 and 
+                 bool(options["compression"]))
+        if chars:
+            width = _string_width(array)
+            dims = dims + (define_dim(term_grp, "strlen", width),)
+            dtype = "S1"
+            kwargs = _create_options(options, instr.term, dtype, dims)
+            if "chunksizes" in kwargs:
+                kwargs["chunksizes"] = tuple(kwargs["chunksizes"]) + (width,)
+        nc_var = term_grp.createVariable(name, dtype, dims, **kwargs)
+        if chars:
+            # read and written as strings by netCDF4
+            nc_var._Encoding = "utf-8"
+        if len(dims) == 0:
+            _assign_scalar(nc_var, array[()])
+        elif isinstance(array, ShardedColumn):
+            array.copyTo(nc_var)
+        elif chars:
+            _assign_chars(nc_var, Ellipsis, array)
+        else:
+            nc_var[...] = array
+
+def write_shard(build: object, start: int, stop: int, terms: dict,
+                frag_def: list[int], path: str) -> str:
+    """Build the fragment columns for the fragments start:stop along the first
+    dimension of the fragment definition, by calling build(start, stop), and
+    write them to the netCDF shard file at path.  terms maps each term to its
+    CFAType.  This is run in a worker process."""
+    columns = build(start, stop)
+    shape = [stop - start] + list(frag_def[1:])
+    with Dataset(path, mode='w') as nc_shard:
+        dims = tuple(nc_shard.createDimension(f"f{d}", s).name
+                     for d, s in enumerate(shape))
+        for term, T in terms.items():
+            if term not in columns:
+                raise CFAException(f"Term {term} not built for shard "
+                                   f"{start}:{stop}")
+            info = CFAPython.CFATypeToInfo(T)
+            column = numpy.ma.asanyarray(columns[term], dtype=info.dtype)
+            if T == CFAType.CFAString:
+                column = numpy.where(column == None, "", column)
+            if column.ndim == 0:
+                nc_var = nc_shard.createVariable(term, info.nc_type, ())
+                _assign_scalar(nc_var, column[()])
+            elif list(column.shape) != shape:
+                raise CFAException(-502)
+            else:
+                nc_var = nc_shard.createVariable(term, info.nc_type, dims)
+                nc_var[...] = column
+    return path
+
+class ShardedColumn:
+    def __init__(self, shards: list[tuple[int, int, str]], instr: object,
+                 frag_def: list[int]):
+        """The column of a term for every fragment, held in shard files as
+        (start, stop, path) along the first dimension of the fragment
+        definition"""
+        self._shards = shards
+        self._term = instr.term
+        self._type = instr.type
+        self.shape = tuple(frag_def)
+
+    def _shardValues(self, path: str) -> numpy.ndarray:
+        """Read the values of the term from a shard file"""
+        with CFAPython.nc_lock:
+            with Dataset(path, mode='r') as nc_shard:
+                return nc_shard[self._term][...]
+
+    def read(self, scalar: bool=False) -> numpy.ndarray:
+        """Read the whole column (or, if scalar, the value in the first shard)
+        into memory"""
+        if scalar:
+            return numpy.asanyarray(self._shardValues(self._shards[0][2]))
+        dtype = CFAPython.CFATypeToInfo(self._type).dtype
+        column = numpy.ma.masked_all(self.shape, dtype=dtype)
+        for start, stop, path in self._shards:
+            column[start:stop] = self._shardValues(path)
+        if self._type == CFAType.CFAString:
+            column = numpy.where(column == "", None, column)
+        return column
+
+    def width(self) -> int:
+        """Get the maximum length, in bytes, of the strings of the column,
+        reading one shard at a time"""
+        width = 1
+        for start, stop, path in self._shards:
+            values = numpy.ma.getdata(self._shardValues(path))
+            width = max([width] + [len(v.encode()) for v in values.ravel()])
+        return width
+
+    def copyTo(self, nc_var: object) -> None:
+        """Copy the column into a netCDF variable, one shard at a time"""
+        for start, stop, path in self._shards:
+            values = self._shardValues(path)
+            if nc_var.dtype == numpy.dtype("S1"):
+                _assign_chars(nc_var, slice(start, stop), values)
+            else:
+                nc_var[start:stop] = values
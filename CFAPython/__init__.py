@@ -1,19 +1,143 @@
 import ctypes
+from ctypes import (c_byte, c_char, c_short, c_int, c_float, c_double, 
+                    c_ubyte, c_ushort, c_uint, c_longlong, c_ulonglong, 
+                    c_char_p, pointer, sizeof, POINTER)
+from collections import namedtuple
+import contextlib
+import functools
 from importlib.machinery import EXTENSION_SUFFIXES
 import os.path
 import site
+import threading
 import netCDF4      # this import has to remain to get the dynamic libraries loaded
+import numpy
 from enum import IntEnum
 
 from CFAPython.CFAExceptions import CFAException
 
+# Neither the CFA-C library nor netCDF-C / HDF5 are thread-safe, so calls into
+# them are serialised by these locks.  They are separate so that a thread
+# reading a fragment file does not block a thread querying the CFA-C library.
+# Where both are needed, cfa_lock must be acquired before nc_lock, and the
+# CFA-C library must not be called while holding nc_lock.
+cfa_lock = threading.RLock()
+nc_lock = threading.RLock()
+
+class CFAAccessLock:
+    def __init__(self):
+        """A lock held, shared, by the threads reading a dataset and held
+        exclusively while the dataset is refreshed (see CFADataset.refresh),
+        so that the netCDF objects a reader has found are not closed under 
+        it.  Shared holds are reentrant.  New shared holds wait while the 
+        lock is held, or waited for, exclusively, so that a steady stream of
+        readers cannot starve a refresh."""
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        # the number of threads waiting for an exclusive hold
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def shared(self):
+        depth = getattr(self._local, "depth", 0)
+        me = threading.current_thread()
+        counted = depth == 0 and self._writer is not me
+        if counted:
+            with self._cond:
+                while self._writer is not None or self._writers_waiting > 0:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if counted:
+                with self._cond:
+                    self._readers -= 1
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        if getattr(self._local, "depth", 0) > 0:
+            raise CFAException("A dataset cannot be refreshed by a thread "
+                               "that is reading it")
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers > 0:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+                self._cond.notify_all()
+            self._writer = threading.current_thread()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+# the access lock of datasets that cannot be refreshed
+_NO_ACCESS_LOCK = CFAAccessLock()
+
+def access_lock(nc_object: object) -> CFAAccessLock:
+    """Get the CFAAccessLock of the dataset that a netCDF group or variable
+    belongs to"""
+    if nc_object is None:
+        return _NO_ACCESS_LOCK
+    with nc_lock:
+        grp = nc_object
+        if isinstance(nc_object, netCDF4.Variable):
+            grp = nc_object.group()
+        while grp.parent is not None:
+            grp = grp.parent
+    return getattr(grp, "__dict__", {}).get("_access", _NO_ACCESS_LOCK)
+
+def shared_access(method: object) -> object:
+    """Decorate a method of a CFAGroup or CFAVariable that reads from the 
+    netCDF dataset, to hold its CFAAccessLock (shared) while it runs"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with access_lock(self._nc_object).shared():
+            return method(self, *args, **kwargs)
+    return locked
+
+# CFA-C functions that also call netCDF-C
+_NETCDF_FUNCTIONS = ("cfa_load", "cfa_close",
+                     "_serialise_cfa_fragments_netcdf", 
+                     "_serialise_cfa_aggregation_instructions")
+
+class _LockedLibrary:
+    """Wrapper around the CFA-C library that holds cfa_lock (and nc_lock for
+    functions that call netCDF-C) for the duration of each call"""
+    def __init__(self, dll: ctypes.CDLL):
+        self._dll = dll
+
+    def __getattr__(self, name: str) -> object:
+        func = getattr(self._dll, name)
+        if name in _NETCDF_FUNCTIONS:
+            def locked(*args):
+                with cfa_lock, nc_lock:
+                    return func(*args)
+        else:
+            def locked(*args):
+                with cfa_lock:
+                    return func(*args)
+        # cache the wrapper so __getattr__ is only called once per function
+        self.__dict__[name] = locked
+        return locked
+
 libDLL = None
 def lib():
     global libDLL
     if not libDLL:
-        libpath = os.path.join(site.getsitepackages()[0], "CFAPython")
-        libpath = os.path.join(libpath, "cfa" + EXTENSION_SUFFIXES[0])
-        libDLL = ctypes.CDLL(libpath)
+        with cfa_lock:
+            if not libDLL:
+                libpath = os.path.join(site.getsitepackages()[0], "CFAPython")
+                libpath = os.path.join(libpath, "cfa" + EXTENSION_SUFFIXES[0])
+                libDLL = _LockedLibrary(ctypes.CDLL(libpath))
     return libDLL
 
 # define the file format enum
@@ -42,32 +166,99 @@ class CFAType(IntEnum):
     CFAUInt64 = 11,             # /**< unsigned 8-byte int */
     CFAString = 12              # /**< really a char* */
 
+# define the registry of type information for each CFAType.  Every path that
+# needs to convert between a CFAType and a ctypes or NumPy type (or encode or
+# decode a value for the CFA-C library) uses this table, rather than switching
+# on the CFAType.
+# ctype    : the ctypes type of a single value
+# ptype    : the ctypes type that cfa_var_get1_frag returns a value through
+# nc_type  : the specifier required by NumPy / netCDF4-python
+# dtype    : the NumPy dtype of an array of values
+# itemsize : the size (in bytes) of a single value
+# encode   : Python value -> (cdata, length) for cfa_var_put1_frag
+# decode   : ptype -> Python value
+CFATypeInfo = namedtuple(
+    "CFATypeInfo", 
+    ["ctype", "ptype", "nc_type", "dtype", "itemsize", "encode", "decode"]
+)
+
+def _encode_value(ctype):
+    """Return an encoder that packs a Python value as a pointer to a ctype, 
+    with a length of 1, ready to pass to cfa_var_put1_frag"""
+    def encode(value):
+        return pointer(ctype(value)), 1
+    return encode
+
+def _decode_value(cdata):
+    """Decode a pointer to a ctype, as returned by cfa_var_get1_frag"""
+    return cdata.contents.value
+
+def _encode_string(value):
+    """Encode a Python string as a char*, with a length including the 
+    terminating NULL"""
+    return c_char_p(value.encode()), c_int(len(value)+1)
+
+def _decode_string(cdata):
+    """Decode a char*, as returned by cfa_var_get1_frag"""
+    if cdata.value is None:
+        return None
+    return cdata.value.decode('utf-8')
+
+def _type_info(ctype, nc_type):
+    """Build the CFATypeInfo for a numeric ctype"""
+    return CFATypeInfo(ctype, POINTER(ctype), nc_type, numpy.dtype(nc_type),
+                       sizeof(ctype), _encode_value(ctype), _decode_value)
+
+CFATypes = {
+    CFAType.CFAByte   : _type_info(c_byte, 'i1'),
+    CFAType.CFAChar   : _type_info(c_char, 'c'),
+    CFAType.CFAShort  : _type_info(c_short, 'i2'),
+    CFAType.CFAInt    : _type_info(c_int, 'i4'),
+    CFAType.CFAFloat  : _type_info(c_float, 'f4'),
+    CFAType.CFADouble : _type_info(c_double, 'f8'),
+    CFAType.CFAUByte  : _type_info(c_ubyte, 'u1'),
+    CFAType.CFAUShort : _type_info(c_ushort, 'u2'),
+    CFAType.CFAUInt   : _type_info(c_uint, 'u4'),
+    CFAType.CFAInt64  : _type_info(c_longlong, 'i8'),
+    CFAType.CFAUInt64 : _type_info(c_ulonglong, 'u8'),
+    CFAType.CFAString : CFATypeInfo(c_char_p, c_char_p, str, 
+                                    numpy.dtype(object), sizeof(c_char_p),
+                                    _encode_string, _decode_string),
+}
+
+def CFATypeToInfo(cfa_type: CFAType) -> CFATypeInfo:
+    """Return the CFATypeInfo for a CFAType"""
+    try:
+        return CFATypes[cfa_type]
+    except KeyError:
+        raise CFAException(-504)    # not a type (NAT)
+
 def CFATypeToNumpy(cfa_type: CFAType):
     """Return the specifier required by Numpy (and netCDF4-python) for a CFAType"""
-    if cfa_type == CFAType.CFANat:
-        raise CFAException(-504)    # not a type (NAT)
-    elif cfa_type == CFAType.CFAByte:                # /**< signed 1 byte integer */
-        return 'i1'
-    elif cfa_type == CFAType.CFAChar:                # /**< ISO/ASCII character */
-        return 'c'
-    elif cfa_type == CFAType.CFAShort:               # /**< signed 2 byte integer */
-        return 'i2'
-    elif cfa_type == CFAType.CFAInt:                 # /**< signed 4 byte integer */
-        return 'i4'
-    #CFALong  = 4,
-    elif cfa_type == CFAType.CFAFloat:               # /**< single precision floating point number */
-        return 'f4'
-    elif cfa_type == CFAType.CFADouble:              # /**< double precision floating point number */
-        return 'f8'
-    elif cfa_type == CFAType.CFAUByte:               # /**< unsigned 1 byte int */
-        return 'u1'
-    elif cfa_type == CFAType.CFAUShort:              # /**< unsigned 2-byte int */
-        return 'u2'
-    elif cfa_type == CFAType.CFAUInt:                # /**< unsigned 4-byte int */
-        return 'u4'
-    elif cfa_type == CFAType.CFAInt64:               # /**< signed 8-byte int */
-        return 'i8'
-    elif cfa_type == CFAType.CFAUInt64:              # /**< unsigned 8-byte int */
-        return 'u8'
-    elif cfa_type == CFAType.CFAString:              # /**< really a char* */
-        return str
\ No newline at end of file
+    return CFATypeToInfo(cfa_type).nc_type
+
+def CFATypeFromNumpy(dtype: object) -> CFAType:
+    """Return the CFAType for a NumPy dtype (or netCDF4-python type)"""
+    if dtype is str or numpy.dtype(dtype).kind in "OSU":
+        return CFAType.CFAString
+    for cfa_type, info in CFATypes.items():
+        if info.dtype == numpy.dtype(dtype):
+            return cfa_type
+    raise CFAException(-504)    # not a type (NAT)
+
+def CFADecodeColumn(cfa_type: CFAType, buffer: object) -> numpy.ndarray:
+    """Decode a whole column of values of a CFAType from a contiguous buffer
+    (for example, a ctypes array) with a single call, rather than decoding
+    each value in turn."""
+    info = CFATypeToInfo(cfa_type)
+    if cfa_type == CFAType.CFAString:
+        # strings are an array of char* and have to be decoded individually
+        return numpy.array(
+            [v.decode('utf-8') if v is not None else None for v in buffer],
+            dtype=info.dtype
+        )
+    return numpy.frombuffer(buffer, dtype=info.dtype)
+
+# imported last, as these modules use the definitions above
+from CFAPython.CFAMultiDataset import open_mfcfa
+from CFAPython.CFARefragment import refragment
@@ -114,7 +114,15 @@ if __name__ == "__main__":
         long_description = '''
     Python bindings for the CFA-C library.
     ''',
-        install_requires=["netCDF4"],
+        install_requires=["netCDF4", "numpy"],
         packages=["CFAPython"],
+        entry_points={
+            "console_scripts": [
+                "cfa-validate=CFAPython.CFAValidate:main",
+                "cfa-references=CFAPython.CFAReferences:main",
+                "cfa-aggregate=CFAPython.CFAAggregate:main",
+                "cfa-refragment=CFAPython.CFARefragment:main",
+            ]
+        },
         ext_modules = build_cfa_extension()
     )
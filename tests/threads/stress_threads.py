@@ -0,0 +1,110 @@
+"""Stress test for concurrent read access to a single CFADataset.  Creates an
+aggregation of twelve monthly fragments, then runs many threads that each call
+getFragment and read slices of the aggregated data from the same, shared,
+CFADataset, and checks every result against the expected values."""
+from CFAPython.CFADataset import CFADataset
+from CFAPython import CFAFileFormat
+from CFAPython import CFAType
+from netCDF4 import Dataset
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import sys
+
+# set the test path to be relative to this file
+this_path = os.path.dirname(__file__)
+test_dir = os.path.join(this_path, "../../examples/test/threads")
+cfa_path = os.path.join(test_dir, "stress_threads.nc")
+
+N_MONTHS = 12
+N_LAT = 73
+N_LON = 144
+
+def expected(t, lat, lon):
+    """The value stored in the fragments at each location"""
+    return t * 1e6 + lat * 1e3 + lon
+
+def stress_threads_save():
+    print("Stress threads save")
+    if not (os.path.exists(test_dir)):
+        os.makedirs(test_dir)
+
+    # write one fragment file per month
+    t, lat, lon = np.meshgrid(np.arange(N_MONTHS), np.arange(N_LAT),
+                              np.arange(N_LON), indexing='ij')
+    data = expected(t, lat, lon)
+    for m in range(0, N_MONTHS):
+        frag_path = os.path.join(test_dir, f"month_{m:02d}.nc")
+        with Dataset(frag_path, mode="w") as nc_frag:
+            nc_frag.createDimension("time", 1)
+            nc_frag.createDimension("latitude", N_LAT)
+            nc_frag.createDimension("longitude", N_LON)
+            frag_var = nc_frag.createVariable(
+                "temp", "f8", ("time", "latitude", "longitude")
+            )
+            frag_var[:] = data[m:m+1]
+
+    # write the aggregation file
+    ds = CFADataset(cfa_path, mode="w", format=CFAFileFormat.CFANetCDF)
+    ds.CFA.createDimension("time", CFAType.CFAInt, N_MONTHS)
+    ds.CFA.createDimension("latitude", CFAType.CFADouble, N_LAT)
+    ds.CFA.createDimension("longitude", CFAType.CFADouble, N_LON)
+    var = ds.CFA.createVariable("temp", CFAType.CFADouble,
+                                ("time", "latitude", "longitude"))
+    var.setAggregationInstruction({
+        "location": ("aggregation_location", False, CFAType.CFAInt),
+        "file"    : ("aggregation_file", False, CFAType.CFAString),
+        "format"  : ("aggregation_format", True, CFAType.CFAString),
+        "address" : ("aggregation_address", False, CFAType.CFAString),
+    })
+    var.setFragmentDefinition([N_MONTHS, 1, 1], regular=True)
+    for m in range(0, N_MONTHS):
+        var.setFragment(
+            frag_loc=[m, 0, 0],
+            frag={
+                "file"   : f"month_{m:02d}.nc",
+                "format" : "nc",
+                "address": "temp"
+            })
+    ds.close()
+
+def stress_threads_load(n_threads: int, n_iterations: int):
+    print(f"Stress threads load: {n_threads} threads, "
+          f"{n_iterations} iterations")
+    ds = CFADataset(cfa_path, mode="r", format=CFAFileFormat.CFANetCDF)
+    var = ds.CFA.getVariable("temp")
+
+    def work(seed):
+        rng = np.random.default_rng(seed)
+        for i in range(0, n_iterations):
+            # metadata and a single fragment
+            m = int(rng.integers(0, N_MONTHS))
+            frag = var.getFragment(frag_loc=[m, 0, 0])
+            assert(frag["file"] == f"month_{m:02d}.nc")
+            assert(var.getFragmentDefinition() == [N_MONTHS, 1, 1])
+            # a slice across several fragments
+            t0 = int(rng.integers(0, N_MONTHS))
+            t1 = int(rng.integers(t0+1, N_MONTHS+1))
+            y0 = int(rng.integers(0, N_LAT))
+            x0 = int(rng.integers(0, N_LON))
+            data = var[t0:t1, y0, x0:]
+            t, lon = np.meshgrid(np.arange(t0, t1), np.arange(x0, N_LON),
+                                 indexing='ij')
+            assert(np.array_equal(data, expected(t, y0, lon)))
+        return n_iterations
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        total = sum(pool.map(work, range(0, n_threads)))
+    print(f"{total} iterations completed")
+    ds.close()
+
+if __name__ == "__main__":
+    if sys.argv[1] == "S":
+        stress_threads_save()
+    elif sys.argv[1] == "L":
+        n_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+        n_iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        stress_threads_load(n_threads, n_iterations)
+    else:
+        raise SystemExit(f"Command line option: {sys.argv[1]} not recognised.")
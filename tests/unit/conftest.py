@@ -0,0 +1,117 @@
+"""Helpers for the unit tests, which run without the CFA-C library: the
+aggregation variables are stand-ins that provide the fragment table and
+index directly, as CFAVariable does in read mode."""
+import os.path
+from types import SimpleNamespace
+
+import numpy
+import pytest
+from netCDF4 import Dataset
+
+from CFAPython import CFAType
+from CFAPython.CFAFragmentIndex import CFAFragmentIndex
+
+class FakeVariable:
+    def __init__(self, agg: object, name: str, sizes: list, files: object,
+                 addresses: object):
+        """An aggregation variable of the aggregation file agg (an open
+        netCDF4 Dataset), with the fragment sizes along each dimension and
+        the file and address of each fragment"""
+        self.name = name
+        self.nc = agg[name]
+        self.dtype = self.nc.dtype
+        self._fragment_reader = None
+        self._index = CFAFragmentIndex([int(numpy.sum(s)) for s in sizes],
+                                       sizes)
+        self._files = numpy.array(files, dtype=object)
+        self._addresses = numpy.array(addresses, dtype=object)
+        self._dim_names = [f"dim{d}" for d in range(0, len(sizes))]
+        self._variable = SimpleNamespace(instructions=[
+            SimpleNamespace(term="location", value="aggregation_location",
+                            scalar=False, type=CFAType.CFAInt),
+            SimpleNamespace(term="file", value="aggregation_file",
+                            scalar=False, type=CFAType.CFAString),
+            SimpleNamespace(term="address", value="aggregation_address",
+                            scalar=False, type=CFAType.CFAString),
+        ])
+
+    @property
+    def shape(self) -> list:
+        return self._index.shape
+
+    def getFragmentIndex(self) -> CFAFragmentIndex:
+        return self._index
+
+    def getFragmentDefinition(self) -> list:
+        return self._index.frag_def
+
+    def getFragmentColumn(self, term: str) -> numpy.ndarray:
+        return {"file": self._files, "address": self._addresses}[term]
+
+    def _fragmentColumnReader(self, term: str) -> object:
+        column = self.getFragmentColumn(term).reshape(-1)
+        return lambda start, stop: column[start:stop]
+
+    def _resolveFiles(self, files: numpy.ndarray) -> numpy.ndarray:
+        from CFAPython.CFAFragmentReader import CFAFragmentReader
+        return CFAFragmentReader(self)._resolver.resolveColumn(files, ())
+
+    def getFragmentFiles(self) -> numpy.ndarray:
+        from CFAPython.CFAFragmentReader import CFAFragmentReader
+        return CFAFragmentReader(self)._fragmentFiles()
+
+    def getPresentFragments(self) -> numpy.ndarray:
+        from CFAPython.CFAFragmentReader import CFAFragmentReader
+        return ~CFAFragmentReader(self)._absentFragments()
+
+    def _findNetCDFVariable(self, path: str) -> object:
+        return self.nc.group().variables.get(path, None)
+
+class FakeGroup:
+    def __init__(self, agg: object, variables: list):
+        """The root group of an aggregation file agg, with its aggregation
+        variables"""
+        self.nc = agg
+        self._nc_object = agg
+        self._variables = variables
+
+    def walkVariables(self):
+        for var in self._variables:
+            yield self, var
+
+class FakeDataset:
+    def __init__(self, agg: object, variables: list):
+        """A read mode CFADataset of the aggregation file agg"""
+        self._agg = agg
+        self.CFA = FakeGroup(agg, variables)
+
+    def __getitem__(self, name: str) -> object:
+        return self._agg[name]
+
+def write_fragment(path: str, name: str, dims: dict, values: object,
+                   fill_value: object=None, units: str=None) -> None:
+    """Write a fragment file with a single variable"""
+    with Dataset(path, "w") as nc:
+        for dim, size in dims.items():
+            nc.createDimension(dim, size)
+        var = nc.createVariable(name, numpy.asarray(values).dtype,
+                                tuple(dims), fill_value=fill_value)
+        if units is not None:
+            var.units = units
+        var[...] = values
+
+@pytest.fixture
+def aggregation(tmp_path):
+    """An open aggregation file, with a scalar variable temp, in tmp_path"""
+    agg = Dataset(os.path.join(tmp_path, "agg.nc"), "w")
+    var = agg.createVariable("temp", "f8", fill_value=-999.0)
+    var.units = "K"
+    yield agg
+    agg.close()
+
+@pytest.fixture(autouse=True)
+def close_files():
+    """Close the fragment files held open by the storage backends"""
+    from CFAPython.CFAStorage import close_backends
+    yield
+    close_backends()
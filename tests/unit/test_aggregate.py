@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+from CFAPython.CFAAggregate import _blocks, _check_files
+from CFAPython.CFAExceptions import CFAException
+
+def _file(path, time, lat=(0.0, 1.0)):
+    return {"path": path,
+            "dims": {"time": len(time), "lat": len(lat)},
+            "coords": {"time": (numpy.array(time, dtype="f8"), "f8", {}),
+                       "lat": (numpy.array(lat, dtype="f8"), "f8", {})},
+            "variables": {"temp": (("time", "lat"), "f8", {})}}
+
+def test_blocks_ascending():
+    files = [_file("b", [2.0, 3.0]), _file("a", [0.0, 1.0]), _file("c", [4.0])]
+    file_block, sizes, coords = _blocks(files, "time")
+    assert file_block == [1, 0, 2]
+    assert sizes == [2, 2, 1]
+    assert coords.tolist() == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+def test_blocks_descending():
+    files = [_file("a", [1.0, 0.0]), _file("b", [5.0]), _file("c", [3.0, 2.0])]
+    file_block, sizes, coords = _blocks(files, "time")
+    assert file_block == [2, 0, 1]
+    assert coords.tolist() == [5.0, 3.0, 2.0, 1.0, 0.0]
+
+def test_blocks_mixed_directions():
+    files = [_file("a", [0.0, 1.0]), _file("b", [3.0, 2.0])]
+    with pytest.raises(CFAException):
+        _blocks(files, "time")
+
+def test_blocks_overlap():
+    files = [_file("a", [3.0, 2.0]), _file("b", [2.5, 1.0])]
+    with pytest.raises(CFAException):
+        _blocks(files, "time")
+
+def test_check_files_sizes():
+    files = [_file("a", [0.0]), _file("b", [1.0], lat=(0.0, 1.0, 2.0))]
+    with pytest.raises(CFAException):
+        _check_files(files, ["time"])
+    _check_files([_file("a", [0.0]), _file("b", [1.0])], ["time"])
@@ -0,0 +1,53 @@
+import datetime
+
+import numpy
+import pytest
+
+from CFAPython.CFACoordinateIndex import CFACoordinateIndex
+from CFAPython.CFAExceptions import CFAException
+
+def test_slice_ascending():
+    index = CFACoordinateIndex(numpy.arange(0.0, 10.0))
+    assert index.getSlice(slice(2, 5)) == slice(2, 6)
+    assert index.getSlice(slice(5, 2)) == slice(2, 6)
+    assert index.getSlice(slice(7.5, None)) == slice(8, 10)
+    assert index.getSlice(slice(None, 1.5)) == slice(0, 2)
+    assert index.getSlice(3.0) == slice(3, 4)
+
+def test_slice_descending():
+    values = numpy.arange(90.0, -91.0, -10.0)
+    index = CFACoordinateIndex(values)
+    key = index.getSlice(slice(-10, 10))
+    assert values[key].tolist() == [10.0, 0.0, -10.0]
+    # open ranges select by value, not by storage order
+    assert values[index.getSlice(slice(75, None))].tolist() == [90.0, 80.0]
+    assert values[index.getSlice(slice(None, -75))].tolist() == [-80.0, -90.0]
+
+def test_value_not_found():
+    index = CFACoordinateIndex([0.0, 1.0, 2.0])
+    with pytest.raises(CFAException):
+        index.getSlice(1.5)
+
+def test_not_monotonic():
+    with pytest.raises(CFAException):
+        CFACoordinateIndex([0.0, 2.0, 1.0])
+
+def test_time_periods():
+    index = CFACoordinateIndex(numpy.arange(0.0, 365.0),
+                               units="days since 2001-01-01",
+                               calendar="365_day")
+    assert index.getSlice("2001-03") == slice(59, 90)
+    assert index.getSlice("2001-12-31") == slice(364, 365)
+    # the upper period is included
+    assert index.getSlice(slice("2001-02", "2001-03")) == slice(31, 90)
+    assert index.getSlice("2001") == slice(0, 365)
+
+def test_datetime_label():
+    index = CFACoordinateIndex(numpy.arange(0.0, 10.0),
+                               units="days since 2001-01-01")
+    assert index.getSlice(datetime.datetime(2001, 1, 3)) == slice(2, 3)
+
+def test_time_label_without_time_units():
+    index = CFACoordinateIndex(numpy.arange(0.0, 10.0), units="m")
+    with pytest.raises(CFAException):
+        index.getSlice("2001-03")
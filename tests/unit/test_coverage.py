@@ -0,0 +1,63 @@
+import numpy
+
+from CFAPython.CFACoverage import check_coverage
+
+class _Variable:
+    name = "temp"
+
+    def __init__(self, shape, sizes, present=None, writes=()):
+        self.shape = shape
+        self._sizes = sizes
+        self._present = present
+        self._fragment_writes = list(writes)
+
+    def getFragmentDefinition(self):
+        return [len(s) for s in self._sizes]
+
+    def _fragmentSizes(self):
+        return self._sizes
+
+    def getPresentFragments(self):
+        if self._present is None:
+            return numpy.ones(self.getFragmentDefinition(), dtype=bool)
+        return numpy.asarray(self._present)
+
+def test_exact_tiling():
+    report = check_coverage(_Variable([10, 4], [numpy.array([5, 5]),
+                                                numpy.array([4])]))
+    assert report.ok
+
+def test_sizes_past_the_end_overlap():
+    report = check_coverage(_Variable([10, 4], [numpy.array([5, 6]),
+                                                numpy.array([4])]))
+    assert not report.ok
+    assert report.overlaps.tolist() == [1]
+
+def test_sizes_short_leave_a_hole():
+    report = check_coverage(_Variable([10, 4], [numpy.array([5, 4]),
+                                                numpy.array([4])]))
+    assert report.holes.tolist() == [1]
+    assert report.getLocations(report.holes).tolist() == [[1, 0]]
+
+def test_masked_size_is_a_hole():
+    sizes = numpy.ma.masked_array([5, 5], mask=[False, True])
+    report = check_coverage(_Variable([10], [sizes]))
+    assert 1 in report.holes.tolist()
+
+def test_absent_fragments():
+    var = _Variable([10], [numpy.array([5, 5])], present=[True, False])
+    assert check_coverage(var).holes.tolist() == [1]
+    assert check_coverage(var, allow_absent=True).ok
+
+def test_terms_set_in_several_calls_are_not_overlaps():
+    # (fragment, data location) pairs: fragment 0 set twice from location 0
+    var = _Variable([10], [numpy.array([5, 5])], writes=[(0, 0), (0, 0),
+                                                          (1, 5)])
+    assert check_coverage(var).ok
+
+def test_different_data_locations_in_one_fragment_overlap():
+    var = _Variable([10], [numpy.array([5, 5])], writes=[(0, 0), (0, 3),
+                                                          (1, 5)])
+    report = check_coverage(var)
+    assert report.overlaps.tolist() == [0]
+    assert "overlaps" in report.summary()
@@ -0,0 +1,43 @@
+import os.path
+
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFileResolver import CFAFileResolver, parse_substitutions
+
+def test_parse_substitutions():
+    assert parse_substitutions("${base}: /data/ ${site}: https://host/") == (
+        ("base", "/data/"), ("site", "https://host/")
+    )
+    assert parse_substitutions(None) == ()
+
+def test_resolve_relative_and_absolute(tmp_path):
+    resolver = CFAFileResolver(base_dir=str(tmp_path))
+    assert resolver.resolve("a/b.nc") == os.path.join(tmp_path, "a", "b.nc")
+    assert resolver.resolve("/x/b.nc") == "/x/b.nc"
+    assert resolver.resolve("s3://bucket/b.nc") == "s3://bucket/b.nc"
+
+def test_substitutions_take_precedence_over_defaults():
+    resolver = CFAFileResolver(base_dir="/")
+    defaults = (("base", "/data/"),)
+    assert resolver.resolve("${base}b.nc", defaults) == "/data/b.nc"
+    generation = resolver.generation
+    resolver.setSubstitutions({"base": "/archive/"})
+    assert resolver.generation == generation + 1
+    assert resolver.resolve("${base}b.nc", defaults) == "/archive/b.nc"
+
+def test_missing_substitution():
+    resolver = CFAFileResolver()
+    with pytest.raises(CFAException):
+        resolver.resolve("${base}b.nc")
+
+def test_resolve_column():
+    resolver = CFAFileResolver(base_dir="/data")
+    files = numpy.ma.masked_array(numpy.array(["a.nc", "b.nc", "a.nc"],
+                                              dtype=object),
+                                  mask=[False, True, False])
+    column = resolver.resolveColumn(files)
+    assert column.tolist() == ["/data/a.nc", None, "/data/a.nc"]
+    # each distinct name is resolved once, to the same string
+    assert column[0] is column[2]
@@ -0,0 +1,55 @@
+import os.path
+
+import numpy
+import pytest
+from netCDF4 import Dataset
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentIndex import CFAFragmentIndex, normalise_key
+import CFAPython._CFASerialise as CFASerialise
+
+@pytest.mark.parametrize("n", [0, -1, 11])
+def test_regular_rejects_invalid_splits(n):
+    with pytest.raises(CFAException):
+        CFAFragmentIndex.regular([10], [n])
+
+def test_regular_spreads_the_remainder():
+    index = CFAFragmentIndex.regular([10, 365], [6, 12])
+    assert index.sizes[0].tolist() == [2, 2, 2, 2, 1, 1]
+    assert index.sizes[1].tolist() == [31] * 5 + [30] * 7
+    assert index.is_regular
+
+@pytest.mark.parametrize("sizes", [[2, 2, 2, 2, 1, 1], [3, 3, 3, 1],
+                                   [4, 1, 3, 2]])
+def test_locate_and_extent(sizes):
+    index = CFAFragmentIndex([sum(sizes)], [sizes])
+    bounds = numpy.cumsum([0] + sizes)
+    for f in range(0, len(sizes)):
+        assert index.getExtent([f]) == [(bounds[f], bounds[f+1])]
+        for x in range(bounds[f], bounds[f+1]):
+            assert index.getFragmentLocation([x]) == [f]
+
+def test_sizes_must_sum_to_shape():
+    with pytest.raises(CFAException):
+        CFAFragmentIndex([10], [[3, 3, 3]])
+
+def test_intersect():
+    index = CFAFragmentIndex([10], [[4, 4, 2]])
+    slices, squeeze = normalise_key(slice(3, 10, 2), index.shape)
+    pieces = list(index.intersect(slices))
+    assert [p[0] for p in pieces] == [[0], [1], [2]]
+    assert [p[1] for p in pieces] == [(slice(3, 4, 2),), (slice(1, 4, 2),),
+                                      (slice(1, 2, 2),)]
+    assert [p[2] for p in pieces] == [(slice(0, 1),), (slice(1, 3),),
+                                      (slice(3, 4),)]
+    assert squeeze == []
+
+def test_drop_location(tmp_path):
+    with Dataset(os.path.join(tmp_path, "agg.nc"), "w") as nc:
+        var = nc.createVariable("temp", "f8")
+        var.aggregated_data = ("location: aggregation_location "
+                               "file: aggregation_file "
+                               "address: aggregation_address")
+        CFASerialise.drop_location(var)
+        assert var.aggregated_data == ("file: aggregation_file "
+                                       "address: aggregation_address")
@@ -0,0 +1,80 @@
+import os.path
+import threading
+
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentReader import CFAFragmentReader
+from conftest import FakeVariable, write_fragment
+
+def _variable(tmp_path, agg, absent=()):
+    """An aggregation of three fragments of four values, 0 to 11, with the
+    fragments in absent missing"""
+    files = []
+    addresses = []
+    for f in range(0, 3):
+        path = os.path.join(tmp_path, f"frag{f}.nc")
+        write_fragment(path, "temp", {"time": 4}, numpy.arange(4.0) + 4 * f,
+                       fill_value=-999.0)
+        files.append(None if f in absent else path)
+        addresses.append(None if f in absent else "temp")
+    return FakeVariable(agg, "temp", [[4, 4, 4]], files, addresses)
+
+def test_read_across_fragments(tmp_path, aggregation):
+    reader = CFAFragmentReader(_variable(tmp_path, aggregation))
+    assert reader.read((slice(2, 10, 3),)).tolist() == [2.0, 5.0, 8.0]
+    assert reader.read((11,)) == 11.0
+
+def test_absent_fragments_are_masked(tmp_path, aggregation):
+    reader = CFAFragmentReader(_variable(tmp_path, aggregation, absent=(1,)))
+    data = reader.read((slice(None),))
+    assert numpy.ma.getmaskarray(data).tolist() == [False] * 4 + [True] * 4 + \
+        [False] * 4
+    assert data[8] == 8.0
+
+def test_concurrent_reads(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    reader = CFAFragmentReader(var)
+    expected = numpy.arange(12.0)
+    errors = []
+
+    def read(start):
+        try:
+            for i in range(0, 50):
+                s0 = (start + i) % 12
+                data = reader.read((slice(s0, 12),))
+                assert data.tolist() == expected[s0:].tolist()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+def _integer_variable(tmp_path, agg, dtype, values, units):
+    var = agg.createVariable("count", dtype, fill_value=-99)
+    var.units = "degC"
+    path = os.path.join(tmp_path, "count.nc")
+    write_fragment(path, "count", {"time": len(values)},
+                   numpy.array(values, dtype=dtype), fill_value=-99,
+                   units=units)
+    return FakeVariable(agg, "count", [[len(values)]], [path], ["count"])
+
+def test_integer_units_are_rounded(tmp_path, aggregation):
+    var = _integer_variable(tmp_path, aggregation, "i4", [300, 250, -99],
+                            "K")
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert data.dtype == numpy.int32
+    # 26.85 and -23.15 round to the nearest integer, rather than truncating
+    assert data[0:2].tolist() == [27, -23]
+    assert numpy.ma.getmaskarray(data).tolist() == [False, False, True]
+
+def test_integer_units_out_of_range(tmp_path, aggregation):
+    # 0 K is -273 degC, which does not fit in a byte
+    var = _integer_variable(tmp_path, aggregation, "i1", [0, 10], "K")
+    with pytest.raises(CFAException):
+        CFAFragmentReader(var).read((slice(None),))
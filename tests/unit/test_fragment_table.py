@@ -0,0 +1,52 @@
+import os.path
+
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAFragmentTable import (fragment_batches, fragment_table,
+                                        write_fragment_table)
+from conftest import FakeVariable
+
+pa = pytest.importorskip("pyarrow")
+
+def _variable(agg):
+    """Two by two fragments, with one absent and one in the aggregation
+    file"""
+    files = [["a.nc", "b.nc"], [None, "/data/d.nc"]]
+    addresses = [["temp", "temp"], ["temp_frag", None]]
+    return FakeVariable(agg, "temp", [[3, 2], [4, 1]], files, addresses)
+
+def test_table_columns(aggregation):
+    table = fragment_table(_variable(aggregation))
+    assert table.column_names == ["fragment", "f_dim0", "f_dim1",
+                                  "start_dim0", "start_dim1", "size_dim0",
+                                  "size_dim1", "file", "address"]
+    rows = table.to_pydict()
+    assert rows["fragment"] == [0, 1, 2, 3]
+    assert rows["f_dim0"] == [0, 0, 1, 1]
+    assert rows["start_dim1"] == [0, 4, 0, 4]
+    assert rows["size_dim0"] == [3, 3, 2, 2]
+    assert rows["file"] == ["a.nc", "b.nc", None, "/data/d.nc"]
+    assert rows["address"] == ["temp", "temp", "temp_frag", None]
+
+def test_table_resolve_files(tmp_path, aggregation):
+    table = fragment_table(_variable(aggregation), resolve_files=True)
+    files = table.column("file").to_pylist()
+    assert files == [os.path.join(tmp_path, "a.nc"),
+                     os.path.join(tmp_path, "b.nc"), None, "/data/d.nc"]
+
+def test_batches(aggregation):
+    batches = list(fragment_batches(_variable(aggregation), batch_size=3))
+    assert [b.num_rows for b in batches] == [3, 1]
+    assert batches[1].column(0).to_pylist() == [3]
+    with pytest.raises(CFAException):
+        list(fragment_batches(_variable(aggregation), batch_size=0))
+
+def test_write_fragment_table(tmp_path, aggregation):
+    import pyarrow.parquet
+    path = os.path.join(tmp_path, "fragments.parquet")
+    var = _variable(aggregation)
+    assert write_fragment_table(var, path, batch_size=3) == 4
+    table = pyarrow.parquet.read_table(path)
+    assert table.equals(fragment_table(var))
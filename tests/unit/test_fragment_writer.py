@@ -0,0 +1,88 @@
+import os.path
+import pathlib
+
+import numpy
+from netCDF4 import Dataset
+
+from CFAPython.CFAFragmentReader import CFAFragmentReader
+from CFAPython.CFAFragmentWriter import CFAFragmentWriter
+from conftest import FakeVariable, write_fragment
+
+def _variable(tmp_path, agg):
+    files = []
+    for f in range(0, 2):
+        path = os.path.join(tmp_path, f"frag{f}.nc")
+        write_fragment(path, "temp", {"time": 4}, numpy.zeros(4),
+                       fill_value=-999.0)
+        files.append(path)
+    return FakeVariable(agg, "temp", [[4, 4]], files, ["temp", "temp"])
+
+def test_write_across_fragments(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    CFAFragmentWriter(var).write((slice(2, 6),), [1.0, 2.0, 3.0, 4.0])
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert data.tolist() == [0.0, 0.0, 1.0, 2.0, 3.0, 4.0, 0.0, 0.0]
+
+def test_write_masked(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    value = numpy.ma.masked_array([1.0, 2.0, 3.0, 4.0],
+                                  mask=[False, True, True, False])
+    CFAFragmentWriter(var).write((slice(2, 6),), value)
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert numpy.ma.getmaskarray(data).tolist() == [
+        False, False, False, True, True, False, False, False
+    ]
+    assert data[2] == 1.0 and data[5] == 4.0
+
+def test_write_broadcast_masked(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    CFAFragmentWriter(var).write((slice(None),), numpy.ma.masked)
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert numpy.ma.getmaskarray(data).all()
+
+def test_write_buffered(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    writer = CFAFragmentWriter(var, buffered=True)
+    writer.write((0,), 5.0)
+    writer.write((7,), 6.0)
+    assert CFAFragmentReader(var).read((0,)) == 0.0
+    writer.flush()
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert data[0] == 5.0 and data[7] == 6.0
+
+def test_write_converts_units(tmp_path, aggregation):
+    path = os.path.join(tmp_path, "frag.nc")
+    write_fragment(path, "temp", {"time": 2}, numpy.array([300.0, 300.0]),
+                   units="degC")
+    var = FakeVariable(aggregation, "temp", [[2]], [path], ["temp"])
+    assert CFAFragmentReader(var).read((0,)) == 573.15
+    CFAFragmentWriter(var).write((slice(None),), [280.0, 290.0])
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert numpy.allclose(data, [280.0, 290.0])
+
+def test_write_converts_integer_units(tmp_path, aggregation):
+    path = os.path.join(tmp_path, "frag.nc")
+    write_fragment(path, "temp", {"time": 2}, numpy.array([0, 0], dtype="i2"),
+                   units="degC")
+    var = FakeVariable(aggregation, "temp", [[2]], [path], ["temp"])
+    CFAFragmentWriter(var).write((slice(None),), [300.0, 250.0])
+    with Dataset(path) as nc:
+        assert nc["temp"][:].tolist() == [27, -23]
+
+def test_write_buffered_copies_value(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    writer = CFAFragmentWriter(var, buffered=True)
+    value = numpy.array([1.0, 2.0])
+    writer.write((slice(0, 2),), value)
+    value[...] = 99.0
+    writer.flush()
+    data = CFAFragmentReader(var).read((slice(0, 2),))
+    assert data.tolist() == [1.0, 2.0]
+
+def test_write_workers_file_uri(tmp_path, aggregation):
+    var = _variable(tmp_path, aggregation)
+    var._files = numpy.array([pathlib.Path(f).as_uri() for f in var._files],
+                             dtype=object)
+    CFAFragmentWriter(var, workers=2).write((slice(3, 5),), [1.0, 2.0])
+    data = CFAFragmentReader(var).read((slice(None),))
+    assert data.tolist() == [0.0, 0.0, 0.0, 1.0, 2.0, 0.0, 0.0, 0.0]
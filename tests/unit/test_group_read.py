@@ -0,0 +1,44 @@
+import os.path
+
+import numpy
+from netCDF4 import Dataset
+
+from CFAPython.CFAGroup import CFAGroup
+from CFAPython.CFAStorage import get_backend
+from conftest import FakeGroup, FakeVariable
+
+def _group(tmp_path, agg):
+    """Two aggregation variables, temp and temp2, whose two fragments are
+    in the same two files"""
+    agg.createVariable("temp2", "f8", fill_value=-999.0)
+    files = []
+    for f in range(0, 2):
+        path = os.path.join(tmp_path, f"frag{f}.nc")
+        with Dataset(path, "w") as nc:
+            nc.createDimension("time", 3)
+            for name, offset in (("temp", 0.0), ("temp2", 100.0)):
+                var = nc.createVariable(name, "f8", ("time",))
+                var[:] = numpy.arange(3.0) + 3 * f + offset
+        files.append(path)
+    variables = [FakeVariable(agg, name, [[3, 3]], files, [name, name])
+                 for name in ("temp", "temp2")]
+    group = FakeGroup(agg, variables)
+    group._findVariable = lambda path: CFAGroup._findVariable(group, path)
+    return group
+
+def test_read_several_variables(tmp_path, aggregation):
+    group = _group(tmp_path, aggregation)
+    data = CFAGroup.read(group, {"temp": (slice(None),),
+                                 "/temp2": (slice(2, 4),)})
+    assert data["temp"].tolist() == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    assert data["/temp2"].tolist() == [102.0, 103.0]
+
+def test_read_opens_each_file_once(tmp_path, aggregation):
+    group = _group(tmp_path, aggregation)
+    stats = get_backend("").stats
+    opens = stats.opens
+    data = CFAGroup.read(group, {"temp": (4,), "temp2": (slice(None),)})
+    assert data["temp"] == 4.0
+    assert data["temp2"].tolist() == [100.0, 101.0, 102.0, 103.0, 104.0,
+                                      105.0]
+    assert stats.opens - opens == 2
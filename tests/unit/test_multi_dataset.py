@@ -0,0 +1,9 @@
+import numpy
+
+from CFAPython.CFAMultiDataset import _resolve_files
+
+def test_resolve_files():
+    files = numpy.array(["/data/a.nc", "s3://bucket/b.nc", None], dtype=object)
+    resolved = _resolve_files(files, "/agg/agg.nc")
+    assert resolved.tolist() == ["/data/a.nc", "s3://bucket/b.nc",
+                                 "/agg/agg.nc"]
@@ -0,0 +1,36 @@
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFARaggedIndex import CFARaggedIndex
+
+def test_offsets():
+    index = CFARaggedIndex([3, 0, 2])
+    assert index.offsets.tolist() == [0, 3, 3, 5]
+    assert index.counts.tolist() == [3, 0, 2]
+    assert index.nfeatures == 3
+    assert index.nelements == 5
+
+def test_feature_slices():
+    index = CFARaggedIndex([3, 0, 2])
+    assert index.getFeatureSlice(0) == slice(0, 3)
+    assert index.getFeatureSlice(-1) == slice(3, 5)
+    assert index.getFeatureSlice(0, 3) == slice(0, 5)
+    with pytest.raises(CFAException):
+        index.getFeatureSlice(2, 4)
+
+def test_feature_of():
+    index = CFARaggedIndex([3, 0, 2])
+    assert index.getFeatureOf([0, 2, 3, 4]).tolist() == [0, 0, 2, 2]
+    with pytest.raises(CFAException):
+        index.getFeatureOf(5)
+
+def test_masked_counts():
+    index = CFARaggedIndex(numpy.ma.masked_array([2, 9], mask=[False, True]))
+    assert index.counts.tolist() == [2, 0]
+
+def test_invalid_counts():
+    with pytest.raises(CFAException):
+        CFARaggedIndex([1, -1])
+    with pytest.raises(CFAException):
+        CFARaggedIndex([[1, 2]])
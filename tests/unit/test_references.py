@@ -0,0 +1,70 @@
+import json
+import os.path
+from types import SimpleNamespace
+
+import numpy
+import pytest
+from netCDF4 import Dataset
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAReferences import (_ExportVariable, _JSONWriter,
+                                     _export_batch, _export_variables)
+from conftest import FakeDataset, FakeVariable
+
+def _layout(n_chunks):
+    return {"shape": (2 * n_chunks,), "chunks": (2,), "dtype": "<f8",
+            "filters": [],
+            "starts": numpy.arange(0, 2 * n_chunks, 2).reshape(-1, 1),
+            "byte_offsets": numpy.arange(n_chunks) * 16 + 100,
+            "sizes": numpy.full(n_chunks, 16)}
+
+def test_export_batches(tmp_path):
+    path = os.path.join(tmp_path, "refs.json")
+    writer = _JSONWriter(path)
+    ev = _ExportVariable("/temp", [8], ["x"], {}, None)
+    scanned = []
+
+    def scan(uris, addresses):
+        scanned.append(list(uris))
+        return [{a: _layout(2) for a in addr} for addr in addresses]
+
+    # two batches of fragments, each scanning only its own files
+    files = _export_batch(ev, [("a.nc", "temp", (0,), (4,))], writer, scan)
+    files |= _export_batch(ev, [("b.nc", "temp", (4,), (4,))], writer, scan)
+    writer.close()
+    assert scanned == [["a.nc"], ["b.nc"]]
+    assert files == {"a.nc", "b.nc"}
+    with open(path) as fh:
+        refs = json.load(fh)["refs"]
+    assert refs == {"temp/0": ["a.nc", 100, 16], "temp/1": ["a.nc", 116, 16],
+                    "temp/2": ["b.nc", 100, 16], "temp/3": ["b.nc", 116, 16]}
+
+def test_fragment_encoding():
+    ev = _ExportVariable("temp", [8], ["x"], {"units": "K"}, -999.0)
+    layout = _layout(2)
+    layout["encoding"] = {"units": "K", "_FillValue": -999.0}
+    ev.chunkRefs((0,), (4,), layout)
+    for encoding in ({"units": "degC", "_FillValue": -999.0},
+                     {"units": "K", "_FillValue": 1e20},
+                     {"units": "K", "_FillValue": -999.0,
+                      "scale_factor": 0.5}):
+        layout["encoding"] = encoding
+        with pytest.raises(CFAException):
+            ev.chunkRefs((4,), (4,), layout)
+
+def test_aggregated_coordinate_exported_once(tmp_path):
+    with Dataset(os.path.join(tmp_path, "agg.nc"), "w") as agg:
+        agg.createDimension("time", 4)
+        time = agg.createVariable("time", "f8", ())
+        time.aggregated_data = "location: aggregation_location"
+        agg.createVariable("temp", "f8", ())
+        dim = SimpleNamespace(name="time")
+        variables = []
+        for name in ("temp", "time"):
+            var = FakeVariable(agg, name, [[4]], ["a.nc"], [name])
+            var._dim_names = ["time"]
+            var.getDimensions = lambda: [dim]
+            variables.append(var)
+        ds = FakeDataset(agg, variables)
+        keys = [ev.key for ev, fragments in _export_variables(ds, "agg.nc")]
+    assert keys == ["temp", "time"]
@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFARefragment import (_chunks, _new_index, _parse_frag_def,
+                                     _run_bounded)
+
+MONTHS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def test_new_index_sizes():
+    index = _new_index([365, 4], [MONTHS, 2])
+    assert index.frag_def == [12, 2]
+    assert index.sizes[0].tolist() == MONTHS
+    assert index.getExtent([1, 1]) == [(31, 59), (2, 4)]
+
+def test_new_index_counts():
+    index = _new_index([365], [12])
+    assert index.sizes[0].tolist() == [31] * 5 + [30] * 7
+
+@pytest.mark.parametrize("frag_def", [[[30] * 12], [[365, 0]], [0]])
+def test_new_index_invalid(frag_def):
+    with pytest.raises(CFAException):
+        _new_index([365], frag_def)
+
+def test_chunks_are_bounded_and_cover_the_extent():
+    extent = [(5, 15), (0, 4), (2, 5)]
+    chunks = _chunks(extent, 8, 8 * 12 * 2)
+    covered = numpy.zeros((10, 4, 3), dtype=int)
+    for chunk in chunks:
+        assert covered[chunk].size * 8 <= 8 * 12 * 2
+        covered[chunk] += 1
+    assert numpy.all(covered == 1)
+
+def test_chunks_of_a_scalar():
+    assert _chunks([], 8, 1) == [()]
+
+def test_parse_frag_def():
+    assert _parse_frag_def("12,1") == [12, 1]
+    assert _parse_frag_def("31:28,365:,2") == [[31, 28], [365], 2]
+    assert _new_index([365], _parse_frag_def("365:")).frag_def == [1]
+
+def test_run_bounded_does_not_wait_for_the_slowest_job():
+    last_started = threading.Event()
+    waited = []
+
+    def job(n):
+        if n == 0:
+            # the slow job finishes only once the last job has started
+            waited.append(last_started.wait(5))
+        elif n == 5:
+            last_started.set()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        _run_bounded(pool, job, [(n,) for n in range(0, 6)], 2)
+    assert waited == [True]
+
+def test_run_bounded_raises():
+    def job(n):
+        if n == 2:
+            raise CFAException("failed")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(CFAException):
+            _run_bounded(pool, job, [(n,) for n in range(0, 5)], 2)
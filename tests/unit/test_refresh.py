@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+
+import CFAPython
+from CFAPython.CFADataset import _CFAPoller
+
+def test_access_lock_shared_is_reentrant():
+    lock = CFAPython.CFAAccessLock()
+    with lock.shared():
+        with lock.shared():
+            pass
+    with lock.exclusive():
+        pass
+
+def test_access_lock_exclusive_waits_for_readers():
+    lock = CFAPython.CFAAccessLock()
+    events = []
+    reading = threading.Event()
+
+    def reader():
+        with lock.shared():
+            reading.set()
+            time.sleep(0.05)
+            events.append("read")
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    reading.wait()
+    with lock.exclusive():
+        events.append("refresh")
+    thread.join()
+    assert events == ["read", "refresh"]
+
+def test_access_lock_refresh_while_reading():
+    lock = CFAPython.CFAAccessLock()
+    with lock.shared():
+        with pytest.raises(CFAPython.CFAException):
+            with lock.exclusive():
+                pass
+
+def test_access_lock_exclusive_blocks_new_readers():
+    lock = CFAPython.CFAAccessLock()
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def first_reader():
+        with lock.shared():
+            reading.set()
+            release.wait()
+            events.append("read1")
+
+    def refresh():
+        with lock.exclusive():
+            events.append("refresh")
+
+    def second_reader():
+        with lock.shared():
+            events.append("read2")
+
+    threads = [threading.Thread(target=first_reader)]
+    threads[0].start()
+    reading.wait()
+    threads.append(threading.Thread(target=refresh))
+    threads[1].start()
+    # wait for the refresh to be waiting for the first reader
+    deadline = time.time() + 5
+    while lock._writers_waiting == 0 and time.time() < deadline:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=second_reader))
+    threads[2].start()
+    time.sleep(0.05)
+    assert events == []
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert events == ["read1", "refresh", "read2"]
+
+class _Dataset:
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+        self.closed = False
+
+    def refresh(self):
+        self.calls += 1
+        result = self.results.pop(0) if self.results else False
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+def test_poller_survives_errors():
+    ds = _Dataset([RuntimeError("partial"), True, OSError("gone"), True])
+    changed = []
+    errors = []
+
+    def callback(d):
+        changed.append(d.calls)
+        if len(changed) == 1:
+            raise ValueError("callback failed")
+
+    poller = _CFAPoller(ds, 0.005, callback,
+                        lambda d, e: errors.append(type(e).__name__))
+    poller.start()
+    deadline = time.time() + 5
+    while ds.calls < 6 and time.time() < deadline:
+        time.sleep(0.01)
+    poller.stop()
+    assert not poller.is_alive()
+    assert changed == [2, 4]
+    assert errors == ["RuntimeError", "ValueError", "OSError"]
+
+def test_poller_stops_when_closed():
+    ds = _Dataset([])
+    errors = []
+
+    def refresh():
+        ds.calls += 1
+        ds.closed = True
+        raise CFAPython.CFAException("could not be reopened")
+
+    ds.refresh = refresh
+    poller = _CFAPoller(ds, 0.005, None, lambda d, e: errors.append(e))
+    poller.start()
+    poller.join(5)
+    assert not poller.is_alive()
+    assert ds.calls == 1 and len(errors) == 1
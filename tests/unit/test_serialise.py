@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import numpy
+
+from CFAPython import CFAType
+import CFAPython._CFASerialise as CFASerialise
+
+class _Variable:
+    """An aggregation variable with the definition arrays to write"""
+    def __init__(self):
+        self._dim_names = ["time", "lat"]
+        self.instructions = {}
+
+    def setAggregationInstruction(self, instructions: dict) -> None:
+        self.instructions.update(instructions)
+
+FILES = numpy.array([["a.nc", "bé.nc"], ["c.nc", ""]], dtype=object)
+
+def _instr(term, value, T=CFAType.CFAString):
+    return SimpleNamespace(term=term, value=value, scalar=False, type=T)
+
+def _options(**options):
+    return dict(CFASerialise.DEFAULT_OPTIONS, **options)
+
+def test_strings_uncompressed(aggregation):
+    CFASerialise.write_definition(aggregation, _Variable(),
+                                  [(_instr("file", "file"), FILES)],
+                                  _options())
+    nc_var = aggregation["file"]
+    assert nc_var.dtype is str
+    assert nc_var[...].tolist() == FILES.tolist()
+
+def test_strings_compressed(aggregation):
+    options = _options(compression="zlib", chunksizes={"file": (1, 2)})
+    CFASerialise.write_definition(aggregation, _Variable(),
+                                  [(_instr("file", "file"), FILES)], options)
+    nc_var = aggregation["file"]
+    # the longest file name is 6 bytes in UTF-8
+    assert nc_var.dtype == numpy.dtype("S1")
+    assert nc_var.shape == (2, 2, 6)
+    assert nc_var.filters()["zlib"]
+    assert nc_var.chunking() == [1, 2, 6]
+    assert nc_var[...].tolist() == FILES.tolist()
+
+def test_numbers_compressed(aggregation):
+    options = _options(compression="zlib", complevel=2, shuffle=False)
+    values = numpy.arange(4, dtype="i4").reshape(2, 2)
+    CFASerialise.write_definition(
+        aggregation, _Variable(),
+        [(_instr("index", "index", CFAType.CFAInt), values)], options
+    )
+    filters = aggregation["index"].filters()
+    assert filters["zlib"] and filters["complevel"] == 2
+    assert not filters["shuffle"]
+
+def test_deduplicate(aggregation):
+    var = _Variable()
+    written = {}
+    for name in ("file_a", "file_b"):
+        CFASerialise.write_definition(aggregation, var,
+                                      [(_instr("file", name), FILES)],
+                                      _options(), written)
+    assert "file_b" not in aggregation.variables
+    assert var.instructions == {"file": ("/file_a", False, CFAType.CFAString)}
+
+def test_no_deduplicate(aggregation):
+    var = _Variable()
+    written = {}
+    for name in ("file_a", "file_b"):
+        CFASerialise.write_definition(aggregation, var,
+                                      [(_instr("file", name), FILES)],
+                                      _options(deduplicate=False), written)
+    assert "file_b" in aggregation.variables
+    assert var.instructions == {}
+
+def test_sharded_strings_compressed(tmp_path, aggregation):
+    instr = _instr("file", "file")
+    shards = []
+    for start in range(0, 2):
+        path = str(tmp_path / f"shard{start}.nc")
+        build = lambda start, stop: {"file": FILES[start:stop]}
+        CFASerialise.write_shard(build, start, start + 1,
+                                 {"file": CFAType.CFAString}, [2, 2], path)
+        shards.append((start, start + 1, path))
+    column = CFASerialise.ShardedColumn(shards, instr, [2, 2])
+    CFASerialise.write_definition(aggregation, _Variable(), [(instr, column)],
+                                  _options(compression="zlib"))
+    assert aggregation["file"].shape == (2, 2, 6)
+    assert aggregation["file"][...].tolist() == FILES.tolist()
@@ -0,0 +1,73 @@
+import os.path
+
+import numpy
+import pytest
+
+from CFAPython.CFAExceptions import CFAException
+from CFAPython.CFAVariable import CFAVariable
+import CFAPython._CFASerialise as CFASerialise
+from conftest import FakeVariable
+
+FRAG_DEF = [5, 2]
+
+def build(start, stop):
+    """Build the file and address columns of the fragments start:stop"""
+    rows = numpy.arange(start, stop).reshape(-1, 1)
+    files = numpy.empty((stop - start, FRAG_DEF[1]), dtype=object)
+    for (r, c), _ in numpy.ndenumerate(files):
+        files[r, c] = f"frag_{rows[r, 0]}_{c}.nc"
+    return {"file": files, "address": "temp"}
+
+def build_without_address(start, stop):
+    return {"file": build(start, stop)["file"]}
+
+class _ShardedVariable(FakeVariable):
+    """A variable in write mode whose fragments are set in shards"""
+    setFragmentsSharded = CFAVariable.setFragmentsSharded
+    _releaseShards = CFAVariable._releaseShards
+
+    def __init__(self, agg):
+        super().__init__(agg, "temp", [[1] * FRAG_DEF[0], [2] * FRAG_DEF[1]],
+                         [], [])
+        self._shards = []
+        self._shard_dir = None
+        self._fragment_writes = [(0, 0)]
+
+def _expected():
+    return build(0, FRAG_DEF[0])["file"]
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_shards_hold_the_columns(tmp_path, aggregation, workers):
+    var = _ShardedVariable(aggregation)
+    var.setFragmentsSharded(build, workers=workers, shard_size=2,
+                            tmp_dir=tmp_path)
+    assert [s[0:2] for s in var._shards] == [(0, 2), (2, 4), (4, 5)]
+    assert var._fragment_writes == []
+    instrs = {i.term: i for i in var._variable.instructions}
+    column = CFASerialise.ShardedColumn(var._shards, instrs["file"], FRAG_DEF)
+    assert column.read().tolist() == _expected().tolist()
+    address = CFASerialise.ShardedColumn(var._shards, instrs["address"],
+                                         FRAG_DEF)
+    assert address.read(scalar=True)[()] == "temp"
+
+def test_shards_are_merged_and_released(tmp_path, aggregation):
+    var = _ShardedVariable(aggregation)
+    var.setFragmentsSharded(build, shard_size=2, tmp_dir=tmp_path)
+    shard_dir = var._shard_dir
+    instr = var._variable.instructions[1]
+    column = CFASerialise.ShardedColumn(var._shards, instr, FRAG_DEF)
+    CFASerialise.write_definition(aggregation, var, [(instr, column)])
+    assert aggregation[instr.value][...].tolist() == _expected().tolist()
+    var._releaseShards()
+    assert not os.path.exists(shard_dir)
+    assert var._shards == []
+
+def test_missing_term_removes_the_shards(tmp_path, aggregation):
+    var = _ShardedVariable(aggregation)
+    tmp_dir = tmp_path / "shards"
+    tmp_dir.mkdir()
+    with pytest.raises(CFAException):
+        var.setFragmentsSharded(build_without_address, shard_size=2,
+                                tmp_dir=tmp_dir)
+    assert var._shards == []
+    assert os.listdir(tmp_dir) == []
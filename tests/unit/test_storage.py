@@ -0,0 +1,97 @@
+import os.path
+import threading
+
+import numpy
+import pytest
+from netCDF4 import Dataset
+
+from CFAPython.CFAStorage import (CFAStorageBackend, CFAPosixBackend,
+                                  _mask_and_scale)
+
+from conftest import write_fragment
+
+def _fragments(tmp_path, n):
+    paths = []
+    for i in range(n):
+        path = os.path.join(tmp_path, f"frag{i}.nc")
+        write_fragment(path, "temp", {"x": 4}, numpy.arange(4.0) + i)
+        paths.append(path)
+    return paths
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        CFAStorageBackend()
+
+def test_read_many(tmp_path):
+    path, = _fragments(tmp_path, 1)
+    backend = CFAPosixBackend()
+    data = backend.read_many(path, [("temp", (slice(0, 2),)),
+                                    ("temp", (slice(2, 4),))])
+    assert data[0].tolist() == [0.0, 1.0]
+    assert data[1].tolist() == [2.0, 3.0]
+    assert backend.stats.opens == 1
+    backend.close()
+
+def test_eviction_skips_files_in_use(tmp_path):
+    paths = _fragments(tmp_path, 3)
+    backend = CFAPosixBackend(max_open=1)
+    with backend.dataset(paths[0]) as nc_object:
+        # opening other files must not close the file in use
+        backend.shape(paths[1], "temp")
+        backend.shape(paths[2], "temp")
+        assert nc_object.isopen()
+        assert nc_object["temp"][0] == 0.0
+    # the pool is trimmed again once the file is no longer in use
+    backend.shape(paths[1], "temp")
+    assert not nc_object.isopen()
+    assert len(backend._pool) == 1
+    backend.close()
+
+def test_release_waits_for_users(tmp_path):
+    path, = _fragments(tmp_path, 1)
+    backend = CFAPosixBackend()
+    with backend.dataset(path) as nc_object:
+        backend.release(path)
+        assert nc_object.isopen()
+        assert path not in backend._pool
+    assert not nc_object.isopen()
+
+def test_concurrent_reads(tmp_path):
+    paths = _fragments(tmp_path, 4)
+    backend = CFAPosixBackend(max_open=2)
+    errors = []
+
+    def read(i):
+        try:
+            for _ in range(20):
+                path = paths[i % len(paths)]
+                data = backend.read(path, "temp", (slice(None),))
+                assert data[0] == i % len(paths)
+                i += 1
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    backend.close()
+
+def test_mask_and_scale(tmp_path):
+    # h5netcdf data are masked and scaled as netCDF4 does
+    path = os.path.join(tmp_path, "packed.nc")
+    write_fragment(path, "temp", {"x": 4},
+                   numpy.array([0, 1, -1, 3], dtype="i2"), fill_value=-1)
+    with Dataset(path, "a") as nc:
+        nc["temp"].scale_factor = 0.5
+        nc["temp"].add_offset = 10.0
+        nc["temp"].missing_value = numpy.int16(3)
+        expected = nc["temp"][:]
+        nc["temp"].set_auto_maskandscale(False)
+        raw = nc["temp"][:]
+        attrs = {k: nc["temp"].getncattr(k) for k in nc["temp"].ncattrs()}
+    data = _mask_and_scale(raw, "i2", attrs)
+    assert numpy.ma.getmaskarray(data).tolist() == [False, False, True, True]
+    assert data.compressed().tolist() == expected.compressed().tolist()
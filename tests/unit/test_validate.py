@@ -0,0 +1,73 @@
+import os.path
+import pathlib
+
+import numpy
+
+from CFAPython.CFAValidate import validate
+from conftest import FakeDataset, FakeVariable, write_fragment
+
+def _dataset(tmp_path, agg, files, addresses):
+    for f, file in enumerate(files):
+        if file is not None and not file.startswith("missing"):
+            write_fragment(os.path.join(tmp_path, file), "temp", {"time": 2},
+                           numpy.arange(2.0) + f)
+    files = [None if f is None else os.path.join(tmp_path, f) for f in files]
+    var = FakeVariable(agg, "temp", [[2] * len(files)], files, addresses)
+    return FakeDataset(agg, [var])
+
+def test_validate(tmp_path, aggregation):
+    ds = _dataset(tmp_path, aggregation, ["a.nc", "b.nc"], ["temp", "temp"])
+    report = validate(ds)
+    assert report.ok
+    assert report.n_fragments == 2 and report.n_files == 2
+
+def test_validate_errors(tmp_path, aggregation):
+    ds = _dataset(tmp_path, aggregation, ["a.nc", "missing.nc"],
+                  ["other", "temp"])
+    report = validate(ds)
+    assert sorted(i.check for i in report.errors) == ["address", "file"]
+
+def test_validate_skips_absent_fragments(tmp_path, aggregation):
+    # no address, and an internal address not in the aggregation file
+    ds = _dataset(tmp_path, aggregation, ["a.nc", "b.nc", None],
+                  ["temp", None, "absent"])
+    report = validate(ds)
+    assert report.ok
+    assert report.n_fragments == 1
+
+def test_validate_file_uris(tmp_path, aggregation):
+    ds = _dataset(tmp_path, aggregation, ["a.nc", "missing.nc"],
+                  ["temp", "temp"])
+    var, = ds.CFA._variables
+    var._files = numpy.array([pathlib.Path(f).as_uri() for f in var._files],
+                             dtype=object)
+    report = validate(ds, workers=2, threads=True)
+    assert [i.check for i in report.errors] == ["file"]
+    assert report.errors[0].file.endswith("missing.nc")
+
+def test_validate_shape_dtype_and_units(tmp_path, aggregation):
+    write_fragment(os.path.join(tmp_path, "a.nc"), "temp", {"time": 3},
+                   numpy.arange(3.0))
+    write_fragment(os.path.join(tmp_path, "b.nc"), "temp", {"time": 2},
+                   numpy.array([b"x", b"y"], dtype="S1"))
+    write_fragment(os.path.join(tmp_path, "c.nc"), "temp", {"time": 2},
+                   numpy.arange(2.0), units="degC")
+    files = [os.path.join(tmp_path, f) for f in ("a.nc", "b.nc", "c.nc")]
+    var = FakeVariable(aggregation, "temp", [[2, 2, 2]], files, ["temp"] * 3)
+    report = validate(FakeDataset(aggregation, [var]), workers=2)
+    assert not report.ok
+    assert [(i.check, i.index) for i in report.errors] == [("shape", (0,)),
+                                                          ("dtype", (1,))]
+    assert [(i.check, i.index) for i in report.warnings] == [("units", (2,))]
+    summary = report.to_dict()
+    assert summary["n_fragments"] == 3 and summary["n_files"] == 3
+    assert len(summary["issues"]) == 3
+
+def test_validate_internal_fragments(tmp_path, aggregation):
+    aggregation.createDimension("time", 2)
+    frag = aggregation.createVariable("temp_frag", "f8", ("time",))
+    frag[:] = [1.0, 2.0]
+    ds = _dataset(tmp_path, aggregation, [None, "a.nc"], ["temp_frag", "temp"])
+    report = validate(ds)
+    assert report.ok
+    assert report.n_fragments == 2 and report.n_files == 1